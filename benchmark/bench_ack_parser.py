@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+'''
+ACK classification: chained get_*_from_ack*_content calls of detect_ack_file and process_ack*_file
+versus one ackparser.parse_ack_content scan, on ACK3 XML files of growing size.
+
+usage: python bench_ack_parser.py [-r repeat]
+'''
+import sys
+import os
+import timeit
+import logging
+import argparse
+
+import bench_util
+
+try:
+    from uditransfer import monitor
+    from uditransfer import ackparser
+except:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from uditransfer import monitor
+    from uditransfer import ackparser
+
+SAMPLE_ACK3 = os.path.join(bench_util.SAMPLE_FOLDER, "ack", "temp", "ci1474006022846.2416915@fdsuv05638_te1.xml")
+
+FAILURE = '''  <failure>
+    <reportId />
+    <detail>
+      <section />
+      <errorMessage>STEP 2. One or more of the required validation attributes is null/non-existent</errorMessage>
+      <messageValue />
+      <xPath />
+    </detail>
+  </failure>
+'''
+
+
+def create_ack3_content(target_size):
+    with open(SAMPLE_ACK3, 'r') as content_file:
+        content = content_file.read()
+    head, tail = content.split('</submission>')
+    failures = FAILURE * max(0, (target_size - len(content)) // len(FAILURE))
+    return head + failures + '</submission>' + tail
+
+
+def chained(file_content):
+    ''' what detect_ack_file and then process_ack2_file or process_ack3_file did before ackparser '''
+    message_id = monitor.get_messageid_from_ack2_content(file_content)
+    if message_id:
+        return ('ACK2', monitor.get_messageid_from_ack2_content(file_content),
+                monitor.get_coreid_from_ack2_content(file_content))
+    core_id = monitor.get_coreid_from_ack3_content(file_content)
+    if core_id:
+        return 'ACK3', None, monitor.get_coreid_from_ack3_content(file_content)
+    return '', None, None
+
+
+def single_pass(file_content):
+    ack_info = ackparser.parse_ack_content(file_content)
+    return ack_info.ack_type, ack_info.message_id, ack_info.core_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ACK classification micro benchmark')
+    parser.add_argument('-r', action="store", dest="repeat", type=int, default=20,
+                        help="classifications per measurement")
+    args = parser.parse_args()
+
+    # same logger set up as util.initialize_logger, the all log file going to /dev/null
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setFormatter(logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s"))
+    logger.addHandler(handler)
+
+    for all_file_log in [logging.INFO, logging.DEBUG]:
+        handler.setLevel(all_file_log)
+        print("all_file_log = %s" % logging.getLevelName(all_file_log))
+        print("%10s %14s %14s %8s" % ("size", "chained (ms)", "single (ms)", "speedup"))
+        for target_size in [1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024]:
+            file_content = create_ack3_content(target_size)
+            assert chained(file_content) == single_pass(file_content)
+
+            chained_time = min(timeit.repeat(lambda: chained(file_content), number=args.repeat, repeat=3))
+            single_time = min(timeit.repeat(lambda: single_pass(file_content), number=args.repeat, repeat=3))
+            print("%10d %14.3f %14.3f %7.1fx" % (len(file_content), chained_time * 1000 / args.repeat,
+                                                 single_time * 1000 / args.repeat, chained_time / single_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+'''
+throughput of full process_folders cycles on a synthetic tree built from sample_config.ini.
+
+phase hl7: count HL7 packages in local outbox, some invalid, some only half written until after the first cycle.
+phase ack: ACK1, ACK2 and ACK3 of every forwarded package in remote orphan, plus noise not for CCM.
+cycles run until nothing is left to do, reporting files/sec, cycle latency and peak RSS.
+results are saved as JSON, --compare prints the change against an earlier result file.
+
+usage: python bench_cycle.py [-n count] [-o results.json] [--compare old.json] [--set option=value ...]
+'''
+import sys
+import os
+import time
+import json
+import random
+import shutil
+import logging
+import platform
+import tempfile
+import argparse
+import subprocess
+
+import bench_util
+import loadgen
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+except:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from uditransfer import monitor
+    from uditransfer import configuration
+
+ROOT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RESULT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_FOLDER).decode().strip()
+    except Exception:
+        return None
+
+
+def count_files(folder):
+    return len(monitor.get_file_list(folder))
+
+
+def run_cycles(my_config, pending_folder, partial_files, max_cycles):
+    '''
+    run process_folders until pending_folder is empty or nothing changes any more.
+    half written files are completed after the first cycle. time between cycles is not counted.
+    :return: list of cycle durations
+    '''
+    durations = []
+    previous_count = None
+    for cycle in range(max_cycles):
+        if cycle > 0 and my_config.file_stability_quiet_period > 0:
+            # files seen changing in the previous cycle are only released after the quiet period
+            time.sleep(my_config.file_stability_quiet_period)
+        start = time.time()
+        monitor.process_folders(my_config)
+        durations.append(time.time() - start)
+
+        if cycle == 0:
+            for file_name, rest in partial_files.items():
+                if os.path.exists(file_name):
+                    loadgen.complete_file(file_name, rest)
+            if partial_files:
+                continue
+
+        remaining = count_files(pending_folder)
+        if remaining == 0 or remaining == previous_count:
+            break
+        previous_count = remaining
+    return durations
+
+
+def summarize(name, files, durations):
+    total = sum(durations)
+    result = {'files': files, 'cycles': len(durations), 'seconds': total,
+              'files_per_second': files / total if total > 0 else None,
+              'cycle_p50': bench_util.percentile(durations, 0.5),
+              'cycle_p95': bench_util.percentile(durations, 0.95),
+              'cycle_max': max(durations) if durations else 0.0,
+              'peak_rss_mb': get_peak_rss_mb()}
+    print("%-4s %8d files %4d cycles %8.2fs %10.1f files/s  cycle p50=%.3fs p95=%.3fs max=%.3fs  rss=%.1fMB" % (
+        name, files, len(durations), total, result['files_per_second'] or 0, result['cycle_p50'],
+        result['cycle_p95'], result['cycle_max'], result['peak_rss_mb'] or 0))
+    return result
+
+
+def run(args, overrides):
+    random_generator = random.Random(args.seed)
+    root_folder = tempfile.mkdtemp(prefix="uditransfer-bench-", dir=args.temp_folder)
+    try:
+        settings = {'stdout_log': 'ERROR', 'all_file_log': 'ERROR', 'operation_delay': '0',
+                    'hl7_operation_delay': '0'}
+        settings.update(overrides)
+        config_file = bench_util.create_temp_config(root_folder, settings)
+        my_config = configuration.monitor_configuration(config_file)
+
+        results = {}
+        hl7_template = loadgen.create_hl7_template(args.hl7_filler_bytes)
+        invalid_template = loadgen.create_invalid_hl7_template()
+        start = time.time()
+        submissions, invalid_files, partial_files = loadgen.generate_hl7(
+            my_config.folder_localoutbox, args.count, hl7_template, invalid_template,
+            args.invalid_fraction, args.partial_fraction, random_generator)
+        print("generated %d HL7 files in %.2fs" % (args.count, time.time() - start))
+
+        durations = run_cycles(my_config, my_config.folder_localoutbox, partial_files, args.max_cycles)
+        results['hl7'] = summarize("hl7", args.count, durations)
+        forwarded = set(monitor.get_file_list(my_config.folder_remoteoutbox))
+        results['hl7']['forwarded'] = len(forwarded)
+        results['hl7']['rejected'] = count_files(my_config.folder_hl7flag)
+        results['hl7']['partial'] = len(partial_files)
+        results['hl7']['partial_rejected'] = len([file_name for file_name in partial_files
+                                                  if os.path.basename(file_name) not in forwarded])
+
+        templates = loadgen.ack_templates()
+        start = time.time()
+        ack_count, noise_count, partial_files = loadgen.generate_acks(
+            my_config.folder_remoteorphan, [name for name in submissions if name in forwarded], templates,
+            args.noise_fraction, args.partial_fraction, random_generator)
+        print("generated %d ACK and %d noise files in %.2fs" % (ack_count, noise_count, time.time() - start))
+
+        durations = run_cycles(my_config, my_config.folder_remoteorphan, partial_files, args.max_cycles)
+        results['ack'] = summarize("ack", ack_count + noise_count, durations)
+        results['ack']['delivered'] = count_files(my_config.folder_localinbox)
+        results['ack']['left_in_orphan'] = count_files(my_config.folder_remoteorphan)
+        return results
+    finally:
+        shutil.rmtree(root_folder, ignore_errors=True)
+
+
+def compare(results, old_results):
+    print("change against %s (%s):" % (old_results.get('revision'), old_results.get('time')))
+    for phase in ['hl7', 'ack']:
+        new_rate = results['phases'][phase]['files_per_second']
+        old_rate = old_results['phases'].get(phase, {}).get('files_per_second')
+        if new_rate and old_rate:
+            print("%-4s files/s %10.1f -> %10.1f (%+.1f%%)" % (phase, old_rate, new_rate,
+                                                           (new_rate / old_rate - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='process_folders throughput on synthetic load')
+    parser.add_argument('-n', action="store", dest="count", type=int, default=1000,
+                        help="number of HL7 packages")
+    parser.add_argument('--invalid', action="store", dest="invalid_fraction", type=float, default=0.01,
+                        help="fraction of HL7 files without SUBMISSION.XML")
+    parser.add_argument('--partial', action="store", dest="partial_fraction", type=float, default=0.01,
+                        help="fraction of files only half written during the first cycle")
+    parser.add_argument('--noise', action="store", dest="noise_fraction", type=float, default=0.2,
+                        help="noise files not for CCM per submission")
+    parser.add_argument('--filler', action="store", dest="hl7_filler_bytes", type=int, default=0,
+                        help="bytes of attachment in front of Submission.xml in every HL7 package")
+    parser.add_argument('--max-cycles', action="store", dest="max_cycles", type=int, default=10,
+                        help="cycles per phase at most")
+    parser.add_argument('--seed', action="store", dest="seed", type=int, default=1)
+    parser.add_argument('--temp', action="store", dest="temp_folder", default=None,
+                        help="folder to build the tree in, e.g. on the file system to measure")
+    parser.add_argument('--set', action="append", dest="settings", default=[],
+                        help="configuration option=value, may be repeated")
+    parser.add_argument('-o', action="store", dest="output", default=None,
+                        help="result file, default results/bench_cycle-<time>.json")
+    parser.add_argument('--compare', action="store", dest="compare", default=None,
+                        help="earlier result file to compare with")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    overrides = dict(setting.split('=', 1) for setting in args.settings)
+    results = {'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'revision': get_git_revision(),
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'parameters': vars(args), 'phases': run(args, overrides)}
+
+    output = args.output
+    if output is None:
+        if not os.path.exists(RESULT_FOLDER):
+            os.makedirs(RESULT_FOLDER)
+        output = os.path.join(RESULT_FOLDER, "bench_cycle-%s.json" % time.strftime("%Y%m%d-%H%M%S"))
+    with open(output, 'w') as result_file:
+        json.dump(results, result_file, indent=2, sort_keys=True)
+    print("results saved in %s" % output)
+
+    if args.compare:
+        with open(args.compare) as result_file:
+            compare(results, json.load(result_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''
+flag folders with a growing number of flags, flat versus sharded into hash prefix subfolders:
+names() as process_orphan_acks takes it once per pass, lookups of existing and missing flags,
+and add plus remove of one flag. the flat layout is migrated online into shards and timed as well.
+
+usage: python bench_flag_shards.py [-n 1000,10000,100000] [-d 0,1,2] [-l lookups] [--temp folder]
+'''
+import sys
+import os
+import time
+import random
+import shutil
+import tempfile
+import argparse
+
+import bench_util
+
+try:
+    from uditransfer import configuration
+    from uditransfer import flagstore
+except:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from uditransfer import configuration
+    from uditransfer import flagstore
+
+
+def flag_name(index):
+    return "fda_%08d-0000-0000-0000-000000000000.tar.gz" % index
+
+
+def measure(function, repeat):
+    start = time.time()
+    for index in range(repeat):
+        function(index)
+    return (time.time() - start) / repeat
+
+
+def run_one(root_folder, count, shard_depth, lookups):
+    config_file = bench_util.create_temp_config(root_folder, {'stdout_log': 'ERROR', 'all_file_log': 'ERROR',
+                                                              'flag_shard_depth': str(shard_depth)})
+    my_config = configuration.monitor_configuration(config_file)
+    flag_store = flagstore.folder_flag_store(my_config, shard_depth)
+
+    start = time.time()
+    for index in range(count):
+        flag_store.add(flagstore.ACK2_FLAG, flag_name(index))
+    create_seconds = time.time() - start
+
+    random_generator = random.Random(1)
+    names_seconds = measure(lambda index: flag_store.names(flagstore.ACK2_FLAG), 3)
+    names = flag_store.names(flagstore.ACK2_FLAG)
+    hit_seconds = measure(lambda index: flag_name(random_generator.randrange(count)) in names, lookups)
+    miss_seconds = measure(lambda index: flag_name(count + index) in names, lookups)
+
+    def add_remove(index):
+        flag_store.add(flagstore.ACK3_FLAG, flag_name(index))
+        flag_store.remove(flagstore.ACK3_FLAG, flag_name(index))
+    add_remove_seconds = measure(add_remove, lookups)
+
+    print("%9d %5d %10.2f %12.3f %10.1f %10.1f %12.1f" % (
+        count, shard_depth, create_seconds, names_seconds * 1000, hit_seconds * 1e6, miss_seconds * 1e6,
+        add_remove_seconds * 1e6))
+    return my_config
+
+
+def run_migration(root_folder, count, shard_depth):
+    my_config = configuration.monitor_configuration(os.path.join(root_folder, "config.ini"))
+    flag_store = flagstore.folder_flag_store(my_config, shard_depth)
+    start = time.time()
+    moved = 0
+    while True:
+        one_batch = flag_store.migrate(my_config.flag_shard_migration_batch)
+        if one_batch == 0:
+            break
+        moved += one_batch
+    seconds = time.time() - start
+    print("migrated %d flat flag(s) into depth %d in %.2fs, %.1f us per flag" % (
+        moved, shard_depth, seconds, seconds * 1e6 / max(moved, 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='flat versus sharded flag folders')
+    parser.add_argument('-n', action="store", dest="counts", default="1000,10000,100000",
+                        help="comma separated flag counts")
+    parser.add_argument('-d', action="store", dest="depths", default="0,1,2",
+                        help="comma separated shard depths, 0 is flat")
+    parser.add_argument('-l', action="store", dest="lookups", type=int, default=2000,
+                        help="lookups and add/remove per measurement")
+    parser.add_argument('--temp', action="store", dest="temp_folder", default=None,
+                        help="folder to build the flag folders in, e.g. on the SMB share to measure")
+    args = parser.parse_args()
+
+    counts = [int(count) for count in args.counts.split(',')]
+    depths = [int(depth) for depth in args.depths.split(',')]
+
+    print("%9s %5s %10s %12s %10s %10s %12s" % ("flags", "depth", "create (s)", "names (ms)", "hit (us)",
+                                               "miss (us)", "add+rm (us)"))
+    for count in counts:
+        for shard_depth in depths:
+            root_folder = tempfile.mkdtemp(prefix="uditransfer-flags-", dir=args.temp_folder)
+            try:
+                run_one(root_folder, count, shard_depth, args.lookups)
+                if shard_depth == 0 and max(depths) > 0:
+                    run_migration(root_folder, count, max(depths))
+            finally:
+                shutil.rmtree(root_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
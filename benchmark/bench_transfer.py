@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+'''
+shutil.copyfile + os.remove, as monitor used to transfer files, versus the transfer module.
+runs inside one file system, and across file systems when a second folder is given.
+
+usage: python bench_transfer.py [-s size_mb] [-n files] [-x other_filesystem_folder]
+'''
+import sys
+import os
+import time
+import shutil
+import tempfile
+import argparse
+
+try:
+    from uditransfer import transfer
+except:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from uditransfer import transfer
+
+
+def create_files(folder, count, size):
+    block = os.urandom(1024 * 1024)
+    file_names = []
+    for index in range(count):
+        file_name = os.path.join(folder, "fda_bench-%04d.tar.gz" % index)
+        with open(file_name, 'wb') as target:
+            for _ in range(size // len(block)):
+                target.write(block)
+            target.write(block[:size % len(block)])
+        file_names.append(file_name)
+    return file_names
+
+
+def old_move(source_file, target_file):
+    shutil.copyfile(source_file, target_file)
+    os.remove(source_file)
+
+
+def old_copy(source_file, target_file):
+    shutil.copyfile(source_file, target_file)
+
+
+def empty_flag(source_file, target_file):
+    # the ack1 flag is an empty file, it doesn't share anything with the HL7 message
+    with open(target_file, 'a'):
+        pass
+
+
+def measure(name, function, source_folder, target_folder, count, size):
+    source_files = create_files(source_folder, count, size)
+    start = time.time()
+    for source_file in source_files:
+        function(source_file, os.path.join(target_folder, os.path.basename(source_file)))
+    elapsed = time.time() - start
+
+    for folder in [source_folder, target_folder]:
+        for file_name in os.listdir(folder):
+            os.remove(os.path.join(folder, file_name))
+
+    total_mb = float(count * size) / (1024 * 1024)
+    print("%-28s %8.3fs %10.1f MB/s" % (name, elapsed, total_mb / elapsed if elapsed > 0 else 0))
+
+
+def run(title, source_folder, target_folder, count, size):
+    print(title)
+    measure("move: copyfile + remove", old_move, source_folder, target_folder, count, size)
+    measure("move: transfer.move_file", transfer.move_file, source_folder, target_folder, count, size)
+    measure("copy: shutil.copyfile", old_copy, source_folder, target_folder, count, size)
+    measure("copy: transfer.copy_file", transfer.copy_file, source_folder, target_folder, count, size)
+    measure("ack1 flag: shutil.copyfile", old_copy, source_folder, target_folder, count, size)
+    measure("ack1 flag: empty file", empty_flag, source_folder, target_folder, count, size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='transfer benchmark')
+    parser.add_argument('-s', action="store", dest="size_mb", type=int, default=16, help="file size in MB")
+    parser.add_argument('-n', action="store", dest="count", type=int, default=20, help="number of files")
+    parser.add_argument('-x', action="store", dest="other_folder", default=None,
+                        help="folder on another file system, for cross file system transfers")
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+
+    root_folder = tempfile.mkdtemp(prefix="uditransfer-bench-")
+    other_folder = None
+    try:
+        source_folder = os.path.join(root_folder, "source")
+        target_folder = os.path.join(root_folder, "target")
+        os.makedirs(source_folder)
+        os.makedirs(target_folder)
+        run("same file system, %d x %d MB" % (args.count, args.size_mb), source_folder, target_folder,
+            args.count, size)
+
+        if args.other_folder:
+            other_folder = tempfile.mkdtemp(prefix="uditransfer-bench-", dir=args.other_folder)
+            run("across file systems, %d x %d MB" % (args.count, args.size_mb), source_folder, other_folder,
+                args.count, size)
+    finally:
+        shutil.rmtree(root_folder, ignore_errors=True)
+        if other_folder:
+            shutil.rmtree(other_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
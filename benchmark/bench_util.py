@@ -0,0 +1,26 @@
+import sys
+import os
+import time
+
+sys.path.append("..")
+# the configuration fixture is shared with the tests
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test"))
+
+from config_util import SAMPLE_FOLDER, SAMPLE_CONFIG, FOLDER_OPTIONS, create_temp_config
+
+
+def wait_for_file(file_name, timeout, interval=0.002):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if os.path.exists(file_name):
+            return time.time()
+        time.sleep(interval)
+    return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+HL7 package validation of a directory of large tar.gz files: scanned in HL7 threads under the interpreter
+lock, versus handed over to a validation pool of 1, 2, 4 ... processes.
+SUBMISSION.XML is the last member of generated packages, so every package is decompressed completely.
+
+usage: python bench_validation.py [-d folder of tar.gz files] [-n 16] [-s 32] [-p 0,1,2,4] [-t threads]
+'''
+import sys
+import os
+import time
+import shutil
+import tarfile
+import binascii
+import tempfile
+import argparse
+import multiprocessing
+
+try:
+    from uditransfer import validation
+    from uditransfer import workers
+except:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from uditransfer import validation
+    from uditransfer import workers
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def add_member(tar, name, size):
+    '''
+    add a member of size bytes of hex text, which compresses about 2:1 like typical submissions
+    '''
+    temp_file = tempfile.NamedTemporaryFile(delete=False)
+    try:
+        written = 0
+        while written < size:
+            chunk = binascii.hexlify(os.urandom(min(CHUNK_SIZE, size - written) // 2 + 1))[:size - written]
+            temp_file.write(chunk)
+            written += len(chunk)
+        temp_file.close()
+        tar.add(temp_file.name, arcname=name)
+    finally:
+        os.remove(temp_file.name)
+
+
+def create_packages(folder, count, size_mb):
+    for index in range(count):
+        package = os.path.join(folder, "fda_%08d-0000-0000-0000-000000000000.tar.gz" % index)
+        with tarfile.open(package, 'w:gz') as tar:
+            add_member(tar, "payload.dat", size_mb * 1024 * 1024)
+            add_member(tar, "SUBMISSION.XML", 1024)
+    print("created %d package(s) of %d MB uncompressed in %s" % (count, size_mb, folder))
+
+
+def scan_in_threads(packages, thread_count):
+    results = workers.run_tasks(lambda package: validation.scan_package(package)[0], packages, thread_count,
+                                "scan")
+    return results
+
+
+def scan_in_pool(packages, process_count):
+    pool = validation.validation_pool(process_count, min_bytes=0)
+    try:
+        pending_verdicts = [pool.submit(package) for package in packages]
+        return [pending_verdict.get() for pending_verdict in pending_verdicts]
+    finally:
+        pool.close()
+
+
+def measure(label, function, packages, total_bytes, baseline=None):
+    start = time.time()
+    verdicts = function()
+    seconds = time.time() - start
+    assert all(verdicts), "some packages are not valid"
+    print("%-24s %8.2f %10.1f %10.1f %8s" % (label, seconds, len(packages) / seconds,
+                                              total_bytes / seconds / 1024 / 1024,
+                                              "%.2fx" % (baseline / seconds) if baseline else "1.00x"))
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HL7 validation in threads versus a process pool')
+    parser.add_argument('-d', action="store", dest="folder", default=None,
+                        help="folder of tar.gz packages, generated into a temporary folder if not given")
+    parser.add_argument('-n', action="store", dest="count", type=int, default=16,
+                        help="number of packages to generate")
+    parser.add_argument('-s', action="store", dest="size_mb", type=int, default=32,
+                        help="uncompressed MB per generated package")
+    parser.add_argument('-p', action="store", dest="processes", default=None,
+                        help="comma separated process counts, default 1, 2, 4 ... up to the number of cores")
+    parser.add_argument('-t', action="store", dest="threads", type=int, default=multiprocessing.cpu_count(),
+                        help="HL7 threads scanning in process, default the number of cores")
+    args = parser.parse_args()
+
+    cpu_count = multiprocessing.cpu_count()
+    if args.processes:
+        process_counts = [int(count) for count in args.processes.split(',')]
+    else:
+        process_counts = [count for count in [1, 2, 4, 8, 16, 32] if count < cpu_count] + [cpu_count]
+
+    temp_folder = None
+    folder = args.folder
+    if folder is None:
+        temp_folder = tempfile.mkdtemp(prefix="uditransfer-validation-")
+        folder = temp_folder
+        create_packages(folder, args.count, args.size_mb)
+
+    try:
+        packages = sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".tar.gz"))
+        total_bytes = sum(os.path.getsize(package) for package in packages)
+        print("%d package(s), %.1f MB compressed, %d core(s)" % (len(packages), total_bytes / 1024.0 / 1024,
+                                                                 cpu_count))
+        # the first pass warms up the page cache for all of them
+        scan_in_threads(packages, 1)
+
+        print("%-24s %8s %10s %10s %8s" % ("", "seconds", "files/s", "MB/s", "speedup"))
+        baseline = measure("in process, 1 thread", lambda: scan_in_threads(packages, 1), packages, total_bytes)
+        if args.threads > 1:
+            measure("in process, %d threads" % args.threads, lambda: scan_in_threads(packages, args.threads),
+                    packages, total_bytes, baseline)
+        for process_count in process_counts:
+            measure("pool, %d process(es)" % process_count, lambda: scan_in_pool(packages, process_count),
+                    packages, total_bytes, baseline)
+    finally:
+        if temp_folder:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
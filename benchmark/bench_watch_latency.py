@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+latency of a HL7 package from local outbox to remote outbox, -p poll loop versus --watch mode.
+
+usage: python bench_watch_latency.py [-n samples] [-s sleeptime]
+'''
+import sys
+import os
+import time
+import shutil
+import random
+import tempfile
+import argparse
+import subprocess
+
+import bench_util
+
+ROOT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SAMPLE_HL7 = os.path.join(bench_util.SAMPLE_FOLDER, "HL7", "fda_15ff7927-91f6-4fd8-80cb-bbddc6fa0cd1.tar.gz")
+
+
+def measure(mode_flag, samples, sleeptime):
+    root_folder = tempfile.mkdtemp(prefix="uditransfer-bench-")
+    try:
+        config_file = bench_util.create_temp_config(root_folder, {'sleeptime': str(sleeptime),
+                                                                 'stdout_log': 'ERROR',
+                                                                 'all_file_log': 'ERROR'})
+        localoutbox = os.path.join(root_folder, "localoutbox")
+        remoteoutbox = os.path.join(root_folder, "remoteoutbox")
+        if not os.path.exists(localoutbox):
+            os.makedirs(localoutbox)
+
+        process = subprocess.Popen([sys.executable, "-m", "uditransfer.monitor", "-c", config_file, mode_flag],
+                                   cwd=ROOT_FOLDER)
+        latencies = []
+        try:
+            time.sleep(1)
+            for index in range(samples):
+                # land at a random point of the poll interval
+                time.sleep(random.uniform(0, sleeptime))
+                file_name = "fda_bench-%04d.tar.gz" % index
+                temp_file = os.path.join(localoutbox, "." + file_name)
+                shutil.copyfile(SAMPLE_HL7, temp_file)
+                start = time.time()
+                os.rename(temp_file, os.path.join(localoutbox, file_name))
+                arrived = bench_util.wait_for_file(os.path.join(remoteoutbox, file_name), sleeptime * 4 + 10)
+                if arrived is None:
+                    print("%s: %s never arrived!" % (mode_flag, file_name))
+                    continue
+                latencies.append(arrived - start)
+        finally:
+            process.terminate()
+            process.wait()
+        return latencies
+    finally:
+        shutil.rmtree(root_folder, ignore_errors=True)
+
+
+def report(name, latencies):
+    if not latencies:
+        print("%-8s no samples" % name)
+        return
+    print("%-8s samples=%-4d mean=%.3fs p50=%.3fs p95=%.3fs max=%.3fs" % (
+        name, len(latencies), sum(latencies) / len(latencies), bench_util.percentile(latencies, 0.5),
+        bench_util.percentile(latencies, 0.95), max(latencies)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HL7 forward latency: poll loop versus watch mode')
+    parser.add_argument('-n', action="store", dest="samples", type=int, default=20,
+                        help="number of HL7 packages to drop per mode")
+    parser.add_argument('-s', action="store", dest="sleeptime", type=int, default=5,
+                        help="sleeptime of the poll loop in second")
+    args = parser.parse_args()
+
+    report("poll", measure("-p", args.samples, args.sleeptime))
+    report("watch", measure("--watch", args.samples, args.sleeptime))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+'''
+synthetic HL7 packages and ACK files modeled on sample/HL7, sample/ACKs and sample/ack.
+'''
+import os
+import io
+import uuid
+import random
+import tarfile
+
+import bench_util
+
+SAMPLE_HL7 = os.path.join(bench_util.SAMPLE_FOLDER, "HL7", "fda_15ff7927-91f6-4fd8-80cb-bbddc6fa0cd1.tar.gz")
+SAMPLE_ACKS = os.path.join(bench_util.SAMPLE_FOLDER, "ACKs")
+SAMPLE_SUBMISSION = "fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz"
+SAMPLE_NOISE = [os.path.join(bench_util.SAMPLE_FOLDER, "ack", "temp", name)
+                for name in ["ci1474006022846.2416915@fdsuv05638_te1.txt",
+                             "ci1474006022846.2416915@fdsuv05638_te1.xml",
+                             "fda_bdb7caa7-6246-4658-84e3-56863d0a1347.tar.gz"]]
+
+
+def read_file(file_name):
+    with open(file_name, 'rb') as content_file:
+        return content_file.read()
+
+
+def add_member(tar, name, content):
+    tar_info = tarfile.TarInfo(name)
+    tar_info.size = len(content)
+    tar.addfile(tar_info, io.BytesIO(content))
+
+
+def create_hl7_template(filler_bytes=0):
+    '''
+    tar.gz with the Submission.xml of the sample HL7 package, behind a random filler member of filler_bytes.
+    every generated package is a copy of it, the monitor doesn't look at member content.
+    '''
+    with tarfile.open(SAMPLE_HL7, 'r:gz') as sample_tar:
+        member = [one for one in sample_tar.getmembers() if one.isfile()][0]
+        submission_xml = sample_tar.extractfile(member).read()
+        submission_name = member.name
+
+    output = io.BytesIO()
+    tar = tarfile.open(fileobj=output, mode='w:gz')
+    if filler_bytes > 0:
+        add_member(tar, "attachment.bin", os.urandom(filler_bytes))
+    add_member(tar, submission_name, submission_xml)
+    tar.close()
+    return output.getvalue()
+
+
+def create_invalid_hl7_template():
+    output = io.BytesIO()
+    tar = tarfile.open(fileobj=output, mode='w:gz')
+    add_member(tar, "readme.txt", b"no submission in here")
+    tar.close()
+    return output.getvalue()
+
+
+class ack_templates():
+    ''' sample ACK1, ACK2 and ACK3 with the sample submission name replaced by another one
+    '''
+    def __init__(self):
+        self.ack1 = read_file(os.path.join(SAMPLE_ACKS, SAMPLE_SUBMISSION))
+        self.ack2 = read_file(os.path.join(SAMPLE_ACKS, "ACK2_" + SAMPLE_SUBMISSION))
+        self.ack3 = read_file(os.path.join(SAMPLE_ACKS, "ACK3_" + SAMPLE_SUBMISSION))
+        self.noise = [read_file(file_name) for file_name in SAMPLE_NOISE]
+
+    def create(self, template, submission):
+        return template.replace(SAMPLE_SUBMISSION.encode('ascii'), submission.encode('ascii'))
+
+
+def new_submission_name():
+    return "fda_%s.tar.gz" % uuid.uuid4()
+
+
+def write_file(file_name, content, partial=False):
+    '''
+    write content through a hidden temp file and a rename, like a well behaved sender.
+    partial files are written in place and only half of them, like a sender caught mid-transfer.
+    :return: the missing rest of the content, None if the file is complete
+    '''
+    if partial:
+        half = len(content) // 2
+        with open(file_name, 'wb') as target:
+            target.write(content[:half])
+        return content[half:]
+
+    folder, name = os.path.split(file_name)
+    temp_file = os.path.join(folder, "." + name + ".tmp")
+    with open(temp_file, 'wb') as target:
+        target.write(content)
+    os.rename(temp_file, file_name)
+    return None
+
+
+def complete_file(file_name, rest):
+    with open(file_name, 'ab') as target:
+        target.write(rest)
+
+
+def generate_hl7(folder, count, hl7_template, invalid_template, invalid_fraction=0.0, partial_fraction=0.0,
+                 random_generator=random):
+    '''
+    :return: (submission names of valid packages, invalid file names, dict of partial file name -> missing rest)
+    '''
+    submissions = []
+    invalid_files = []
+    partial_files = {}
+    for _ in range(count):
+        name = new_submission_name()
+        if random_generator.random() < invalid_fraction:
+            write_file(os.path.join(folder, name), invalid_template)
+            invalid_files.append(name)
+            continue
+
+        submissions.append(name)
+        partial = random_generator.random() < partial_fraction
+        rest = write_file(os.path.join(folder, name), hl7_template, partial)
+        if rest is not None:
+            partial_files[os.path.join(folder, name)] = rest
+    return submissions, invalid_files, partial_files
+
+
+def generate_acks(folder, submissions, templates, noise_fraction=0.0, partial_fraction=0.0,
+                  random_generator=random):
+    '''
+    ACK1, ACK2 and ACK3 of every submission, plus noise not for CCM modeled on sample/ack.
+    :return: (number of ACK files, number of noise files, dict of partial file name -> missing rest)
+    '''
+    ack_count = 0
+    noise_count = 0
+    partial_files = {}
+    for submission in submissions:
+        for prefix, template in [("", templates.ack1), ("ACK2_", templates.ack2), ("ACK3_", templates.ack3)]:
+            file_name = os.path.join(folder, prefix + submission)
+            partial = random_generator.random() < partial_fraction
+            rest = write_file(file_name, templates.create(template, submission), partial)
+            if rest is not None:
+                partial_files[file_name] = rest
+            ack_count += 1
+
+        if random_generator.random() < noise_fraction:
+            noise = random_generator.choice(templates.noise)
+            write_file(os.path.join(folder, "ci%d.%s.txt" % (random_generator.randint(0, 10 ** 12), uuid.uuid4())),
+                       noise)
+            noise_count += 1
+    return ack_count, noise_count, partial_files
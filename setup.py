@@ -2,6 +2,8 @@
 
 # ...
 
+import sys
+
 try:
     from setuptools import setup
 except ImportError:
@@ -21,4 +23,6 @@ setup(name='monitor.py',
       license="PTC Only",
       platforms=["any"],
       #install_requires=['matplotlib','pandas'],
+      # os.scandir is only there from python 3.5 on, the backport lists folders without a stat per file
+      install_requires=['scandir'] if sys.version_info < (3, 5) else [],
       )
@@ -0,0 +1,50 @@
+import os
+import re
+import codecs
+
+SAMPLE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sample")
+SAMPLE_CONFIG = os.path.join(SAMPLE_FOLDER, "sample_config.ini")
+
+FOLDER_OPTIONS = ['folder_localinbox', 'folder_localoutbox', 'folder_remoteinbox', 'folder_remoteoutbox',
+                  'folder_remoteorphan', 'folder_hl7flag', 'folder_ack1flag', 'folder_ack2flag',
+                  'folder_ack3flag', 'folder_tobedeleted', 'folder_logs']
+
+
+def create_temp_config(root_folder, overrides=None, config_name="config.ini"):
+    '''
+    copy sample_config.ini into root_folder, with every folder option pointing into root_folder.
+    shared by the tests and the benchmarks.
+    :param root_folder: temporary folder the whole tree lives in, created if needed
+    :param overrides: dict of option name to value, appended or replaced in [General]
+    :param config_name: file name of the configuration in root_folder
+    :return: path of the new configuration file
+    '''
+    options = dict((name, os.path.join(root_folder, name.replace('folder_', ''))) for name in FOLDER_OPTIONS)
+    if overrides:
+        options.update(overrides)
+
+    with codecs.open(SAMPLE_CONFIG, 'r', encoding='utf-8') as cf:
+        lines = cf.read().splitlines()
+
+    written = set()
+    output = []
+    for line in lines:
+        match = re.match(r'^(\w+)\s*=', line)
+        if match and match.group(1) in options:
+            name = match.group(1)
+            output.append("%s = %s" % (name, options[name]))
+            written.add(name)
+        else:
+            output.append(line)
+
+    for name in sorted(options):
+        if name not in written:
+            output.append("%s = %s" % (name, options[name]))
+
+    if not os.path.exists(root_folder):
+        os.makedirs(root_folder)
+    config_file = os.path.join(root_folder, config_name)
+    with codecs.open(config_file, 'w', encoding='utf-8') as cf:
+        cf.write("\n".join(output) + "\n")
+
+    return config_file
@@ -0,0 +1,184 @@
+import unittest
+import sys
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import subprocess
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import flagstore
+    from uditransfer import latency
+    from uditransfer import claims
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import flagstore
+    from uditransfer import latency
+    from uditransfer import claims
+import config_util
+
+SAMPLE_SUBMISSION = "fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz"
+
+# one instance processing its share of the folders until both shared folders are empty
+INSTANCE = '''
+import sys
+import time
+sys.path.append("..")
+from uditransfer import monitor
+from uditransfer import configuration
+from uditransfer import claims
+
+my_config = configuration.monitor_configuration(sys.argv[1])
+deadline = time.time() + 60
+while time.time() < deadline:
+    if monitor.process_folders(my_config) == 0:
+        if not (monitor.get_file_list(my_config.folder_localoutbox) or
+                monitor.get_file_list(my_config.folder_remoteorphan)):
+            break
+        time.sleep(0.05)
+my_config.latency_recorder.close()
+claims.close_claim_manager(my_config)
+'''
+
+
+class ClaimsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_folder = tempfile.mkdtemp()
+        self.claim_folder = os.path.join(self.temp_folder, "claims")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def create_file(self, file_name):
+        file_name = os.path.join(self.temp_folder, file_name)
+        with open(file_name, 'w') as one_file:
+            one_file.write("content")
+        return file_name
+
+    def test_partition(self):
+        names = ["fda_%d.tar.gz" % index for index in range(300)]
+        selected = [claims.claim_manager(instance_count=3, instance_index=index).select(self.temp_folder, names)
+                    for index in range(3)]
+        assert (sorted(selected[0] + selected[1] + selected[2]) == sorted(names))
+        assert (min(len(one_selection) for one_selection in selected) > 50)
+        assert (claims.claim_manager().select(self.temp_folder, names) == names)
+
+    def test_claim_and_release(self):
+        self.create_file("fda_1.tar.gz")
+        first = claims.claim_manager(self.claim_folder, "first")
+        second = claims.claim_manager(self.claim_folder, "second")
+
+        with first.claim(claims.HL7_CLAIMS, self.temp_folder, "fda_1.tar.gz") as first_claim:
+            assert (first_claim)
+            with second.claim(claims.HL7_CLAIMS, self.temp_folder, "fda_1.tar.gz") as second_claim:
+                assert (not second_claim)
+        assert (not os.path.exists(first.describe(claims.HL7_CLAIMS, "fda_1.tar.gz")))
+
+        assert (second.acquire(claims.HL7_CLAIMS, self.temp_folder, "fda_1.tar.gz"))
+        second.release(claims.HL7_CLAIMS, "fda_1.tar.gz")
+        # gone means handled by someone else
+        assert (not second.acquire(claims.HL7_CLAIMS, self.temp_folder, "fda_2.tar.gz"))
+        assert (os.listdir(os.path.join(self.claim_folder, claims.HL7_CLAIMS)) == [])
+        first.close()
+        second.close()
+
+    def test_take_over_expired_claim(self):
+        self.create_file("fda_1.tar.gz")
+        crashed = claims.claim_manager(self.claim_folder, "crashed", lease_seconds=60)
+        survivor = claims.claim_manager(self.claim_folder, "survivor", lease_seconds=60)
+        assert (crashed.acquire(claims.ORPHAN_CLAIMS, self.temp_folder, "fda_1.tar.gz"))
+        assert (not survivor.acquire(claims.ORPHAN_CLAIMS, self.temp_folder, "fda_1.tar.gz"))
+
+        claim_file = crashed.describe(claims.ORPHAN_CLAIMS, "fda_1.tar.gz")
+        os.utime(claim_file, (time.time() - 120, time.time() - 120))
+        assert (survivor.acquire(claims.ORPHAN_CLAIMS, self.temp_folder, "fda_1.tar.gz"))
+        assert (survivor.taken_over == 1)
+        with open(claim_file) as claim_stream:
+            assert (claim_stream.read().startswith("survivor "))
+
+        # renewal keeps a held claim from expiring
+        os.utime(claim_file, (time.time() - 120, time.time() - 120))
+        survivor.renew()
+        assert (not crashed.acquire(claims.ORPHAN_CLAIMS, self.temp_folder, "fda_1.tar.gz"))
+
+        # an expired claim of a file which is gone is swept away
+        os.remove(os.path.join(self.temp_folder, "fda_1.tar.gz"))
+        os.utime(claim_file, (time.time() - 120, time.time() - 120))
+        assert (crashed.sweep({claims.ORPHAN_CLAIMS: self.temp_folder}) == 1)
+        assert (not os.path.exists(claim_file))
+        survivor.close()
+        crashed.close()
+
+    def create_config(self, root_folder, instance_count, instance_index):
+        # copy and remove leaves the widest window for two instances delivering the same file
+        return config_util.create_temp_config(root_folder, {
+            'stdout_log': 'ERROR', 'all_file_log': 'ERROR', 'operation_delay': '0',
+            'hl7_operation_delay': '0', 'operation_method': 'Copy', 'hl7_operation_method': 'Copy',
+            'claim_folder': self.claim_folder,
+            'instance_count': str(instance_count),
+            'instance_index': str(instance_index if instance_count > 1 else 0),
+            'instance_id': "instance-%d" % instance_index,
+            'latency_log_file': os.path.join(root_folder, "latency-%d.log" % instance_index)},
+            "config-%d.ini" % instance_index)
+
+    def run_instances(self, config_files):
+        instances = [subprocess.Popen([sys.executable, "-c", INSTANCE, config_file]) for config_file in config_files]
+        for instance in instances:
+            assert (instance.wait() == 0)
+
+    def check_instances(self, instance_count):
+        root_folder = os.path.join(self.temp_folder, "root-%d" % instance_count)
+        config_files = [self.create_config(root_folder, instance_count, index) for index in range(3)]
+        my_config = configuration.monitor_configuration(config_files[0])
+
+        submissions = ["fda_%s.tar.gz" % uuid.uuid4() for _ in range(40)]
+        for submission in submissions:
+            shutil.copyfile(os.path.join("../sample/HL7", SAMPLE_SUBMISSION),
+                            os.path.join(my_config.folder_localoutbox, submission))
+        self.run_instances(config_files)
+        assert (sorted(monitor.get_file_list(my_config.folder_remoteoutbox)) == sorted(submissions))
+
+        ack_files = []
+        for submission in submissions:
+            for prefix in ["", "ACK2_", "ACK3_"]:
+                with open(os.path.join("../sample/ACKs", prefix + SAMPLE_SUBMISSION), 'rb') as sample_ack:
+                    content = sample_ack.read().replace(SAMPLE_SUBMISSION.encode('ascii'),
+                                                        submission.encode('ascii'))
+                with open(os.path.join(my_config.folder_remoteorphan, prefix + submission), 'wb') as ack_file:
+                    ack_file.write(content)
+                ack_files.append(prefix + submission)
+        self.run_instances(config_files)
+
+        assert (sorted(monitor.get_file_list(my_config.folder_localinbox)) == sorted(ack_files))
+        assert (monitor.get_file_list(my_config.folder_remoteorphan) == [])
+        for kind in flagstore.FLAG_KINDS:
+            assert (monitor.get_file_list(flagstore.get_flag_folder(my_config, kind)) == [])
+
+        # every stage of every submission has been handled exactly once, by one of the instances
+        stage_records = {}
+        for index in range(3):
+            with open(os.path.join(root_folder, "latency-%d.log" % index)) as latency_log:
+                for line in latency_log:
+                    fields = line.rstrip('\n').split('\t')
+                    stage_records.setdefault(fields[1], []).append(fields[2])
+        for stage in latency.STAGES:
+            assert (len(stage_records[stage]) == len(submissions)), stage
+            assert (len(set(stage_records[stage])) == len(submissions)), stage
+        assert (os.listdir(os.path.join(self.claim_folder, claims.HL7_CLAIMS)) == [])
+        assert (os.listdir(os.path.join(self.claim_folder, claims.ORPHAN_CLAIMS)) == [])
+
+    def test_instances_racing_for_the_same_files(self):
+        self.check_instances(1)
+
+    def test_partitioned_instances(self):
+        self.check_instances(3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import unittest
+import sys
+import os
+import json
+import shutil
+import tempfile
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import transfer
+    from uditransfer import dedup
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import transfer
+    from uditransfer import dedup
+import config_util
+
+
+class DedupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_hl7 = "../sample/HL7"
+        self.folder_acks = "../sample/ACKs"
+        self.hl7_file = r'fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
+        self.temp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def create_config(self, policy):
+        config_file = config_util.create_temp_config(os.path.join(self.temp_folder, policy),
+                                                     {'hl7_operation_delay': '-1', 'dedup_policy': policy})
+        return configuration.monitor_configuration(config_file)
+
+    def test_store(self):
+        store_file = os.path.join(self.temp_folder, "store.json")
+        store = dedup.dedup_store(store_file, max_entries=2, ttl=100)
+        assert (store.add('hl7', 'a', 'first', now=1000) is None)
+        assert (store.add('hl7', 'a', 'second', now=1001) == 'first')
+        # kinds are kept apart
+        assert (store.add('ack', 'a', 'ack', now=1002) is None)
+        assert (store.get('hl7', 'a', now=1050) == 'first')
+        assert (store.get('hl7', 'a', now=1101) is None)
+
+        # the oldest digest goes first
+        assert (store.add('hl7', 'b', 'b', now=1003) is None)
+        assert (store.add('hl7', 'c', 'c', now=1004) is None)
+        assert (len(store) == 2 and store.get('ack', 'a', now=1005) is None)
+
+        store.save()
+        assert (not os.path.exists(store_file + ".tmp"))
+        with open(store_file) as store_stream:
+            assert (len(json.load(store_stream)) == 2)
+        assert (len(dedup.dedup_store(store_file, ttl=0)) == 2)
+        # expired entries are not loaded
+        assert (len(dedup.dedup_store(store_file, ttl=1)) == 0)
+
+    def test_stream_copy_choose_target(self):
+        source_file = os.path.join(self.folder_hl7, self.hl7_file)
+        target_file = os.path.join(self.temp_folder, "target")
+        other_file = os.path.join(self.temp_folder, "other")
+
+        result = transfer.stream_copy(source_file, target_file, choose_target=lambda result: None)
+        assert (result.target is None and result.digest)
+        assert (os.listdir(self.temp_folder) == [])
+
+        result = transfer.stream_copy(source_file, target_file, choose_target=lambda result: other_file)
+        assert (result.target == other_file)
+        assert (os.listdir(self.temp_folder) == ["other"])
+        assert (transfer.stream_copy(source_file, target_file).target == target_file)
+
+    def test_stream_move(self):
+        source_file = os.path.join(self.temp_folder, "source")
+        target_file = os.path.join(self.temp_folder, "target")
+        shutil.copyfile(os.path.join(self.folder_hl7, self.hl7_file), source_file)
+        digest = transfer.stream_copy(source_file, os.path.join(self.temp_folder, "copy")).digest
+        os.remove(os.path.join(self.temp_folder, "copy"))
+
+        def fail(result):
+            # hashed where it is
+            assert (os.listdir(self.temp_folder) == ["source"])
+            raise ValueError("choose_target failed")
+
+        # nothing published, the source stays
+        self.assertRaises(ValueError, transfer.stream_move, source_file, target_file, choose_target=fail)
+        assert (os.listdir(self.temp_folder) == ["source"])
+
+        # renamed on one file system, not copied
+        inode = os.stat(source_file).st_ino
+        result = transfer.stream_move(source_file, target_file, head_size=10)
+        assert (result.renamed and result.digest == digest and result.head_digest)
+        assert (result.target == target_file and os.stat(target_file).st_ino == inode)
+        assert (os.listdir(self.temp_folder) == ["target"])
+
+        result = transfer.stream_move(target_file, source_file, choose_target=lambda result: None)
+        assert (result.target is None and result.digest == digest)
+        assert (os.listdir(self.temp_folder) == [])
+
+    def test_hl7_duplicates(self):
+        for policy, remaining in [('skip', []), ('quarantine', ["fda_copy.tar.gz"])]:
+            my_config = self.create_config(policy)
+            shutil.copyfile(os.path.join(self.folder_hl7, self.hl7_file),
+                            os.path.join(my_config.folder_localoutbox, self.hl7_file))
+            assert (monitor.process_hl7_message(my_config) == 1)
+
+            shutil.copyfile(os.path.join(self.folder_hl7, self.hl7_file),
+                            os.path.join(my_config.folder_localoutbox, "fda_copy.tar.gz"))
+            assert (monitor.process_hl7_message(my_config) == 0)
+            assert (monitor.get_file_list(my_config.folder_localoutbox) == [])
+            assert (monitor.get_file_list(my_config.folder_remoteoutbox) == [self.hl7_file])
+            # only the original waits for its ACK1
+            assert (monitor.get_file_list(my_config.folder_ack1flag) == [self.hl7_file])
+            quarantine_folder = os.path.join(my_config.folder_quarantine, 'duplicates', dedup.HL7_DIGESTS)
+            assert ((monitor.get_file_list(quarantine_folder) if os.path.exists(quarantine_folder) else []) ==
+                    remaining)
+
+            # the store is kept across restarts
+            assert (len(dedup.dedup_store(dedup.get_store_file(my_config))) == 1)
+
+    def test_forward(self):
+        my_config = self.create_config('forward')
+        for hl7_file in [self.hl7_file, "fda_copy.tar.gz"]:
+            shutil.copyfile(os.path.join(self.folder_hl7, self.hl7_file),
+                            os.path.join(my_config.folder_localoutbox, hl7_file))
+        assert (monitor.process_hl7_message(my_config) == 2)
+        assert (len(monitor.get_file_list(my_config.folder_remoteoutbox)) == 2)
+
+    def test_ack_duplicate(self):
+        my_config = self.create_config('skip')
+        ack_file = os.path.join(self.folder_acks, self.hl7_file)
+        for name in ["first.tar.gz", "second.tar.gz"]:
+            shutil.copyfile(ack_file, os.path.join(my_config.folder_remoteorphan, name))
+        with open(ack_file, 'rb') as ack_stream:
+            file_content = ack_stream.read()
+
+        assert (monitor.create_file(my_config, os.path.join(my_config.folder_remoteorphan, "first.tar.gz"),
+                                    os.path.join(my_config.folder_localinbox, "first.tar.gz"),
+                                    file_content, "ACK1") is True)
+        assert (monitor.create_file(my_config, os.path.join(my_config.folder_remoteorphan, "second.tar.gz"),
+                                    os.path.join(my_config.folder_localinbox, "second.tar.gz"),
+                                    file_content, "ACK1") == dedup.DUPLICATE)
+        assert (monitor.get_file_list(my_config.folder_localinbox) == ["first.tar.gz"])
+        # moved, whatever became of the copy
+        assert (monitor.get_file_list(my_config.folder_remoteorphan) == [])
+
+        # resent under its first name, it's a duplicate all the same
+        shutil.copyfile(ack_file, os.path.join(my_config.folder_remoteorphan, "first.tar.gz"))
+        assert (monitor.create_file(my_config, os.path.join(my_config.folder_remoteorphan, "first.tar.gz"),
+                                    os.path.join(my_config.folder_localinbox, "first.tar.gz"),
+                                    file_content, "ACK1") == dedup.DUPLICATE)
+
+    def test_failed_transfer_is_rolled_back(self):
+        my_config = self.create_config('skip')
+        source_file = os.path.join(my_config.folder_remoteorphan, "first.tar.gz")
+        shutil.copyfile(os.path.join(self.folder_acks, self.hl7_file), source_file)
+        with open(source_file, 'rb') as ack_stream:
+            file_content = ack_stream.read()
+
+        my_config.operation_method_is_move = False
+        my_config.operation_method_is_copy = True
+
+        # a folder in the way, the ack is copied and hashed but can't be published
+        blocking_folder = os.path.join(my_config.folder_localinbox, "first.tar.gz")
+        os.makedirs(os.path.join(blocking_folder, "in-the-way"))
+        assert (monitor.create_file(my_config, source_file, os.path.join(my_config.folder_localinbox, "first.tar.gz"),
+                                    file_content, "ACK1") is False)
+        assert (len(dedup.get_dedup_store(my_config)) == 0)
+
+        shutil.rmtree(blocking_folder)
+        assert (monitor.create_file(my_config, source_file, os.path.join(my_config.folder_localinbox, "first.tar.gz"),
+                                    file_content, "ACK1") is True)
+
+
+if __name__ == '__main__':
+    unittest.main()
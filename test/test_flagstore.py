@@ -0,0 +1,184 @@
+import unittest
+import sys
+import os
+import time
+import shutil
+import tempfile
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import flagstore
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import flagstore
+
+
+class FlagStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_hl7 = "../sample/HL7"
+        self.folder_acks = "../sample/ACKs"
+        self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+        self.temp_folder = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.temp_folder, "flags.db")
+
+        folder_list = [self.config.folder_localinbox, self.config.folder_remoteorphan,
+                       self.config.folder_ack1flag, self.config.folder_ack2flag,
+                       self.config.folder_ack3flag, self.config.folder_tobedeleted]
+        for one_folder in folder_list:
+            for one_file in monitor.get_file_list(one_folder):
+                os.remove(os.path.join(one_folder, one_file))
+
+    def tearDown(self):
+        flag_store = getattr(self.config, 'flag_store', None)
+        if flag_store:
+            flag_store.close()
+        shutil.rmtree(self.temp_folder)
+
+    def test_index_flags(self):
+        index_store = flagstore.index_flag_store(self.index_file)
+        try:
+            index_store.add(flagstore.ACK1_FLAG, "fda_1.tar.gz")
+            index_store.add(flagstore.ACK2_FLAG, "message_1", "fda_1.tar.gz")
+            index_store.commit()
+
+            assert ("fda_1.tar.gz" in index_store.names(flagstore.ACK1_FLAG))
+            assert ("message_1" in index_store.names(flagstore.ACK2_FLAG))
+            assert ("message_1" not in index_store.names(flagstore.ACK3_FLAG))
+            assert (index_store.get_parent(flagstore.ACK2_FLAG, "message_1") == "fda_1.tar.gz")
+
+            index_store.remove(flagstore.ACK1_FLAG, "fda_1.tar.gz")
+            index_store.commit()
+            assert ("fda_1.tar.gz" not in index_store.names(flagstore.ACK1_FLAG))
+            assert (len(index_store.names(flagstore.ACK1_FLAG)) == 0)
+            self.assertRaises(OSError, index_store.remove, flagstore.ACK1_FLAG, "fda_1.tar.gz")
+
+            # only rows removed long enough ago are deleted
+            assert (index_store.purge(3600) == 0)
+            assert (index_store.purge(3600, now=time.time() + 7200) == 1)
+            assert (index_store.purge(3600, now=time.time() + 7200) == 0)
+            assert ("message_1" in index_store.names(flagstore.ACK2_FLAG))
+        finally:
+            index_store.close()
+
+    def test_import_export(self):
+        self.config.flag_index_file = self.index_file
+        monitor.touch(os.path.join(self.config.folder_ack1flag, "fda_1.tar.gz"))
+        monitor.touch(os.path.join(self.config.folder_ack3flag, "core_1"))
+
+        index_store = flagstore.index_flag_store(self.index_file)
+        try:
+            assert (flagstore.import_flag_folders(self.config, index_store) == 2)
+            for one_folder in [self.config.folder_ack1flag, self.config.folder_ack3flag]:
+                for one_file in monitor.get_file_list(one_folder):
+                    os.remove(os.path.join(one_folder, one_file))
+
+            assert (flagstore.export_flag_folders(self.config, index_store) == 2)
+            assert (monitor.get_file_list(self.config.folder_ack1flag) == ["fda_1.tar.gz"])
+            assert (monitor.get_file_list(self.config.folder_ack3flag) == ["core_1"])
+        finally:
+            index_store.close()
+
+    def test_process_orphan_acks_with_index(self):
+        self.config.flag_index_file = self.index_file
+        flag_store = flagstore.get_flag_store(self.config)
+
+        ack_files = monitor.get_file_list(self.folder_acks)
+        for ack in ack_files:
+            shutil.copyfile(os.path.join(self.folder_acks, ack),
+                            os.path.join(self.config.folder_remoteorphan, ack))
+
+        for hl7 in monitor.get_file_list(self.folder_hl7):
+            if hl7 in ack_files:
+                flag_store.create_ack1_flag(hl7, os.path.join(self.folder_hl7, hl7))
+
+        for expected_count in [1, 2, 3]:
+            monitor.process_orphan_acks(self.config)
+            assert (len(monitor.get_file_list(self.config.folder_localinbox)) == expected_count)
+
+        for kind in flagstore.FLAG_KINDS:
+            assert (len(flag_store.names(kind)) == 0)
+            assert (len(monitor.get_file_list(flagstore.get_flag_folder(self.config, kind))) == 0)
+
+        core_id = r'fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gzCOREID'
+        message_id = flag_store.get_parent(flagstore.ACK3_FLAG, core_id)
+        assert (message_id == r'fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz')
+        assert (flag_store.get_parent(flagstore.ACK2_FLAG, message_id) == message_id)
+
+    def use_temp_flag_folders(self, shard_depth):
+        for kind in flagstore.FLAG_KINDS:
+            flag_folder = os.path.join(self.temp_folder, kind)
+            os.makedirs(flag_folder)
+            setattr(self.config, "folder_%sflag" % kind, flag_folder)
+        self.config.flag_shard_depth = shard_depth
+
+    def test_ack1_flag_is_independent(self):
+        self.use_temp_flag_folders(0)
+        hl7_file = os.path.join(self.temp_folder, "fda_1.tar.gz")
+        shutil.copyfile(os.path.join(self.folder_hl7, monitor.get_file_list(self.folder_hl7)[0]), hl7_file)
+        folder_store = flagstore.folder_flag_store(self.config)
+        flag_file = folder_store.create_ack1_flag("fda_1.tar.gz", hl7_file)
+        assert (os.path.getsize(flag_file) == 0)
+        assert (os.stat(flag_file).st_ino != os.stat(hl7_file).st_ino)
+        assert ("fda_1.tar.gz" in folder_store.names(flagstore.ACK1_FLAG))
+
+    def test_sharded_flags(self):
+        self.use_temp_flag_folders(2)
+        monitor.touch(os.path.join(self.config.folder_ack2flag, "message_flat"))
+        folder_store = flagstore.folder_flag_store(self.config, 2)
+
+        folder_store.add(flagstore.ACK2_FLAG, "message_1")
+        flag_file = folder_store.describe(flagstore.ACK2_FLAG, "message_1")
+        assert (os.path.exists(flag_file))
+        assert (os.path.dirname(os.path.dirname(os.path.dirname(flag_file))) == self.config.folder_ack2flag)
+
+        names = folder_store.names(flagstore.ACK2_FLAG)
+        assert ("message_1" in names)
+        assert ("message_flat" in names)
+        assert ("message_2" not in names)
+        assert (sorted(names) == ["message_1", "message_flat"])
+
+        assert (folder_store.migrate(1) == 1)
+        assert (monitor.get_file_list(self.config.folder_ack2flag) == [])
+        assert (folder_store.migrate(1) == 0)
+        assert ("message_flat" in names)
+        assert (len(names) == 2)
+
+        folder_store.remove(flagstore.ACK2_FLAG, "message_flat")
+        assert ("message_flat" not in names)
+        self.assertRaises(OSError, folder_store.remove, flagstore.ACK2_FLAG, "message_flat")
+        assert (len(names) == 1)
+
+        # counted without listing the subfolders again
+        monitor.touch(folder_store.prepare(flagstore.ACK2_FLAG, "message_other"))
+        folder_store.add(flagstore.ACK2_FLAG, "message_1")
+        folder_store.add(flagstore.ACK2_FLAG, "message_2")
+        assert (len(names) == 2)
+        assert (folder_store.count(flagstore.ACK2_FLAG, now=time.time() + flagstore.COUNT_MAX_AGE) == 3)
+
+    def test_process_orphan_acks_with_shards(self):
+        self.use_temp_flag_folders(1)
+        ack_files = monitor.get_file_list(self.folder_acks)
+        for ack in ack_files:
+            shutil.copyfile(os.path.join(self.folder_acks, ack),
+                            os.path.join(self.config.folder_remoteorphan, ack))
+
+        # an ack1 flag from before sharding, still flat
+        for hl7 in monitor.get_file_list(self.folder_hl7):
+            if hl7 in ack_files:
+                shutil.copyfile(os.path.join(self.folder_hl7, hl7), os.path.join(self.config.folder_ack1flag, hl7))
+
+        for expected_count in [1, 2, 3]:
+            monitor.process_orphan_acks(self.config)
+            assert (len(monitor.get_file_list(self.config.folder_localinbox)) == expected_count)
+
+        flag_store = flagstore.get_flag_store(self.config)
+        for kind in flagstore.FLAG_KINDS:
+            assert (len(flag_store.names(kind)) == 0)
+
+
+if __name__=="__main__":
+    unittest.main()
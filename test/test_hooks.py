@@ -0,0 +1,106 @@
+import unittest
+import sys
+import os
+import stat
+import shutil
+import tempfile
+import time
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import hooks
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import hooks
+
+
+class HooksTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+        self.temp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def create_files(self, count):
+        file_names = []
+        for index in range(count):
+            file_name = os.path.join(self.temp_folder, "fda_%d.tar.gz" % index)
+            with open(file_name, "w") as target:
+                target.write("content")
+            os.chmod(file_name, 0o600)
+            file_names.append(file_name)
+        return file_names
+
+    def test_build_command(self):
+        argv = hooks.build_command('"chmod 666 &target"', ["a b.tar.gz"])
+        assert (argv == ["chmod", "666", os.path.abspath("a b.tar.gz")])
+        argv = hooks.build_command("cp --target=&target x", ["a", "b"])
+        assert (argv == ["cp", "--target=" + os.path.abspath("a"), "--target=" + os.path.abspath("b"), "x"])
+        command = hooks.build_command('"chmod 666 &target"', ["a"], use_shell=True)
+        assert (command == 'chmod 666 "%s"' % os.path.abspath("a"))
+
+    def test_find_shell_syntax(self):
+        assert (hooks.find_shell_syntax('"chmod 666 &target"') is None)
+        assert (hooks.find_shell_syntax('"gzip -c &target > &target.gz"') == '>')
+        assert (hooks.find_shell_syntax('"chmod 666 &target && sync"') == '&&')
+
+    def test_default_runs_right_away(self):
+        assert (self.config.hook_worker_count == 0)
+        assert (self.config.hook_use_shell)
+        target_file = self.create_files(1)[0]
+        monitor.process_hl7_shell_commands(self.config, target_file)
+        assert (oct(os.stat(target_file)[stat.ST_MODE])[-3:] == '666')
+
+    def test_background_batch(self):
+        count_file = os.path.join(self.temp_folder, "count.txt")
+        executor = hooks.hook_executor(worker_count=2, batch_size=2)
+        commands = ["chmod 666 &target", "sh -c 'echo $# >> %s' hook &target" % count_file]
+        target_files = self.create_files(3)
+        for target_file in target_files:
+            executor.submit(commands, target_file)
+        executor.close()
+
+        for target_file in target_files:
+            assert (oct(os.stat(target_file)[stat.ST_MODE])[-3:] == '666')
+        with open(count_file) as counts:
+            assert (sorted(counts.read().split()) == ["1", "2"])
+
+        runs, failures, timeouts, total_seconds, max_seconds, last_return_code = executor.statistics()[commands[0]]
+        assert (runs == 2 and failures == 0 and timeouts == 0 and last_return_code == 0)
+
+    def test_timeout_and_failure(self):
+        executor = hooks.hook_executor(timeout=0.2)
+        start = time.time()
+        results = executor.run_commands(["sleep 5", "false", "no-such-command-for-hooks &target"], ["a"])
+        assert (time.time() - start < 4)
+        assert (results[0].timed_out)
+        assert (results[1].return_code == 1 and not results[1].timed_out)
+        assert (results[2].return_code is None)
+        statistics = executor.statistics()
+        assert (statistics["sleep 5"][2] == 1)
+        assert (statistics["false"][1] == 1)
+
+    def test_timeout_kills_the_whole_command(self):
+        if not hasattr(os, 'setsid'):
+            return
+        pid_file = os.path.join(self.temp_folder, "pid")
+        command = "sleep 30 & echo $! > %s; wait" % pid_file
+        result = hooks.run_command(command, [], timeout=0.5, use_shell=True)
+        assert (result.timed_out)
+
+        with open(pid_file) as pid_stream:
+            status_file = "/proc/%d/status" % int(pid_stream.read())
+        time.sleep(0.2)
+        # gone, or a zombie waiting for init
+        if os.path.exists(status_file):
+            with open(status_file) as status:
+                assert ("zombie" in status.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import unittest
+import sys
+import os
+import json
+import shutil
+import tempfile
+import threading
+import subprocess
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import flagstore
+    from uditransfer import journal
+    from uditransfer import ackparser
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import flagstore
+    from uditransfer import journal
+    from uditransfer import ackparser
+
+KILLED_EXIT_CODE = 9
+
+# process orphan acks in a child process which dies right after reaching one hand-off step
+CRASHING_CHILD = '''
+import os
+import sys
+sys.path.append("..")
+from uditransfer import monitor
+from uditransfer import configuration
+from uditransfer import journal
+
+def crash(step):
+    if step == sys.argv[1]:
+        os._exit(%d)
+
+journal.step_hook = crash
+monitor.process_orphan_acks(configuration.monitor_configuration("../sample/sample_config.ini"))
+''' % KILLED_EXIT_CODE
+
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_hl7 = "../sample/HL7"
+        self.folder_acks = "../sample/ACKs"
+        self.hl7_file = r'fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
+        self.ack_files = [self.hl7_file, "ACK2_" + self.hl7_file, "ACK3_" + self.hl7_file]
+        self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+        self.temp_folder = tempfile.mkdtemp()
+        self.clean_folders()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+        self.clean_folders()
+
+    def clean_folders(self):
+        for one_folder in [self.config.folder_localinbox, self.config.folder_localoutbox,
+                           self.config.folder_remoteoutbox, self.config.folder_remoteorphan,
+                           self.config.folder_ack1flag, self.config.folder_ack2flag,
+                           self.config.folder_ack3flag, self.config.folder_tobedeleted]:
+            for one_file in os.listdir(one_folder):
+                os.remove(os.path.join(one_folder, one_file))
+
+    def test_load_journal(self):
+        journal_file = os.path.join(self.temp_folder, "test.journal")
+        handoff_journal = journal.handoff_journal(journal_file)
+        first = handoff_journal.begin({'orphan': 'first'})
+        second = handoff_journal.begin({'orphan': 'second'})
+        handoff_journal.done(first)
+        handoff_journal.close()
+        with open(journal_file, 'a') as journal_stream:
+            journal_stream.write('{"op": "begin", "orph')
+
+        handoff_journal = journal.handoff_journal(journal_file)
+        open_records = handoff_journal.open_records()
+        assert ([record['orphan'] for record in open_records] == ['second'])
+        assert (handoff_journal.begin({'orphan': 'third'}) == second + 1)
+        assert (not handoff_journal.checkpoint())
+        # only the hand-offs still open are kept
+        with open(journal_file) as journal_stream:
+            assert ([json.loads(line)['orphan'] for line in journal_stream] == ['second', 'third'])
+        assert (not handoff_journal.checkpoint())
+
+        handoff_journal.done(second)
+        # done records are handed to the os right away
+        with open(journal_file) as journal_stream:
+            assert (len(journal_stream.readlines()) == 3)
+        assert (not handoff_journal.checkpoint())
+        assert ([record['orphan'] for record in journal.load_journal(journal_file)[0].values()] == ['third'])
+        assert (handoff_journal.begin({'orphan': 'fourth'}) == second + 2)
+        handoff_journal.done(second + 2)
+
+        handoff_journal.done(second + 1)
+        assert (handoff_journal.checkpoint())
+        handoff_journal.close()
+        assert (os.path.getsize(journal_file) == 0)
+
+    def test_group_commit(self):
+        handoff_journal = journal.handoff_journal(os.path.join(self.temp_folder, "test.journal"), 0.05)
+        sequences = []
+
+        def begin_one(index):
+            sequences.append(handoff_journal.begin({'orphan': str(index)}))
+
+        threads = [threading.Thread(target=begin_one, args=(index,)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert (sorted(sequences) == list(range(1, 9)))
+        assert (len(handoff_journal.open_records()) == 8)
+        assert (1 <= handoff_journal.syncs < 8)
+        handoff_journal.close()
+
+    def test_ack2_without_core_id(self):
+        self.prepare_ack(1)
+        ack_file = self.ack_files[1]
+        with open(os.path.join(self.config.folder_remoteorphan, ack_file), 'rb') as ack_stream:
+            file_content = ack_stream.read()
+        ack_info = ackparser.parse_ack_content(file_content)._replace(core_id=None)
+
+        for _ in range(2):
+            assert (not monitor.process_ack2_file(self.config, ack_file, file_content, ack_info))
+        # nothing transferred, no hand-off left open
+        assert (monitor.get_file_list(self.config.folder_localinbox) == [self.ack_files[0]])
+        assert (monitor.get_file_list(self.config.folder_remoteorphan) == [ack_file])
+        assert (journal.get_journal(self.config).open_records() == [])
+
+    def prepare_ack(self, ack_index):
+        ''' forward the HL7 message and process the acks before ack_index, leave that one in remote orphan
+        '''
+        shutil.copyfile(os.path.join(self.folder_hl7, self.hl7_file),
+                        os.path.join(self.config.folder_localoutbox, self.hl7_file))
+        monitor.process_hl7_message(self.config)
+        for ack_file in self.ack_files[:ack_index]:
+            shutil.copyfile(os.path.join(self.folder_acks, ack_file),
+                            os.path.join(self.config.folder_remoteorphan, ack_file))
+            monitor.process_orphan_acks(self.config)
+        ack_file = self.ack_files[ack_index]
+        shutil.copyfile(os.path.join(self.folder_acks, ack_file),
+                        os.path.join(self.config.folder_remoteorphan, ack_file))
+        journal.close_journal(self.config)
+
+    def assert_handed_over(self, my_config, ack_index):
+        flag_store = flagstore.get_flag_store(my_config)
+        flag_counts = [len(flag_store.names(kind)) for kind in flagstore.FLAG_KINDS]
+        assert (flag_counts == [[0, 1, 0], [0, 0, 1], [0, 0, 0]][ack_index])
+        assert (monitor.get_file_list(my_config.folder_remoteorphan) == [])
+        assert (sorted(monitor.get_file_list(my_config.folder_localinbox)) ==
+                sorted(self.ack_files[:ack_index + 1]))
+        assert (journal.get_journal(my_config).open_records() == [])
+
+    def test_crash_at_every_step(self):
+        for ack_index in range(len(self.ack_files)):
+            for step in journal.STEPS:
+                self.clean_folders()
+                self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+                self.prepare_ack(ack_index)
+
+                return_code = subprocess.call([sys.executable, "-c", CRASHING_CHILD, step])
+                assert (return_code == KILLED_EXIT_CODE), "%s not reached" % step
+
+                # a new process replays the journal on startup
+                restarted_config = configuration.monitor_configuration("../sample/sample_config.ini")
+                assert (len(journal.get_journal(restarted_config).open_records()) == 1)
+                assert (monitor.replay_handoffs(restarted_config) == 1)
+                monitor.process_orphan_acks(restarted_config)
+                self.assert_handed_over(restarted_config, ack_index)
+                journal.close_journal(restarted_config)
+
+
+if __name__ == '__main__':
+    unittest.main()
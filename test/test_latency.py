@@ -0,0 +1,80 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import latency
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import latency
+
+
+class LatencyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_hl7 = "../sample/HL7"
+        self.folder_acks = "../sample/ACKs"
+        self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+        self.temp_folder = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.temp_folder, "latency.log")
+        for one_folder in [self.config.folder_localinbox, self.config.folder_localoutbox,
+                           self.config.folder_remoteoutbox, self.config.folder_remoteorphan,
+                           self.config.folder_ack1flag, self.config.folder_ack2flag,
+                           self.config.folder_ack3flag, self.config.folder_tobedeleted]:
+            for one_file in monitor.get_file_list(one_folder):
+                os.remove(os.path.join(one_folder, one_file))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def test_load_latencies(self):
+        recorder = latency.latency_recorder(self.log_file)
+        recorder.record(latency.HL7_STAGE, "fda_1.tar.gz", timestamp=100)
+        recorder.record(latency.HL7_STAGE, "fda_2.tar.gz", timestamp=110)
+        recorder.record(latency.ACK1_STAGE, "fda_1.tar.gz", "message_1", timestamp=110)
+        recorder.record(latency.ACK1_STAGE, "fda_2.tar.gz", "message_2", timestamp=130)
+        recorder.record(latency.ACK2_STAGE, "message_1", "core_1", timestamp=200)
+        recorder.record(latency.ACK3_STAGE, "core_1", timestamp=400)
+        recorder.record(latency.ACK3_STAGE, "core_unknown", timestamp=400)
+        recorder.close()
+
+        report = latency.load_latencies(self.log_file)
+        assert (report.completed == 1)
+        assert (report.latencies[(latency.HL7_STAGE, latency.ACK1_STAGE)] == [10, 20])
+        assert (report.latencies[(latency.ACK2_STAGE, latency.ACK3_STAGE)] == [200])
+        assert (report.latencies[(latency.HL7_STAGE, latency.ACK3_STAGE)] == [300])
+        assert (list(report.open_submissions.keys()) == ["fda_2.tar.gz"])
+
+        summary = latency.summarize(report)
+        assert (summary["HL7->ACK1"] == {'count': 2, 'p50': 10, 'p90': 20, 'p99': 20, 'max': 20})
+        assert (latency.get_stuck_submissions(report, 60, now=200) == [("fda_2.tar.gz", latency.ACK1_STAGE, 70)])
+        assert (latency.get_stuck_submissions(report, 60, now=150) == [])
+
+    def test_monitor_records_stages(self):
+        self.config.latency_log_file = self.log_file
+        hl7_file = r'fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
+        shutil.copyfile(os.path.join(self.folder_hl7, hl7_file),
+                        os.path.join(self.config.folder_localoutbox, hl7_file))
+        monitor.process_hl7_message(self.config)
+
+        for ack in monitor.get_file_list(self.folder_acks):
+            shutil.copyfile(os.path.join(self.folder_acks, ack), os.path.join(self.config.folder_remoteorphan, ack))
+        for _ in range(3):
+            monitor.process_orphan_acks(self.config)
+        self.config.latency_recorder.close()
+
+        report = latency.load_latencies(self.log_file)
+        assert (report.completed == 1)
+        assert (report.open_submissions == {})
+        for interval in latency.INTERVALS:
+            assert (len(report.latencies[interval]) == 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
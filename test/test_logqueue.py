@@ -0,0 +1,105 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import datetime
+import logging
+
+try:
+    from uditransfer import util
+    from uditransfer import logqueue
+except:
+    sys.path.append("..")
+    from uditransfer import util
+    from uditransfer import logqueue
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class LogQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_folder = tempfile.mkdtemp()
+        self.logger = logging.getLogger("uditransfer-test-%s" % self.id())
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+        shutil.rmtree(self.temp_folder)
+
+    def read_log(self, file_name):
+        with open(os.path.join(self.temp_folder, file_name)) as log_file:
+            return log_file.read()
+
+    def test_dated_file_rolls_over(self):
+        handler = logqueue.dated_file_handler(self.temp_folder, "all", max_bytes=100)
+        self.logger.addHandler(handler)
+        today = datetime.date.today()
+        log_name = "all-%4d-%02d-%02d.log" % (today.year, today.month, today.day)
+
+        for index in range(4):
+            self.logger.info("line %d %s", index, "x" * 60)
+        assert (sorted(os.listdir(self.temp_folder)) == [log_name[:-4] + ".1.log", log_name[:-4] + ".2.log"])
+        assert ("line 0" in self.read_log(log_name[:-4] + ".1.log"))
+        assert ("line 3" in self.read_log(log_name[:-4] + ".2.log"))
+
+        handler.day = today - datetime.timedelta(days=1)
+        self.logger.info("next day")
+        assert ("next day" in self.read_log(log_name))
+
+    def test_queue_listener(self):
+        handler = logqueue.dated_file_handler(self.temp_folder, "all")
+        handler.setLevel(logging.INFO)
+        record_queue = queue.Queue()
+        listener = logqueue.queue_listener(record_queue, [handler])
+        listener.start()
+        self.logger.addHandler(logqueue.queue_handler(record_queue))
+
+        self.logger.debug("not written %s", "debug")
+        self.logger.info("written %s", "info")
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            self.logger.exception("failed %s", "here")
+        listener.stop()
+
+        today = datetime.date.today()
+        content = self.read_log("all-%4d-%02d-%02d.log" % (today.year, today.month, today.day))
+        assert ("written info" in content)
+        assert ("not written" not in content)
+        assert ("failed here" in content and "ValueError: boom" in content)
+
+    def test_log_payload(self):
+        records = []
+
+        class collect_handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+
+        root_logger = logging.getLogger()
+        handler = collect_handler()
+        root_level = root_logger.level
+        root_logger.addHandler(handler)
+        root_logger.setLevel(logging.DEBUG)
+        try:
+            util.log_payload("a" * 100, 10)
+            util.log_payload("short", 10)
+            util.log_payload("not logged", 0)
+            root_logger.setLevel(logging.INFO)
+            util.log_payload("not logged either", -1)
+        finally:
+            root_logger.removeHandler(handler)
+            root_logger.setLevel(root_level)
+
+        assert (records == ["a" * 10 + "... (10 of 100 bytes)", "short"])
+
+
+if __name__ == '__main__':
+    unittest.main()
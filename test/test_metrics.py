@@ -0,0 +1,87 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import metrics
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_hl7 = "../sample/HL7"
+        self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+        self.temp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def test_disabled_by_default(self):
+        registry = metrics.get_metrics(self.config)
+        assert (not registry.enabled)
+        with registry.time(metrics.STAGE_SECONDS, {'stage': 'list'}):
+            registry.inc(metrics.FILES_TOTAL, {'type': 'HL7'})
+        registry.export()
+
+    def test_render(self):
+        registry = metrics.metrics_registry()
+        registry.inc(metrics.FILES_TOTAL, {'type': 'ACK1'})
+        registry.inc(metrics.FILES_TOTAL, {'type': 'ACK1'})
+        registry.set_gauge(metrics.BACKLOG_FILES, 7, {'folder': 'remoteorphan'})
+        registry.observe(metrics.CYCLE_SECONDS, 0.02)
+        registry.observe(metrics.CYCLE_SECONDS, 2)
+
+        lines = registry.render().splitlines()
+        assert ("# TYPE uditransfer_files_total counter" in lines)
+        assert ('uditransfer_files_total{type="ACK1"} 2.0' in lines)
+        assert ('uditransfer_backlog_files{folder="remoteorphan"} 7.0' in lines)
+        assert ('uditransfer_cycle_seconds_bucket{le="0.05"} 1' in lines)
+        assert ('uditransfer_cycle_seconds_bucket{le="5.0"} 2' in lines)
+        assert ('uditransfer_cycle_seconds_bucket{le="+Inf"} 2' in lines)
+        assert ('uditransfer_cycle_seconds_count 2' in lines)
+
+    def test_textfile_and_http(self):
+        hl7_file = r'fda_15ff7927-91f6-4fd8-80cb-bbddc6fa0cd1.tar.gz'
+        for one_folder in [self.config.folder_localoutbox, self.config.folder_remoteoutbox,
+                           self.config.folder_ack1flag]:
+            for one_file in monitor.get_file_list(one_folder):
+                os.remove(os.path.join(one_folder, one_file))
+        shutil.copyfile(os.path.join(self.folder_hl7, hl7_file),
+                        os.path.join(self.config.folder_localoutbox, hl7_file))
+
+        self.config.metrics_textfile = os.path.join(self.temp_folder, "uditransfer.prom")
+        registry = metrics.get_metrics(self.config)
+        port = registry.serve("127.0.0.1", 0)
+        try:
+            monitor.process_folders(self.config)
+
+            with open(self.config.metrics_textfile) as textfile:
+                content = textfile.read()
+            assert ('uditransfer_files_total{type="HL7"} 1.0' in content)
+            assert ('uditransfer_backlog_files{folder="localoutbox"} 1.0' in content)
+            assert ('uditransfer_stage_seconds_count{stage="validate"} 1' in content)
+            assert ('uditransfer_stage_seconds_count{stage="hook"} 1' in content)
+            assert ('uditransfer_cycle_seconds_count 1' in content)
+
+            response = urlopen("http://127.0.0.1:%d/metrics" % port)
+            assert (response.read().decode('utf-8') == content)
+        finally:
+            registry.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
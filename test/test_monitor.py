@@ -5,16 +5,24 @@ import shutil
 import logging
 import stat
 import codecs
+import tarfile
+import tempfile
 
 try:
     from uditransfer import monitor
     from uditransfer import configuration
     from uditransfer import util
+    from uditransfer import workers
+    from uditransfer import filecache
+    from uditransfer import ackparser
 except:
     sys.path.append("..")
     from uditransfer import monitor
     from uditransfer import configuration
     from uditransfer import util
+    from uditransfer import workers
+    from uditransfer import filecache
+    from uditransfer import ackparser
 
 class MonitorTestCase(unittest.TestCase):
 
@@ -95,6 +103,37 @@ class MonitorTestCase(unittest.TestCase):
         core_id = monitor.get_coreid_from_ack3_content(ack2_content)
         assert(not core_id)
 
+    def test_parse_ack_content(self):
+        ack_files = [os.path.join(self.folder_acks, f) for f in monitor.get_file_list(self.folder_acks)]
+        ack_files += [os.path.join(self.folder_ghxack, "temp", f)
+                      for f in monitor.get_file_list(os.path.join(self.folder_ghxack, "temp"))]
+        ack_files += [os.path.join(self.folder_hl7, f) for f in monitor.get_file_list(self.folder_hl7)]
+
+        found_types = set()
+        for ack_file in ack_files:
+            file_content = self.read_file_content(ack_file)
+            ack_info = ackparser.parse_ack_content(file_content)
+            found_types.add(ack_info.ack_type)
+
+            assert (ack_info.ack1_message_id == monitor.get_messageid_from_ack1_content(file_content))
+            message_id = monitor.get_messageid_from_ack2_content(file_content)
+            if message_id:
+                assert (ack_info.ack_type == 'ACK2')
+                assert (ack_info.message_id == message_id)
+                assert (ack_info.core_id == monitor.get_coreid_from_ack2_content(file_content))
+            elif monitor.get_coreid_from_ack3_content(file_content):
+                assert (ack_info.ack_type == 'ACK3')
+                assert (ack_info.core_id == monitor.get_coreid_from_ack3_content(file_content))
+            else:
+                assert (ack_info.ack_type == '')
+
+            for flags in [(set(), set(), set()),
+                          (set([os.path.basename(ack_file)]), set([message_id]), set([ack_info.core_id]))]:
+                assert (monitor.detect_ack_file(self.config, ack_file, file_content, *flags) ==
+                        monitor.detect_ack_file(self.config, ack_file, file_content, *flags, ack_info=ack_info))
+
+        assert (found_types == set(['', 'ACK2', 'ACK3']))
+
     def test_is_valid_hl7_message(self):
         hl7_1_file = r'../sample/HL7/fda_15ff7927-91f6-4fd8-80cb-bbddc6fa0cd1.tar.gz'
         hl7_2_file = r'../sample/HL7/fda_a383c97e-5749-4c0c-aff9-1f3883a34191.tar.gz'
@@ -111,6 +150,38 @@ class MonitorTestCase(unittest.TestCase):
         assert (not monitor.is_valid_hl7_message(ack3_file))
 
 
+    def test_is_valid_hl7_message_limits(self):
+        temp_folder = tempfile.mkdtemp()
+        try:
+            member_file = os.path.join(temp_folder, "member.txt")
+            with open(member_file, "w") as target:
+                target.write("x" * 4096)
+
+            hl7_file = os.path.join(temp_folder, "fda_late_submission.tar.gz")
+            tar = tarfile.open(hl7_file, "w:gz")
+            for index in range(5):
+                tar.add(member_file, "fda_late_submission/attachment_%d.txt" % index)
+            tar.add(member_file, "fda_late_submission/SPL/Submission.xml")
+            tar.close()
+
+            assert (monitor.is_valid_hl7_message(hl7_file))
+            assert (not monitor.is_valid_hl7_message(hl7_file, max_members=3))
+            assert (not monitor.is_valid_hl7_message(hl7_file, max_bytes=8192))
+            assert (monitor.is_valid_hl7_message(hl7_file, max_members=10, max_bytes=1024 * 1024))
+
+            cache = filecache.verdict_cache(2)
+            assert (monitor.is_valid_hl7_message(hl7_file, verdict_cache=cache))
+            assert (cache.get(filecache.get_file_identity(hl7_file)) is True)
+            # a cached verdict is returned without opening the package again
+            assert (monitor.is_valid_hl7_message(hl7_file, max_members=1, verdict_cache=cache))
+
+            ack1_file = r'../sample/ACKs/fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
+            assert (not monitor.is_valid_hl7_message(ack1_file, verdict_cache=cache))
+            assert (cache.get(filecache.get_file_identity(ack1_file)) is False)
+            assert (len(cache) == 2)
+        finally:
+            shutil.rmtree(temp_folder)
+
     def test_process_orphan_acks(self):
         ack1_file = r'fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
         ack2_file = r'ACK2_fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
@@ -260,6 +331,143 @@ class MonitorTestCase(unittest.TestCase):
         files_in_remoteoutbox = monitor.get_file_list(self.config.folder_remoteoutbox)
         assert(len(files_in_remoteoutbox) == total_files)
 
+    def test_copy_method_renames_on_one_file_system(self):
+        self.config.hl7_operation_method_is_copy = True
+        self.config.hl7_operation_method_is_move = False
+        hl7_file = r'fda_15ff7927-91f6-4fd8-80cb-bbddc6fa0cd1.tar.gz'
+        wrong_file = r'ACK2_fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
+        shutil.copyfile(os.path.join(self.folder_hl7, hl7_file),
+                        os.path.join(self.config.folder_localoutbox, hl7_file))
+        shutil.copyfile(os.path.join(self.folder_acks, wrong_file),
+                        os.path.join(self.config.folder_localoutbox, wrong_file))
+        inodes = dict((file_name, os.stat(os.path.join(self.config.folder_localoutbox, file_name)).st_ino)
+                      for file_name in [hl7_file, wrong_file])
+
+        monitor.process_hl7_message(self.config)
+        assert (monitor.get_file_list(self.config.folder_localoutbox) == [])
+        assert (os.stat(os.path.join(self.config.folder_remoteoutbox, hl7_file)).st_ino == inodes[hl7_file])
+        assert (os.stat(os.path.join(self.config.folder_hl7flag, wrong_file)).st_ino == inodes[wrong_file])
+
+    def test_process_hl7_message_with_workers(self):
+        self.config.hl7_worker_count = 3
+        self.config.hl7_max_inflight_transfers = 2
+
+        hl7_files = monitor.get_file_list(self.folder_hl7)
+        wrong_file = r'ACK2_fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
+        for hl7_file in hl7_files:
+            shutil.copyfile(os.path.join(self.folder_hl7, hl7_file),
+                            os.path.join(self.config.folder_localoutbox, hl7_file))
+        shutil.copyfile(os.path.join(self.folder_acks, wrong_file),
+                        os.path.join(self.config.folder_localoutbox, wrong_file))
+
+        monitor.process_hl7_message(self.config)
+
+        assert (len(monitor.get_file_list(self.config.folder_localoutbox)) == 0)
+        assert (sorted(monitor.get_file_list(self.config.folder_remoteoutbox)) == sorted(hl7_files))
+        assert (sorted(monitor.get_file_list(self.config.folder_ack1flag)) == sorted(hl7_files))
+        assert (os.path.exists(os.path.join(self.config.folder_hl7flag, wrong_file)))
+
+    def test_process_orphan_acks_with_workers(self):
+        self.config.ack_worker_count = 3
+
+        ack_files = monitor.get_file_list(self.folder_acks)
+        for ack in ack_files:
+            shutil.copyfile(os.path.join(self.folder_acks, ack),
+                            os.path.join(self.config.folder_remoteorphan, ack))
+
+        for hl7 in monitor.get_file_list(self.folder_hl7):
+            if hl7 in ack_files:
+                shutil.copyfile(os.path.join(self.folder_hl7, hl7),
+                                os.path.join(self.config.folder_ack1flag, hl7))
+
+        # one more hand-off per pass: ACK1, then ACK2 with the new ack2 flag, then ACK3
+        for expected_count in [1, 2, 3]:
+            monitor.process_orphan_acks(self.config)
+            local_inbox_files = monitor.get_file_list(self.config.folder_localinbox)
+            assert (len(local_inbox_files) == expected_count)
+
+        assert (sorted(local_inbox_files) == sorted(ack_files))
+        assert (len(monitor.get_file_list(self.config.folder_remoteorphan)) == 0)
+        assert (len(monitor.get_file_list(self.config.folder_ack2flag)) == 0)
+        assert (len(monitor.get_file_list(self.config.folder_ack3flag)) == 0)
+
+    def test_negative_orphan_cache(self):
+        ack2_file = r'ACK2_fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
+        message_id = r'fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
+        temp_folder = tempfile.mkdtemp()
+        self.config.orphan_negative_cache_file = os.path.join(temp_folder, "orphans.json")
+        shutil.copyfile(os.path.join(self.folder_acks, ack2_file),
+                        os.path.join(self.config.folder_remoteorphan, ack2_file))
+
+        read_files = []
+        read_content_from_orphan = monitor.read_content_from_orphan
+
+        def counting_read(my_config, orphan):
+            read_files.append(orphan)
+            return read_content_from_orphan(my_config, orphan)
+
+        monitor.read_content_from_orphan = counting_read
+        try:
+            monitor.process_orphan_acks(self.config)
+            assert (read_files == [ack2_file])
+            assert (os.path.exists(self.config.orphan_negative_cache_file))
+
+            # an unchanged orphan known not for CCM is not opened again, even by a new process
+            del self.config.negative_orphan_cache
+            monitor.process_orphan_acks(self.config)
+            assert (read_files == [ack2_file])
+
+            # an orphan held back as not stable yet keeps its entry
+            self.config.file_stability_quiet_period = 0
+            monitor.process_orphan_acks(self.config)
+            assert (len(self.config.negative_orphan_cache) == 1)
+            self.config.file_stability_quiet_period = -1
+
+            # its ack2 flag shows up, so it could match now
+            monitor.touch(os.path.join(self.config.folder_ack2flag, message_id))
+            monitor.process_orphan_acks(self.config)
+            assert (read_files == [ack2_file, ack2_file])
+            assert (monitor.get_file_list(self.config.folder_localinbox) == [ack2_file])
+
+            monitor.process_orphan_acks(self.config)
+            assert (len(self.config.negative_orphan_cache) == 0)
+        finally:
+            monitor.read_content_from_orphan = read_content_from_orphan
+            shutil.rmtree(temp_folder)
+
+    def test_write_large_ack3_with_bounded_read(self):
+        self.config.operation_method_is_move = False
+        self.config.operation_method_is_write = True
+        self.config.recheck_content = True
+        self.config.ack_read_max_bytes = 4096
+
+        ack3_file = r'ACK3_fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
+        core_id = r'fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gzCOREID'
+        content = self.read_file_content(os.path.join(self.folder_acks, ack3_file))
+        content = content.replace("</submission>", "  <report />\n" * 100000 + "</submission>")
+        orphan_file = os.path.join(self.config.folder_remoteorphan, ack3_file)
+        with open(orphan_file, "w") as target:
+            target.write(content)
+        monitor.touch(os.path.join(self.config.folder_ack3flag, core_id))
+
+        file_content = monitor.read_content_from_orphan(self.config, ack3_file)
+        assert (len(file_content) == 4096)
+        assert (not monitor.is_whole_content(self.config, file_content))
+
+        monitor.process_orphan_acks(self.config)
+
+        assert (not os.path.exists(orphan_file))
+        assert (self.read_file_content(os.path.join(self.config.folder_localinbox, ack3_file)) == content)
+        assert (len(monitor.get_file_list(self.config.folder_ack3flag)) == 0)
+
+    def test_group_items(self):
+        items = [('a', ['m1']), ('b', ['m2']), ('c', ['m1', 'c1']), ('d', ['c1']), ('e', [])]
+        groups = workers.group_items(items, lambda item: item[1])
+        assert ([[item[0] for item in group] for group in groups] == [['a', 'c', 'd'], ['b'], ['e']])
+
+        results = workers.run_tasks(lambda item: item * 2, [1, 2, 3, 4], 3)
+        assert (results == [2, 4, 6, 8])
+
     def read_file_content(self, file_name):
         with open(file_name, 'r') as content_file:
             return content_file.read()
@@ -0,0 +1,111 @@
+import unittest
+import sys
+import os
+import time
+import signal
+import shutil
+import tempfile
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import profiler
+    from uditransfer import workers
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import profiler
+    from uditransfer import workers
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+        self.temp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def get_files(self, extension):
+        return sorted(f for f in os.listdir(self.temp_folder) if f.endswith(extension))
+
+    def test_disabled_by_default(self):
+        cycle_profiler = profiler.get_profiler(self.config)
+        assert (not cycle_profiler.enabled)
+        assert (cycle_profiler.output_dir == self.config.folder_logs)
+        with cycle_profiler.cycle():
+            pass
+        assert (cycle_profiler.profiled == 0)
+
+    def test_every_nth_cycle(self):
+        self.config.cycle_profiler = profiler.cycle_profiler(self.temp_folder, every=2)
+        for _ in range(3):
+            monitor.process_folders(self.config)
+
+        assert (self.config.cycle_profiler.profiled == 2)
+        assert (len(self.get_files(".pstats")) == 2)
+        reports = self.get_files(".txt")
+        assert (len(reports) == 2)
+        with open(os.path.join(self.temp_folder, reports[0])) as report:
+            assert ("process_orphan_acks" in report.read())
+
+    def test_worker_threads(self):
+        def busy_task(item):
+            return sum(range(item))
+
+        cycle_profiler = profiler.cycle_profiler(self.temp_folder)
+        with cycle_profiler.cycle("test"):
+            workers.run_tasks(busy_task, [1000] * 4, 2)
+        assert (profiler.get_active_profile() is None)
+
+        reports = self.get_files(".txt")
+        with open(os.path.join(self.temp_folder, reports[0])) as report:
+            report_text = report.read()
+        assert ("2 worker thread(s)" in report_text)
+        assert ("busy_task" in report_text)
+
+        # unprofiled passes don't profile their workers
+        workers.run_tasks(busy_task, [1000] * 4, 2)
+        assert (len(self.get_files(".pstats")) == 1)
+
+    def test_signal_toggles_profiling(self):
+        if profiler.TOGGLE_SIGNAL is None:
+            return
+        previous_handler = signal.getsignal(profiler.TOGGLE_SIGNAL)
+        cycle_profiler = profiler.cycle_profiler(self.temp_folder, every=5, enabled=False)
+        try:
+            assert (cycle_profiler.install_signal_handler())
+            os.kill(os.getpid(), profiler.TOGGLE_SIGNAL)
+            time.sleep(0.1)
+            assert (cycle_profiler.enabled)
+            with cycle_profiler.cycle("test"):
+                sum(range(1000))
+            assert (len(self.get_files(".pstats")) == 1)
+
+            os.kill(os.getpid(), profiler.TOGGLE_SIGNAL)
+            time.sleep(0.1)
+            assert (not cycle_profiler.enabled)
+        finally:
+            signal.signal(profiler.TOGGLE_SIGNAL, previous_handler)
+
+    def test_memory_snapshots(self):
+        if not profiler.tracemalloc_available():
+            return
+        cycle_profiler = profiler.cycle_profiler(self.temp_folder, memory_frames=5)
+        try:
+            for _ in range(2):
+                with cycle_profiler.cycle("test"):
+                    [str(i) for i in range(1000)]
+        finally:
+            profiler.tracemalloc.stop()
+
+        snapshots = self.get_files(".tracemalloc")
+        assert (len(snapshots) == 2)
+        with open(os.path.join(self.temp_folder, snapshots[1].replace(".tracemalloc", ".txt"))) as report:
+            assert ("growth since previous snapshot" in report.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+import sys
+import os
+import time
+import shutil
+import tempfile
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import retry
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import retry
+
+
+class RetryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_hl7 = "../sample/HL7"
+        self.folder_acks = "../sample/ACKs"
+        self.hl7_file = r'fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
+        self.temp_folder = tempfile.mkdtemp()
+        self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+        self.config.retry_base_delay = 0.2
+        self.config.retry_jitter = 0
+        self.config.retry_max_attempts = 2
+        self.config.retry_queue_file = os.path.join(self.temp_folder, "retry-queue.json")
+        self.config.folder_quarantine = os.path.join(self.temp_folder, "quarantine")
+        self.clean_folders()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+        self.clean_folders()
+
+    def clean_folders(self):
+        for one_folder in [self.config.folder_localinbox, self.config.folder_localoutbox,
+                           self.config.folder_remoteoutbox, self.config.folder_remoteorphan,
+                           self.config.folder_ack1flag, self.config.folder_ack2flag,
+                           self.config.folder_ack3flag]:
+            for one_file in os.listdir(one_folder):
+                one_file = os.path.join(one_folder, one_file)
+                if os.path.isdir(one_file):
+                    shutil.rmtree(one_file)
+                else:
+                    os.remove(one_file)
+
+    def test_backoff(self):
+        queue = retry.retry_queue(None, 1, 10, jitter=0)
+        assert ([queue.get_delay(attempts) for attempts in range(1, 7)] == [1, 2, 4, 8, 10, 10])
+
+        queue = retry.retry_queue(None, 8, 100, jitter=0.5)
+        delays = [queue.get_delay(1) for _ in range(100)]
+        assert (4 <= min(delays) and max(delays) <= 8)
+        assert (len(set(delays)) > 1)
+
+    def test_select_and_persistence(self):
+        queue_file = os.path.join(self.temp_folder, "queue.json")
+        queue = retry.retry_queue(queue_file, 10, 100, max_attempts=3, jitter=0, max_per_pass=1)
+        now = time.time()
+        assert (not queue.failed(retry.HL7_RETRIES, "a", now=now))
+        assert (not queue.failed(retry.HL7_RETRIES, "b", now=now + 1))
+        assert (not queue.failed(retry.HL7_RETRIES, "c", now=now + 2))
+
+        names = ["a", "b", "c", "d", "e"]
+        assert (queue.select(retry.HL7_RETRIES, names, now) == ["d", "e"])
+        # healthy files first, then the retry waiting longest
+        assert (queue.select(retry.HL7_RETRIES, names, now + 60) == ["d", "e", "a"])
+        assert (queue.select(retry.ORPHAN_RETRIES, names, now) == names)
+
+        queue.forget(retry.HL7_RETRIES, "c")
+        queue.save()
+        queue = retry.retry_queue(queue_file, 10, 100, max_attempts=3, jitter=0)
+        assert (len(queue) == 2)
+        assert (not queue.failed(retry.HL7_RETRIES, "a", now=now))
+        assert (queue.failed(retry.HL7_RETRIES, "a", now=now))
+        queue.evict_missing(retry.HL7_RETRIES, ["b"])
+        assert (queue.attempts(retry.HL7_RETRIES, "a") == 0)
+        assert (queue.attempts(retry.HL7_RETRIES, "b") == 1)
+
+    def test_quarantine_hl7(self):
+        shutil.copyfile(os.path.join(self.folder_hl7, self.hl7_file),
+                        os.path.join(self.config.folder_localoutbox, self.hl7_file))
+        # a folder in the way makes every transfer fail
+        os.mkdir(os.path.join(self.config.folder_remoteoutbox, self.hl7_file))
+
+        assert (monitor.process_hl7_message(self.config) == 0)
+        queue = retry.get_retry_queue(self.config)
+        assert (queue.attempts(retry.HL7_RETRIES, self.hl7_file) == 1)
+        assert (os.path.exists(self.config.retry_queue_file))
+
+        # backing off, not tried again
+        monitor.process_hl7_message(self.config)
+        assert (queue.attempts(retry.HL7_RETRIES, self.hl7_file) == 1)
+
+        time.sleep(self.config.retry_base_delay)
+        monitor.process_hl7_message(self.config)
+        assert (queue.attempts(retry.HL7_RETRIES, self.hl7_file) == 0)
+        assert (monitor.get_file_list(self.config.folder_localoutbox) == [])
+        assert (os.path.exists(os.path.join(self.config.folder_quarantine, retry.HL7_RETRIES, self.hl7_file)))
+
+    def test_retry_ack_until_it_succeeds(self):
+        shutil.copyfile(os.path.join(self.folder_hl7, self.hl7_file),
+                        os.path.join(self.config.folder_localoutbox, self.hl7_file))
+        assert (monitor.process_hl7_message(self.config) == 1)
+
+        shutil.copyfile(os.path.join(self.folder_acks, self.hl7_file),
+                        os.path.join(self.config.folder_remoteorphan, self.hl7_file))
+        blocker = os.path.join(self.config.folder_localinbox, self.hl7_file)
+        os.mkdir(blocker)
+        monitor.process_orphan_acks(self.config)
+        queue = retry.get_retry_queue(self.config)
+        assert (queue.attempts(retry.ORPHAN_RETRIES, self.hl7_file) == 1)
+
+        os.rmdir(blocker)
+        assert (monitor.process_orphan_acks(self.config) == 0)
+        time.sleep(self.config.retry_base_delay)
+        assert (monitor.process_orphan_acks(self.config) == 1)
+        assert (queue.attempts(retry.ORPHAN_RETRIES, self.hl7_file) == 0)
+        assert (monitor.get_file_list(self.config.folder_localinbox) == [self.hl7_file])
+
+
+if __name__ == '__main__':
+    unittest.main()
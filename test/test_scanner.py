@@ -0,0 +1,144 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import scanner
+    from uditransfer import stages
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import scanner
+    from uditransfer import stages
+
+
+class ScannerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_hl7 = "../sample/HL7"
+        self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+        self.temp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def write_file(self, file_name, content):
+        full_name = os.path.join(self.temp_folder, file_name)
+        with open(full_name, "w") as target:
+            target.write(content)
+        return full_name
+
+    def test_get_file_list(self):
+        self.write_file("a.tar.gz", "content")
+        self.write_file(".a.tar.gz.1.tmp", "content")
+        os.mkdir(os.path.join(self.temp_folder, "folder"))
+        assert (monitor.get_file_list(self.temp_folder) == ["a.tar.gz"])
+        listed = [entry.name for entry in scanner.listdir_scandir(self.temp_folder) if entry.is_file()]
+        assert (sorted(listed) == [".a.tar.gz.1.tmp", "a.tar.gz"])
+
+    def test_snapshot_changes(self):
+        snapshot = scanner.folder_snapshot(self.temp_folder, detect_changes=True)
+        self.write_file("a.tar.gz", "content")
+        self.write_file("b.tar.gz", "content")
+        assert (snapshot.scan() == (["a.tar.gz", "b.tar.gz"], [], []))
+        assert (snapshot.scan() == ([], [], []))
+
+        os.remove(os.path.join(self.temp_folder, "a.tar.gz"))
+        self.write_file("b.tar.gz", "more content")
+        self.write_file("c.tar.gz", "content")
+        assert (snapshot.scan() == (["c.tar.gz"], ["a.tar.gz"], ["b.tar.gz"]))
+        assert (snapshot.names() == ["b.tar.gz", "c.tar.gz"])
+
+    def test_snapshot_without_stat(self):
+        snapshot = scanner.folder_snapshot(self.temp_folder)
+        self.write_file("flag_1", "")
+        snapshot.scan()
+        # same inode, only a rename shows up without detect_changes
+        self.write_file("flag_1", "content")
+        assert (snapshot.scan() == ([], [], []))
+        temp_file = self.write_file(".flag_1.tmp", "")
+        os.rename(temp_file, os.path.join(self.temp_folder, "flag_1"))
+        assert (snapshot.scan().changed == ["flag_1"])
+
+    def test_scanner_timings(self):
+        observed = []
+        folder_scanner = scanner.folder_scanner(lambda folder, seconds, count: observed.append((folder, count)))
+        folder_scanner.add_folder(self.temp_folder)
+        self.write_file("a.tar.gz", "content")
+        folder_scanner.scan_all()
+        folder_scanner.scan_all()
+        assert (observed == [(self.temp_folder, 1)] * 2)
+        scans, total_seconds, last_seconds, last_entries = folder_scanner.timings()[self.temp_folder]
+        assert (scans == 2)
+        assert (total_seconds >= last_seconds >= 0)
+        assert (last_entries == 1)
+
+    def test_scan_events(self):
+        for one_folder in [self.config.folder_localoutbox, self.config.folder_remoteorphan,
+                           self.config.folder_ack1flag, self.config.folder_ack2flag, self.config.folder_ack3flag]:
+            for one_file in monitor.get_file_list(one_folder):
+                os.remove(os.path.join(one_folder, one_file))
+
+        folder_scanner = monitor.create_folder_scanner(self.config)
+        assert (monitor.get_scan_events(folder_scanner) == [])
+
+        hl7_file = r'fda_15ff7927-91f6-4fd8-80cb-bbddc6fa0cd1.tar.gz'
+        shutil.copyfile(os.path.join(self.folder_hl7, hl7_file),
+                        os.path.join(self.config.folder_localoutbox, hl7_file))
+        monitor.touch(os.path.join(self.config.folder_ack2flag, "message_1"))
+        events = monitor.get_scan_events(folder_scanner)
+        assert ((self.config.folder_localoutbox, hl7_file, 0) in events)
+        assert ((self.config.folder_ack2flag, "message_1", 0) in events)
+        assert (len(events) == 2)
+
+        os.remove(os.path.join(self.config.folder_localoutbox, hl7_file))
+        os.remove(os.path.join(self.config.folder_ack2flag, "message_1"))
+        assert (monitor.get_scan_events(folder_scanner) == [])
+
+    def test_periodical_passes_skip_unchanged_stages(self):
+        for one_folder in [self.config.folder_localoutbox, self.config.folder_remoteorphan,
+                           self.config.folder_localinbox, self.config.folder_ack1flag, self.config.folder_ack2flag,
+                           self.config.folder_ack3flag]:
+            for one_file in monitor.get_file_list(one_folder):
+                os.remove(os.path.join(one_folder, one_file))
+        ack2_file = r'ACK2_fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
+        shutil.copyfile(os.path.join("../sample/ACKs", ack2_file),
+                        os.path.join(self.config.folder_remoteorphan, ack2_file))
+
+        # the first pass always runs, the one after it because the first found work
+        assert (monitor.process_folders(self.config, skip_unchanged=True) == 0)
+        assert (monitor.process_folders(self.config, skip_unchanged=True) == 0)
+        assert ([monitor.get_stage_watch(self.config, stage).skipped for stage in stages.STAGES] == [1, 1])
+
+        # an HL7 message only wakes up the HL7 stage, its ack1 flag the ACK stage
+        hl7_file = r'fda_15ff7927-91f6-4fd8-80cb-bbddc6fa0cd1.tar.gz'
+        shutil.copyfile(os.path.join(self.folder_hl7, hl7_file),
+                        os.path.join(self.config.folder_localoutbox, hl7_file))
+        self.config.stage_order = 'hl7'
+        assert (monitor.process_folders(self.config, skip_unchanged=True) == 1)
+        assert (monitor.get_stage_watch(self.config, stages.ACK_STAGE).skipped == 1)
+
+        # the waiting orphan matches once its ack2 flag shows up
+        monitor.process_folders(self.config, skip_unchanged=True)
+        monitor.process_folders(self.config, skip_unchanged=True)
+        assert (monitor.get_stage_watch(self.config, stages.ACK_STAGE).skipped == 3)
+        monitor.touch(os.path.join(self.config.folder_ack2flag, "fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz"))
+        assert (monitor.process_folders(self.config, skip_unchanged=True) == 1)
+        assert (monitor.get_file_list(self.config.folder_localinbox) == [ack2_file])
+
+        for one_file in monitor.get_file_list(self.config.folder_ack1flag):
+            os.remove(os.path.join(self.config.folder_ack1flag, one_file))
+        os.remove(os.path.join(self.config.folder_remoteoutbox, hl7_file))
+        os.remove(os.path.join(self.config.folder_localinbox, ack2_file))
+        for one_file in monitor.get_file_list(self.config.folder_ack3flag):
+            os.remove(os.path.join(self.config.folder_ack3flag, one_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import sys
+import os
+import time
+import signal
+import shutil
+import tempfile
+import threading
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import scheduler
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import scheduler
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_hl7 = "../sample/HL7"
+        self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+        self.temp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def test_fixed_sleeptime_by_default(self):
+        schedule = scheduler.get_scheduler(self.config)
+        assert (schedule.next_interval(0) == self.config.sleeptime)
+        assert (schedule.next_interval(0) == self.config.sleeptime)
+        assert (schedule.next_interval(3) == self.config.sleeptime)
+
+    def test_backoff_and_burst(self):
+        schedule = scheduler.adaptive_scheduler(1, 10, 2)
+        assert ([schedule.next_interval(0) for _ in range(5)] == [2, 4, 8, 10, 10])
+        assert (schedule.next_interval(1) == 1)
+        assert (schedule.next_interval(0) == 2)
+
+    def test_wake_up(self):
+        schedule = scheduler.adaptive_scheduler(1, 10)
+        start = time.time()
+        assert (not schedule.wait(0.05))
+        assert (time.time() - start >= 0.05)
+
+        threading.Timer(0.05, schedule.wake).start()
+        start = time.time()
+        assert (schedule.wait(5))
+        assert (time.time() - start < 1)
+
+        if scheduler.WAKEUP_SIGNAL is not None:
+            previous_handler = signal.getsignal(scheduler.WAKEUP_SIGNAL)
+            try:
+                assert (schedule.install_signal_handler())
+                os.kill(os.getpid(), scheduler.WAKEUP_SIGNAL)
+                assert (schedule.wait(5))
+            finally:
+                signal.signal(scheduler.WAKEUP_SIGNAL, previous_handler)
+
+    def test_trigger_file(self):
+        trigger_file = os.path.join(self.temp_folder, "wakeup")
+        schedule = scheduler.adaptive_scheduler(1, 10, trigger_file=trigger_file)
+        threading.Timer(0.05, open, [trigger_file, 'w']).start()
+        start = time.time()
+        assert (schedule.wait(5))
+        assert (time.time() - start < scheduler.TRIGGER_POLL_INTERVAL + 1)
+        assert (not os.path.exists(trigger_file))
+
+    def test_work_count(self):
+        for one_folder in [self.config.folder_localoutbox, self.config.folder_remoteoutbox,
+                           self.config.folder_remoteorphan, self.config.folder_ack1flag]:
+            for one_file in monitor.get_file_list(one_folder):
+                os.remove(os.path.join(one_folder, one_file))
+        hl7_file = r'fda_15ff7927-91f6-4fd8-80cb-bbddc6fa0cd1.tar.gz'
+        shutil.copyfile(os.path.join(self.folder_hl7, hl7_file),
+                        os.path.join(self.config.folder_localoutbox, hl7_file))
+
+        assert (monitor.process_folders(self.config) == 1)
+        assert (monitor.process_folders(self.config) == 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
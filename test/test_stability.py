@@ -0,0 +1,93 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import stability
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import stability
+
+
+class StabilityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_hl7 = "../sample/HL7"
+        self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+        self.temp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def write_file(self, file_name, content):
+        full_name = os.path.join(self.temp_folder, file_name)
+        with open(full_name, "a") as target:
+            target.write(content)
+        return full_name
+
+    def test_changing_file_is_deferred(self):
+        tracker = stability.file_stability_tracker(0.2)
+        self.write_file("ack.txt", "MessageId:")
+        assert (not tracker.is_stable(self.temp_folder, "ack.txt"))
+        assert (tracker.pending() == [(self.temp_folder, "ack.txt")])
+
+        time.sleep(0.1)
+        self.write_file("ack.txt", " <id>")
+        assert (not tracker.is_stable(self.temp_folder, "ack.txt"))
+
+        time.sleep(0.25)
+        assert (tracker.is_stable(self.temp_folder, "ack.txt"))
+        assert (tracker.pending() == [])
+        # a file left in the folder stays stable until it changes
+        assert (tracker.is_stable(self.temp_folder, "ack.txt"))
+        assert (tracker.is_stable(self.temp_folder, "ack.txt"))
+        assert (tracker.pending() == [])
+
+        self.write_file("ack.txt", " more")
+        assert (not tracker.is_stable(self.temp_folder, "ack.txt"))
+        assert (tracker.pending() == [(self.temp_folder, "ack.txt")])
+        os.remove(os.path.join(self.temp_folder, "ack.txt"))
+        assert (tracker.pending() == [])
+
+    def test_quiet_file_is_released_on_second_sight(self):
+        tracker = stability.file_stability_tracker(0)
+        self.write_file("ack.txt", "content")
+        # an old mtime doesn't count, it might come from the clock of a file server
+        os.utime(os.path.join(self.temp_folder, "ack.txt"), (0, 0))
+        assert (not tracker.is_stable(self.temp_folder, "ack.txt"))
+        assert (tracker.is_stable(self.temp_folder, "ack.txt"))
+        assert (not tracker.is_stable(self.temp_folder, "gone.txt"))
+
+    def test_disabled_by_default(self):
+        assert (stability.get_tracker(self.config) is None)
+        assert (stability.get_ready_files(self.config, self.temp_folder, ["a", "b"]) == ["a", "b"])
+
+    def test_hl7_deferred_until_stable(self):
+        hl7_file = r'fda_15ff7927-91f6-4fd8-80cb-bbddc6fa0cd1.tar.gz'
+        self.config.file_stability_quiet_period = 0.3
+        for one_folder in [self.config.folder_localoutbox, self.config.folder_remoteoutbox,
+                           self.config.folder_ack1flag]:
+            for one_file in monitor.get_file_list(one_folder):
+                os.remove(os.path.join(one_folder, one_file))
+
+        shutil.copyfile(os.path.join(self.folder_hl7, hl7_file),
+                        os.path.join(self.config.folder_localoutbox, hl7_file))
+
+        monitor.process_hl7_message(self.config)
+        assert (monitor.get_file_list(self.config.folder_localoutbox) == [hl7_file])
+
+        time.sleep(0.35)
+        monitor.process_hl7_message(self.config)
+        assert (monitor.get_file_list(self.config.folder_localoutbox) == [])
+        assert (monitor.get_file_list(self.config.folder_remoteoutbox) == [hl7_file])
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+import sys
+import os
+import time
+import signal
+import shutil
+import threading
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import scheduler
+    from uditransfer import stages
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import scheduler
+    from uditransfer import stages
+
+
+class StagesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_hl7 = "../sample/HL7"
+        self.folder_acks = "../sample/ACKs"
+        self.hl7_files = sorted(file_name for file_name in os.listdir(self.folder_hl7)
+                                if file_name.endswith(".tar.gz"))
+        self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+        self.clean_folders()
+
+    def tearDown(self):
+        self.clean_folders()
+
+    def clean_folders(self):
+        for one_folder in [self.config.folder_localinbox, self.config.folder_localoutbox,
+                           self.config.folder_remoteoutbox, self.config.folder_remoteorphan,
+                           self.config.folder_hl7flag, self.config.folder_ack1flag, self.config.folder_ack2flag,
+                           self.config.folder_ack3flag]:
+            for one_file in monitor.get_file_list(one_folder):
+                os.remove(os.path.join(one_folder, one_file))
+
+    def test_budget_carries_leftovers_over(self):
+        budget = stages.stage_budget(max_files=2)
+        assert (budget.start(["a", "b", "c", "d"]) == ["a", "b"])
+        assert (budget.leftovers() == ["c", "d"])
+        # leftovers first, gone ones dropped
+        assert (budget.start(["a", "b", "d", "e"]) == ["d", "a"])
+        assert (budget.leftovers() == ["b", "e"])
+
+        budget = stages.stage_budget(max_seconds=0.05)
+        assert (budget.start(["a", "b", "c"]) == ["a", "b", "c"])
+        assert (not budget.expired())
+        time.sleep(0.05)
+        assert (budget.expired())
+        budget.leave(["c"])
+        assert (budget.start(["a", "b", "c"]) == ["c", "a", "b"])
+
+        budget = stages.stage_budget()
+        assert (budget.start(["a", "b"]) == ["a", "b"])
+        assert (budget.leftovers() == [])
+
+    def test_order(self):
+        assert (stages.stage_coordinator('hl7').next_order() == ['hl7', 'ack'])
+        coordinator = stages.stage_coordinator('ack')
+        assert ([coordinator.next_order() for _ in range(2)] == [['ack', 'hl7'], ['ack', 'hl7']])
+        coordinator = stages.stage_coordinator('alternate')
+        assert ([coordinator.next_order() for _ in range(3)] == [['hl7', 'ack'], ['ack', 'hl7'], ['hl7', 'ack']])
+
+    def test_priority(self):
+        coordinator = stages.stage_coordinator('ack')
+        entered = threading.Event()
+
+        def run_hl7_pass():
+            with coordinator.running(stages.HL7_STAGE):
+                entered.set()
+
+        with coordinator.running(stages.ACK_STAGE):
+            thread = threading.Thread(target=run_hl7_pass)
+            thread.start()
+            # the HL7 pass waits for the ACK pass
+            assert (not entered.wait(0.1))
+        thread.join(5)
+        assert (entered.is_set())
+
+        # while an HL7 pass runs, ACK passes still start right away
+        with coordinator.running(stages.HL7_STAGE):
+            with coordinator.running(stages.ACK_STAGE):
+                pass
+
+    def test_linked_schedulers(self):
+        schedules = [scheduler.adaptive_scheduler(1, 10) for _ in range(2)]
+        scheduler.link_schedulers(schedules)
+        schedules[0].wake_all()
+        assert (schedules[0].wait(0) and schedules[1].wait(0))
+
+    def test_budget_of_a_pass(self):
+        for hl7_file in self.hl7_files:
+            shutil.copyfile(os.path.join(self.folder_hl7, hl7_file),
+                            os.path.join(self.config.folder_localoutbox, hl7_file))
+        self.config.hl7_stage_max_files = 1
+        self.config.stage_order = 'ack'
+
+        for pass_index in range(len(self.hl7_files)):
+            assert (monitor.process_folders(self.config) == 1)
+            assert (stages.get_leftover_count(self.config) == len(self.hl7_files) - pass_index - 1)
+        assert (monitor.process_folders(self.config) == 0)
+        assert (sorted(monitor.get_file_list(self.config.folder_remoteoutbox)) == self.hl7_files)
+
+    def test_concurrent_stages(self):
+        hl7_file = r'fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz'
+        ack_files = [hl7_file, "ACK2_" + hl7_file, "ACK3_" + hl7_file]
+        shutil.copyfile(os.path.join(self.folder_hl7, hl7_file),
+                        os.path.join(self.config.folder_localoutbox, hl7_file))
+        for ack_file in ack_files:
+            shutil.copyfile(os.path.join(self.folder_acks, ack_file),
+                            os.path.join(self.config.folder_remoteorphan, ack_file))
+        self.config.min_sleeptime = 0.01
+        self.config.max_sleeptime = 0.05
+        self.config.stage_order = 'ack'
+
+        stopped = threading.Event()
+
+        def stop_when_done():
+            deadline = time.time() + 30
+            while time.time() < deadline:
+                if sorted(monitor.get_file_list(self.config.folder_localinbox)) == sorted(ack_files):
+                    break
+                time.sleep(0.05)
+            stopped.set()
+
+        threading.Thread(target=stop_when_done).start()
+        previous_handler = signal.getsignal(scheduler.WAKEUP_SIGNAL) if scheduler.WAKEUP_SIGNAL else None
+        try:
+            monitor.run_stages_concurrently(self.config, stopped)
+        finally:
+            if scheduler.WAKEUP_SIGNAL is not None:
+                signal.signal(scheduler.WAKEUP_SIGNAL, previous_handler)
+
+        assert (monitor.get_file_list(self.config.folder_remoteoutbox) == [hl7_file])
+        assert (sorted(monitor.get_file_list(self.config.folder_localinbox)) == sorted(ack_files))
+        assert (monitor.get_file_list(self.config.folder_remoteorphan) == [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+import sys
+import os
+import shutil
+import hashlib
+import tempfile
+
+try:
+    from uditransfer import transfer
+except:
+    sys.path.append("..")
+    from uditransfer import transfer
+
+
+class TransferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.hl7_file = r'../sample/HL7/fda_15ff7927-91f6-4fd8-80cb-bbddc6fa0cd1.tar.gz'
+        self.temp_folder = tempfile.mkdtemp()
+        self.source_file = os.path.join(self.temp_folder, "source.tar.gz")
+        shutil.copyfile(self.hl7_file, self.source_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def read_binary(self, file_name):
+        with open(file_name, 'rb') as content_file:
+            return content_file.read()
+
+    def assert_no_temp_files(self):
+        assert ([f for f in os.listdir(self.temp_folder) if f.startswith('.')] == [])
+
+    def test_copy_file(self):
+        target_file = os.path.join(self.temp_folder, "target.tar.gz")
+        transfer.copy_file(self.source_file, target_file)
+        assert (self.read_binary(target_file) == self.read_binary(self.hl7_file))
+        assert (os.path.exists(self.source_file))
+        self.assert_no_temp_files()
+
+    def test_copy_in_kernel(self):
+        if not sys.platform.startswith('linux'):
+            return
+        assert (transfer.get_kernel_copy_functions()[1] is not None)
+
+        def copy_in_userspace(source, target, length=0):
+            raise AssertionError("copied in userspace")
+
+        target_file = os.path.join(self.temp_folder, "target.tar.gz")
+        copyfileobj = shutil.copyfileobj
+        shutil.copyfileobj = copy_in_userspace
+        try:
+            transfer.copy_file(self.source_file, target_file)
+        finally:
+            shutil.copyfileobj = copyfileobj
+        assert (self.read_binary(target_file) == self.read_binary(self.hl7_file))
+
+        # sendfile alone, as on kernels without copy_file_range
+        os.remove(target_file)
+        with open(self.source_file, 'rb') as source:
+            with open(target_file, 'wb') as target:
+                size = os.fstat(source.fileno()).st_size
+                assert (transfer._copy_in_kernel_sendfile(source, target, 0, size))
+        assert (self.read_binary(target_file) == self.read_binary(self.hl7_file))
+
+        # a source which ends before the size it had is an error, not a short copy
+        for copy_function in [transfer._copy_in_kernel, lambda source, target, size:
+                              transfer._copy_in_kernel_sendfile(source, target, 0, size)]:
+            with open(self.source_file, 'rb') as source:
+                with open(target_file, 'wb') as target:
+                    size = os.fstat(source.fileno()).st_size
+                    self.assertRaises(IOError, copy_function, source, target, size + 10)
+
+    def test_move_file(self):
+        target_file = os.path.join(self.temp_folder, "target.tar.gz")
+        source_inode = os.stat(self.source_file).st_ino
+        assert (transfer.move_file(self.source_file, target_file))
+        assert (not os.path.exists(self.source_file))
+        assert (os.stat(target_file).st_ino == source_inode)
+        assert (self.read_binary(target_file) == self.read_binary(self.hl7_file))
+
+    def test_link_or_copy(self):
+        target_file = os.path.join(self.temp_folder, "flag.tar.gz")
+        method = transfer.link_or_copy(self.source_file, target_file)
+        assert (method in ['link', 'clone', 'copy'])
+        assert (self.read_binary(target_file) == self.read_binary(self.hl7_file))
+
+        # the flag outlives the source which is removed after a copy
+        os.remove(self.source_file)
+        assert (self.read_binary(target_file) == self.read_binary(self.hl7_file))
+        self.assert_no_temp_files()
+
+    def test_stream_copy(self):
+        target_file = os.path.join(self.temp_folder, "target.tar.gz")
+        content = self.read_binary(self.hl7_file)
+        result = transfer.stream_copy(self.source_file, target_file, head_size=100, chunk_size=64)
+        assert (result.size == len(content))
+        assert (result.digest == hashlib.sha256(content).hexdigest())
+        assert (result.head_digest == transfer.get_content_digest(content[:100]))
+        assert (self.read_binary(target_file) == content)
+        self.assert_no_temp_files()
+
+    def test_remove_stale_temp_files(self):
+        stale_file = transfer.get_temp_file(os.path.join(self.temp_folder, "stale.tar.gz"))
+        fresh_file = transfer.get_temp_file(os.path.join(self.temp_folder, "fresh.tar.gz"))
+        for name in [stale_file, fresh_file, os.path.join(self.temp_folder, ".hidden"),
+                     os.path.join(self.temp_folder, "old.tmp")]:
+            with open(name, 'w') as temp_stream:
+                temp_stream.write("partial")
+            os.utime(name, (0, 0))
+        os.utime(fresh_file, None)
+
+        assert (transfer.remove_stale_temp_files(self.temp_folder, 3600) == 1)
+        assert (sorted(os.listdir(self.temp_folder)) ==
+                sorted([os.path.basename(fresh_file), ".hidden", "old.tmp", "source.tar.gz"]))
+        assert (transfer.remove_stale_temp_files(os.path.join(self.temp_folder, "missing"), 3600) == 0)
+
+    def test_failed_copy_leaves_no_target(self):
+        target_file = os.path.join(self.temp_folder, "target.tar.gz")
+        self.assertRaises(IOError, transfer.copy_file, os.path.join(self.temp_folder, "missing"), target_file)
+        assert (not os.path.exists(target_file))
+        self.assert_no_temp_files()
+
+
+if __name__=="__main__":
+    unittest.main()
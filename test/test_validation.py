@@ -0,0 +1,100 @@
+import unittest
+import sys
+import os
+import shutil
+import tarfile
+import tempfile
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import filecache
+    from uditransfer import validation
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import filecache
+    from uditransfer import validation
+import config_util
+
+
+class ValidationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_hl7 = "../sample/HL7"
+        self.folder_acks = "../sample/ACKs"
+        self.hl7_files = sorted(file_name for file_name in os.listdir(self.folder_hl7)
+                                if file_name.endswith(".tar.gz"))
+        self.ack_file = os.path.join(self.folder_acks, r'fda_f012caf2-d546-4885-a2e6-0640dfd408e2.tar.gz')
+        self.temp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def test_scan_package(self):
+        verdict, level, reason = validation.scan_package(os.path.join(self.folder_hl7, self.hl7_files[0]))
+        assert (verdict and "valid HL7" in reason)
+        assert (validation.scan_package(self.ack_file)[0] is False)
+        assert (validation.scan_package(os.path.join(self.temp_folder, "missing.tar.gz"))[0] is None)
+        assert (validation.get_verdict(validation.scan_package(os.path.join(self.temp_folder, "missing"))) is False)
+
+    def test_max_bytes_limits_member_start(self):
+        hl7_file = os.path.join(self.temp_folder, "fda_large.tar.gz")
+        filler_file = os.path.join(self.temp_folder, "filler.bin")
+        with open(filler_file, 'wb') as filler:
+            filler.write(b"x" * 4000)
+        tar = tarfile.open(hl7_file, 'w:gz')
+        try:
+            tar.add(filler_file, "fda_large/filler.bin")
+            tar.add(filler_file, "fda_large/SPL/Submission.xml")
+        finally:
+            tar.close()
+
+        # the filler ends at 512 + 4000, SUBMISSION.XML starts after its padding at 512 + 4096
+        assert (validation.scan_package(hl7_file, max_bytes=512 + 4096 + 1)[0])
+        assert (validation.scan_package(hl7_file, max_bytes=512 + 4096)[0] is False)
+        assert (validation.scan_package(hl7_file, max_bytes=512 + 4000 + 1)[0] is False)
+
+    def test_pool(self):
+        verdict_cache = filecache.verdict_cache(16)
+        # every process is replaced after each package
+        pool = validation.validation_pool(2, min_bytes=0, max_tasks_per_child=1)
+        try:
+            packages = [os.path.join(self.folder_hl7, hl7_file) for hl7_file in self.hl7_files]
+            packages.append(self.ack_file)
+            pending_verdicts = [pool.submit(package, verdict_cache=verdict_cache) for package in packages]
+            assert ([pending_verdict.get() for pending_verdict in pending_verdicts] ==
+                    [True] * len(self.hl7_files) + [False])
+            assert (len(verdict_cache) == len(packages))
+
+            # known verdicts and missing files are not handed over
+            assert (pool.submit(packages[0], verdict_cache=verdict_cache) is None)
+            assert (pool.submit(os.path.join(self.temp_folder, "missing.tar.gz")) is None)
+            assert (pool.submitted == len(packages))
+        finally:
+            pool.close()
+
+        small_pool = validation.validation_pool(2, min_bytes=1024 * 1024 * 1024)
+        assert (small_pool.submit(os.path.join(self.folder_hl7, self.hl7_files[0])) is None)
+        assert (not validation.validation_pool(0).enabled)
+
+    def test_hl7_pass_with_pool(self):
+        my_config = configuration.monitor_configuration(config_util.create_temp_config(self.temp_folder, {
+            'hl7_operation_delay': '-1', 'hl7_validation_processes': '2', 'hl7_validation_process_min_bytes': '0'}))
+
+        for hl7_file in self.hl7_files:
+            shutil.copyfile(os.path.join(self.folder_hl7, hl7_file),
+                            os.path.join(my_config.folder_localoutbox, hl7_file))
+        shutil.copyfile(self.ack_file, os.path.join(my_config.folder_localoutbox, "fda_wrong.tar.gz"))
+        try:
+            assert (monitor.process_hl7_message(my_config) == len(self.hl7_files))
+            assert (validation.get_validation_pool(my_config).submitted == len(self.hl7_files) + 1)
+        finally:
+            validation.close_validation_pool(my_config)
+        assert (sorted(monitor.get_file_list(my_config.folder_remoteoutbox)) == self.hl7_files)
+        assert (monitor.get_file_list(my_config.folder_hl7flag) == ["fda_wrong.tar.gz"])
+
+
+if __name__ == '__main__':
+    unittest.main()
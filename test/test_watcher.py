@@ -0,0 +1,75 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+
+try:
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import watcher
+except:
+    sys.path.append("..")
+    from uditransfer import monitor
+    from uditransfer import configuration
+    from uditransfer import watcher
+
+
+class WatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_hl7 = "../sample/HL7"
+        self.config = configuration.monitor_configuration("../sample/sample_config.ini")
+        self.temp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    @unittest.skipUnless(watcher.inotify_available(), "inotify is only available on Linux")
+    def test_inotify_close_write(self):
+        folder_watcher = watcher.inotify_watcher()
+        try:
+            folder_watcher.add_folder(self.temp_folder, watcher.FILE_READY_MASK)
+            assert (folder_watcher.read_events(0) == [])
+
+            with open(os.path.join(self.temp_folder, "fda_test.tar.gz"), "w") as target:
+                target.write("content")
+
+            events = folder_watcher.read_events(1)
+            assert (len(events) == 1)
+            folder, file_name, mask = events[0]
+            assert (folder == self.temp_folder)
+            assert (file_name == "fda_test.tar.gz")
+            assert (mask & watcher.IN_CLOSE_WRITE)
+        finally:
+            folder_watcher.close()
+
+    def test_get_changed_files(self):
+        for file_name in ["b.tar.gz", "a.tar.gz", ".hidden"]:
+            with open(os.path.join(self.temp_folder, file_name), "w") as target:
+                target.write("content")
+
+        changed_files = monitor.get_changed_files(self.temp_folder,
+                                                  ["b.tar.gz", "a.tar.gz", "a.tar.gz", ".hidden", "gone.tar.gz"])
+        assert (changed_files == ["a.tar.gz", "b.tar.gz"])
+
+    def test_dispatch_hl7_event(self):
+        hl7_file = r'fda_15ff7927-91f6-4fd8-80cb-bbddc6fa0cd1.tar.gz'
+        for one_folder in [self.config.folder_localoutbox, self.config.folder_remoteoutbox,
+                           self.config.folder_ack1flag]:
+            for one_file in monitor.get_file_list(one_folder):
+                os.remove(os.path.join(one_folder, one_file))
+
+        shutil.copyfile(os.path.join(self.folder_hl7, hl7_file),
+                        os.path.join(self.config.folder_localoutbox, hl7_file))
+
+        events = [(self.config.folder_localoutbox, hl7_file, watcher.IN_CLOSE_WRITE)]
+        monitor.dispatch_watch_events(self.config, events)
+
+        assert (os.path.exists(os.path.join(self.config.folder_remoteoutbox, hl7_file)))
+        assert (os.path.exists(os.path.join(self.config.folder_ack1flag, hl7_file)))
+        assert (len(monitor.get_file_list(self.config.folder_localoutbox)) == 0)
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import collections
+
+MESSAGE_ID = 'MessageId'
+CORE_ID = 'CoreId:'
+DATA_RECEIVED = 'DateTime Receipt Generated:'
+ACK3_XML = '<submission>'
+CORE_ID_START = '<coreId>'
+CORE_ID_END = '</coreId>'
+
+ack_info = collections.namedtuple('ack_info', ['ack_type', 'message_id', 'core_id', 'ack1_message_id'])
+
+
+def parse_ack_content(file_content):
+    '''
+    find out once what kind of ack an orphan looks like, and all IDs needed to process it.
+    results are the same as the get_*_from_ack*_content functions of monitor, but every marker is
+    searched only once and only a missing MessageId costs a scan of the whole content.
+    ack_type is 'ACK2' if it has a message ID, 'ACK3' if it has a core ID in a <submission>, '' otherwise.
+    :param file_content:
+    :return: ack_info(ack_type, message_id, core_id, ack1_message_id)
+    '''
+    first_lt = file_content.find('<')
+    ack1_message_id = file_content[first_lt + 1:file_content.find('>')]
+
+    if file_content.find(MESSAGE_ID) >= 0:
+        message_id = file_content[first_lt + 1:file_content.rfind('>')].strip()
+        if message_id:
+            core_id = None
+            int_start = file_content.find(CORE_ID)
+            if int_start >= 0:
+                int_end = file_content.find(DATA_RECEIVED, int_start)
+                if int_end >= 0:
+                    core_id = file_content[int_start + len(CORE_ID):int_end]
+                    core_id = core_id.strip() if core_id else None
+            return ack_info('ACK2', message_id, core_id, ack1_message_id)
+
+    if file_content.find(ACK3_XML) >= 0:
+        int_start = file_content.find(CORE_ID_START)
+        int_end = file_content.find(CORE_ID_END)
+        if int_start >= 0 and int_end >= 0:
+            core_id = file_content[int_start + len(CORE_ID_START):int_end]
+            if core_id:
+                return ack_info('ACK3', None, core_id, ack1_message_id)
+
+    return ack_info('', None, None, ack1_message_id)
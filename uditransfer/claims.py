@@ -0,0 +1,276 @@
+import os
+import time
+import zlib
+import errno
+import socket
+import logging
+import threading
+
+# claim subfolders, one per folder files are claimed from
+HL7_CLAIMS = 'hl7'
+ORPHAN_CLAIMS = 'orphan'
+
+CLAIM_SUFFIX = '.claim'
+
+
+def get_partition(file_name, instance_count):
+    '''
+    :return: index of the instance file_name belongs to, crc32 of the name modulo instance_count
+    '''
+    if not isinstance(file_name, bytes):
+        file_name = file_name.encode('utf-8')
+    return (zlib.crc32(file_name) & 0xffffffff) % instance_count
+
+
+class claim():
+    ''' with-block holding the claim of one file, true if the claim has been taken
+    '''
+    def __init__(self, manager, kind, folder, file_name):
+        self.manager = manager
+        self.kind = kind
+        self.folder = folder
+        self.file_name = file_name
+        self.claimed = False
+
+    def __enter__(self):
+        self.claimed = self.manager.acquire(self.kind, self.folder, self.file_name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.claimed:
+            self.manager.release(self.kind, self.file_name)
+        return False
+
+    def __bool__(self):
+        return self.claimed
+
+    __nonzero__ = __bool__
+
+
+class claim_manager():
+    '''
+    lets several instances share local outbox and remote orphan folders.
+    a file is only handled by the instance which created its claim file in claim_folder with O_EXCL.
+    claims are leases: the modification time of a claim file is renewed every lease_seconds / 3 while it's held,
+    a claim older than lease_seconds belongs to a crashed instance and is taken over. the expired claim file is
+    renamed away first, so exactly one instance wins the takeover.
+    with instance_count above 1, files are partitioned by crc32 of their name and every instance only looks at
+    its own partition. files of other partitions are only taken once they are older than lease_seconds,
+    in case their instance is gone. without claim_folder, partitions are strict and nothing is claimed.
+    '''
+    def __init__(self, claim_folder=None, instance_id=None, lease_seconds=300, instance_count=1, instance_index=0):
+        self.claim_folder = claim_folder
+        self.instance_id = instance_id or "%s-%d" % (socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds
+        self.instance_count = max(1, instance_count)
+        self.instance_index = instance_index
+        self.taken_over = 0
+        # (kind, file name) -> claim file of every claim held
+        self.__held = {}
+        self.__lock = threading.Lock()
+        self.__renewer = None
+        self.__stopped = threading.Event()
+
+        if claim_folder:
+            for kind in [HL7_CLAIMS, ORPHAN_CLAIMS]:
+                kind_folder = os.path.join(claim_folder, kind)
+                if not os.path.exists(kind_folder):
+                    try:
+                        os.makedirs(kind_folder)
+                    except OSError:
+                        if not os.path.isdir(kind_folder):
+                            raise
+
+    @property
+    def enabled(self):
+        return bool(self.claim_folder)
+
+    def describe(self, kind, file_name):
+        return os.path.join(self.claim_folder, kind, file_name + CLAIM_SUFFIX)
+
+    def select(self, folder, file_names):
+        '''
+        :return: file names of this instance's partition, plus files of other partitions waiting for longer
+                 than lease_seconds when claims are in use
+        '''
+        if self.instance_count <= 1:
+            return file_names
+
+        selected = []
+        now = time.time()
+        for file_name in file_names:
+            if get_partition(file_name, self.instance_count) == self.instance_index:
+                selected.append(file_name)
+            elif self.enabled:
+                try:
+                    if now - os.path.getmtime(os.path.join(folder, file_name)) > self.lease_seconds:
+                        selected.append(file_name)
+                except OSError:
+                    pass
+        return selected
+
+    def claim(self, kind, folder, file_name):
+        return claim(self, kind, folder, file_name)
+
+    def acquire(self, kind, folder, file_name):
+        '''
+        :return: True if file_name in folder is claimed by this instance now and still there
+        '''
+        if not self.enabled:
+            return True
+
+        claim_file = self.describe(kind, file_name)
+        if not self.__create(claim_file):
+            if not self.__take_over(claim_file) or not self.__create(claim_file):
+                return False
+
+        if not os.path.exists(os.path.join(folder, file_name)):
+            # another instance has finished it in the meantime
+            self.__remove(claim_file)
+            return False
+
+        with self.__lock:
+            self.__held[(kind, file_name)] = claim_file
+            self.__start_renewer()
+        return True
+
+    def release(self, kind, file_name):
+        if not self.enabled:
+            return
+        with self.__lock:
+            claim_file = self.__held.pop((kind, file_name), None)
+        if claim_file:
+            self.__remove(claim_file)
+
+    def renew(self):
+        ''' push the expiry of every claim held further out
+        '''
+        with self.__lock:
+            claim_files = list(self.__held.values())
+        for claim_file in claim_files:
+            try:
+                os.utime(claim_file, None)
+            except OSError as e:
+                logging.error("Unable to renew claim %s:%s", claim_file, str(e))
+
+    def sweep(self, folders):
+        '''
+        remove expired claims of files which are gone, left behind by an instance crashing after its work.
+        :param folders: dict of claim kind -> folder its files are in
+        :return: number of claims removed
+        '''
+        if not self.enabled:
+            return 0
+
+        removed = 0
+        now = time.time()
+        for kind, folder in folders.items():
+            kind_folder = os.path.join(self.claim_folder, kind)
+            for claim_name in os.listdir(kind_folder):
+                if not claim_name.endswith(CLAIM_SUFFIX):
+                    continue
+                file_name = claim_name[:-len(CLAIM_SUFFIX)]
+                claim_file = os.path.join(kind_folder, claim_name)
+                try:
+                    expired = now - os.path.getmtime(claim_file) > self.lease_seconds
+                except OSError:
+                    continue
+                if expired and not os.path.exists(os.path.join(folder, file_name)):
+                    if self.__take_over(claim_file):
+                        removed += 1
+        return removed
+
+    def close(self):
+        self.__stopped.set()
+        if self.__renewer is not None:
+            self.__renewer.join()
+        with self.__lock:
+            claim_files = list(self.__held.values())
+            self.__held.clear()
+        for claim_file in claim_files:
+            self.__remove(claim_file)
+
+    def __create(self, claim_file):
+        try:
+            file_descriptor = os.open(claim_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        try:
+            os.write(file_descriptor, ("%s %d\n" % (self.instance_id, os.getpid())).encode('utf-8'))
+        finally:
+            os.close(file_descriptor)
+        return True
+
+    def __take_over(self, claim_file):
+        '''
+        move an expired claim out of the way, only one of several instances trying at once succeeds.
+        :return: True if the claim was expired and has been removed by this instance
+        '''
+        try:
+            if time.time() - os.path.getmtime(claim_file) <= self.lease_seconds:
+                return False
+        except OSError:
+            # released in the meantime
+            return True
+
+        stale_file = "%s.%s.stale" % (claim_file, self.instance_id)
+        try:
+            os.rename(claim_file, stale_file)
+        except OSError:
+            return False
+
+        try:
+            if time.time() - os.path.getmtime(stale_file) <= self.lease_seconds:
+                # renewed right before the rename, give it back unless someone has claimed it since
+                try:
+                    os.link(stale_file, claim_file)
+                except OSError:
+                    pass
+                return False
+            with open(stale_file, 'r') as stale_stream:
+                owner = stale_stream.read().strip()
+            logging.warning("Taking over expired claim %s of %s", claim_file, owner)
+            self.taken_over += 1
+            return True
+        finally:
+            self.__remove(stale_file)
+
+    def __remove(self, claim_file):
+        try:
+            os.remove(claim_file)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logging.error("Unable to remove claim %s:%s", claim_file, str(e))
+
+    def __start_renewer(self):
+        if self.__renewer is not None:
+            return
+
+        def renew_periodically():
+            while not self.__stopped.wait(self.lease_seconds / 3.0):
+                self.renew()
+
+        self.__renewer = threading.Thread(target=renew_periodically, name="claim-renewer")
+        self.__renewer.daemon = True
+        self.__renewer.start()
+
+
+def get_claim_manager(my_config):
+    '''
+    :return: the claim manager of this configuration, one which claims nothing unless claim_folder is set
+    '''
+    manager = getattr(my_config, 'claim_manager', None)
+    if manager is None:
+        manager = claim_manager(my_config.claim_folder, my_config.instance_id, my_config.claim_lease_seconds,
+                                my_config.instance_count, my_config.instance_index)
+        my_config.claim_manager = manager
+    return manager
+
+
+def close_claim_manager(my_config):
+    manager = getattr(my_config, 'claim_manager', None)
+    if manager is not None:
+        manager.close()
+        my_config.claim_manager = None
@@ -2,6 +2,7 @@ import sys
 import os
 import logging
 import codecs
+import socket
 
 from ConfigParser import SafeConfigParser
 import ConfigParser
@@ -19,6 +20,9 @@ class monitor_configuration():
         self.folder_ack3flag = None
         self.folder_tobedeleted = None
         self.folder_logs = None
+        self.log_max_bytes = 0
+        self.log_async = True
+        self.log_payload_max_bytes = 1024
 
         self.sleeptime = 100
         self.operation_method_is_copy = False
@@ -32,6 +36,75 @@ class monitor_configuration():
 
         self.hl7_operation_shell_commands = []
         self.ack_operation_shell_commands = []
+        self.hook_worker_count = 0
+        self.hook_timeout = 0
+        self.hook_use_shell = True
+        self.hook_batch_size = 1
+
+        self.watch_rescan_interval = 300
+
+        self.hl7_worker_count = 1
+        self.hl7_max_inflight_transfers = 0
+        self.ack_worker_count = 1
+
+        self.file_stability_quiet_period = -1
+
+        self.flag_index_file = None
+        self.flag_index_retention = 30 * 24 * 3600
+        self.flag_shard_depth = 0
+        self.flag_shard_migration_batch = 1000
+
+        self.hl7_validation_max_members = 0
+        self.hl7_validation_max_bytes = 0
+        self.hl7_validation_cache_size = 1024
+        self.hl7_validation_processes = 0
+        self.hl7_validation_process_min_bytes = 1024 * 1024
+        self.hl7_validation_max_tasks_per_child = 100
+        self.hl7_validation_timeout = 300
+
+        self.orphan_negative_cache_file = None
+
+        self.ack_read_max_bytes = 1024 * 1024
+
+        self.metrics_textfile = None
+        self.metrics_http_port = 0
+        self.metrics_http_address = '127.0.0.1'
+
+        self.latency_log_file = None
+
+        self.journal_file = None
+        self.journal_commit_delay = 0.0
+
+        self.min_sleeptime = 100
+        self.max_sleeptime = 100
+        self.sleeptime_backoff = 2.0
+        self.wakeup_trigger_file = None
+
+        self.claim_folder = None
+        self.claim_lease_seconds = 300
+        self.instance_count = 1
+        self.instance_index = 0
+        self.instance_id = None
+
+        self.retry_base_delay = 0
+        self.retry_max_delay = 3600
+        self.retry_jitter = 0.5
+        self.retry_max_attempts = 0
+        self.retry_max_per_pass = 0
+        self.retry_queue_file = None
+        self.folder_quarantine = None
+
+        self.stage_order = 'hl7'
+        self.concurrent_stages = False
+        self.hl7_stage_max_files = 0
+        self.hl7_stage_max_seconds = 0
+        self.ack_stage_max_files = 0
+        self.ack_stage_max_seconds = 0
+
+        self.dedup_policy = 'off'
+        self.dedup_store_file = None
+        self.dedup_max_entries = 100000
+        self.dedup_ttl = 7 * 24 * 3600
 
         self.validate_configuration(configuration_file)
 
@@ -54,6 +127,42 @@ class monitor_configuration():
 
         return option_list
 
+    def __get_optional_option(self, parser, section, option_name, default_value):
+        try:
+            option_value = parser.get(section, option_name)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            return default_value
+
+        if option_value is None:
+            return default_value
+
+        option_value = option_value.strip()
+        if len(option_value) == 0:
+            return default_value
+
+        return option_value
+
+    def __get_optional_float(self, parser, section, option_name, default_value):
+        option_value = self.__get_optional_option(parser, section, option_name, default_value)
+        try:
+            return float(option_value)
+        except:
+            return default_value
+
+    def __get_optional_int(self, parser, section, option_name, default_value):
+        option_value = self.__get_optional_option(parser, section, option_name, default_value)
+        try:
+            return int(option_value)
+        except:
+            return default_value
+
+    def __get_optional_bool(self, parser, section, option_name, default_value):
+        option_value = self.__get_optional_option(parser, section, option_name, None)
+        if option_value is None:
+            return default_value
+
+        return option_value.upper() == 'TRUE'
+
     def __get_log_option(self, log_str, default_log):
         log_dict = {
             'DEBUG':logging.DEBUG,
@@ -83,6 +192,9 @@ class monitor_configuration():
         self.folder_logs = parser.get('General', 'folder_logs')
         self.stdout_log = self.__get_log_option(parser.get('General', 'stdout_log'), logging.INFO)
         self.all_file_log = self.__get_log_option(parser.get('General', 'all_file_log'), logging.DEBUG)
+        self.log_max_bytes = self.__get_optional_int(parser, 'General', 'log_max_bytes', 0)
+        self.log_async = self.__get_optional_bool(parser, 'General', 'log_async', True)
+        self.log_payload_max_bytes = self.__get_optional_int(parser, 'General', 'log_payload_max_bytes', 1024)
 
         # ack operation parameters
         operation_method = parser.get('General','operation_method')
@@ -140,6 +252,115 @@ class monitor_configuration():
         self.ack_operation_shell_commands = self.__get_option_list(parser, "General",
                                                                    "ack_operation_shell_command", 20)
 
+        # hook executor parameters
+        self.hook_worker_count = self.__get_optional_int(parser, 'General', 'hook_worker_count', 0)
+        self.hook_timeout = self.__get_optional_float(parser, 'General', 'hook_timeout', 0)
+        self.hook_use_shell = self.__get_optional_bool(parser, 'General', 'hook_use_shell', True)
+        self.hook_batch_size = self.__get_optional_int(parser, 'General', 'hook_batch_size', 1)
+
+        # watch mode parameters
+        self.watch_rescan_interval = self.__get_optional_float(parser, 'General', 'watch_rescan_interval', 300)
+
+        # HL7 worker pool parameters
+        self.hl7_worker_count = self.__get_optional_int(parser, 'General', 'hl7_worker_count', 1)
+        self.hl7_max_inflight_transfers = self.__get_optional_int(parser, 'General', 'hl7_max_inflight_transfers', 0)
+
+        # orphan ack worker pool parameters
+        self.ack_worker_count = self.__get_optional_int(parser, 'General', 'ack_worker_count', 1)
+
+        # file stability tracker, replaces operation_delay and hl7_operation_delay when set
+        self.file_stability_quiet_period = self.__get_optional_float(parser, 'General',
+                                                                    'file_stability_quiet_period', -1)
+
+        # ack flags kept in a SQLite index instead of flag folders
+        self.flag_index_file = self.__get_optional_option(parser, 'General', 'flag_index_file', None)
+        self.flag_index_retention = self.__get_optional_float(parser, 'General', 'flag_index_retention',
+                                                              30 * 24 * 3600)
+
+        # hash prefix subfolders of flag folders
+        self.flag_shard_depth = self.__get_optional_int(parser, 'General', 'flag_shard_depth', 0)
+        self.flag_shard_migration_batch = self.__get_optional_int(parser, 'General',
+                                                                  'flag_shard_migration_batch', 1000)
+
+        # HL7 package validation limits
+        self.hl7_validation_max_members = self.__get_optional_int(parser, 'General',
+                                                                  'hl7_validation_max_members', 0)
+        self.hl7_validation_max_bytes = self.__get_optional_int(parser, 'General', 'hl7_validation_max_bytes', 0)
+        self.hl7_validation_cache_size = self.__get_optional_int(parser, 'General',
+                                                                 'hl7_validation_cache_size', 1024)
+        self.hl7_validation_processes = self.__get_optional_int(parser, 'General', 'hl7_validation_processes', 0)
+        self.hl7_validation_process_min_bytes = self.__get_optional_int(parser, 'General',
+                                                                        'hl7_validation_process_min_bytes',
+                                                                        1024 * 1024)
+        self.hl7_validation_max_tasks_per_child = self.__get_optional_int(parser, 'General',
+                                                                          'hl7_validation_max_tasks_per_child', 100)
+        self.hl7_validation_timeout = self.__get_optional_float(parser, 'General', 'hl7_validation_timeout', 300)
+
+        # remember orphans which are not for CCM
+        self.orphan_negative_cache_file = self.__get_optional_option(parser, 'General',
+                                                                     'orphan_negative_cache_file', None)
+
+        # bytes read from each orphan to detect its ack type
+        self.ack_read_max_bytes = self.__get_optional_int(parser, 'General', 'ack_read_max_bytes', 1024 * 1024)
+
+        # metrics exporter parameters
+        self.metrics_textfile = self.__get_optional_option(parser, 'General', 'metrics_textfile', None)
+        self.metrics_http_port = self.__get_optional_int(parser, 'General', 'metrics_http_port', 0)
+        self.metrics_http_address = self.__get_optional_option(parser, 'General', 'metrics_http_address',
+                                                               '127.0.0.1')
+
+        # submission latency log
+        self.latency_log_file = self.__get_optional_option(parser, 'General', 'latency_log_file', None)
+
+        # write-ahead journal of ack hand-offs
+        self.journal_file = self.__get_optional_option(parser, 'General', 'journal_file', None)
+        self.journal_commit_delay = self.__get_optional_float(parser, 'General', 'journal_commit_delay', 0.0)
+
+        # adaptive sleep time of periodical running, fixed at sleeptime unless set
+        self.min_sleeptime = self.__get_optional_float(parser, 'General', 'min_sleeptime', self.sleeptime)
+        self.max_sleeptime = self.__get_optional_float(parser, 'General', 'max_sleeptime', self.sleeptime)
+        self.sleeptime_backoff = self.__get_optional_float(parser, 'General', 'sleeptime_backoff', 2.0)
+        self.wakeup_trigger_file = self.__get_optional_option(parser, 'General', 'wakeup_trigger_file', None)
+
+        # several instances sharing the same folders
+        self.claim_folder = self.__get_optional_option(parser, 'General', 'claim_folder', None)
+        self.claim_lease_seconds = self.__get_optional_float(parser, 'General', 'claim_lease_seconds', 300)
+        self.instance_count = self.__get_optional_int(parser, 'General', 'instance_count', 1)
+        self.instance_index = self.__get_optional_int(parser, 'General', 'instance_index', 0)
+        self.instance_id = self.__get_optional_option(parser, 'General', 'instance_id', None)
+        if self.instance_id is None and (self.claim_folder or self.instance_count > 1):
+            self.instance_id = "%s-%d" % (socket.gethostname(), self.instance_index)
+        if not 0 <= self.instance_index < max(1, self.instance_count):
+            raise ValueError("instance_index has to be between 0 and instance_count - 1")
+
+        # retry queue of files whose processing has failed
+        self.retry_base_delay = self.__get_optional_float(parser, 'General', 'retry_base_delay', 0)
+        self.retry_max_delay = self.__get_optional_float(parser, 'General', 'retry_max_delay', 3600)
+        self.retry_jitter = self.__get_optional_float(parser, 'General', 'retry_jitter', 0.5)
+        self.retry_max_attempts = self.__get_optional_int(parser, 'General', 'retry_max_attempts', 0)
+        self.retry_max_per_pass = self.__get_optional_int(parser, 'General', 'retry_max_per_pass', 0)
+        self.retry_queue_file = self.__get_optional_option(parser, 'General', 'retry_queue_file', None)
+        self.folder_quarantine = self.__get_optional_option(parser, 'General', 'folder_quarantine',
+                                                            os.path.join(self.folder_tobedeleted, 'quarantine'))
+
+        # share of HL7 and ACK stages and their work budget per pass
+        self.stage_order = self.__get_optional_option(parser, 'General', 'stage_order', 'hl7').lower()
+        if self.stage_order not in ('hl7', 'ack', 'alternate'):
+            raise ValueError("stage_order has to be hl7, ack or alternate")
+        self.concurrent_stages = self.__get_optional_bool(parser, 'General', 'concurrent_stages', False)
+        self.hl7_stage_max_files = self.__get_optional_int(parser, 'General', 'hl7_stage_max_files', 0)
+        self.hl7_stage_max_seconds = self.__get_optional_float(parser, 'General', 'hl7_stage_max_seconds', 0)
+        self.ack_stage_max_files = self.__get_optional_int(parser, 'General', 'ack_stage_max_files', 0)
+        self.ack_stage_max_seconds = self.__get_optional_float(parser, 'General', 'ack_stage_max_seconds', 0)
+
+        # content-hash deduplication of HL7 messages and acks
+        self.dedup_policy = self.__get_optional_option(parser, 'General', 'dedup_policy', 'off').lower()
+        if self.dedup_policy not in ('off', 'skip', 'quarantine', 'forward'):
+            raise ValueError("dedup_policy has to be off, skip, quarantine or forward")
+        self.dedup_store_file = self.__get_optional_option(parser, 'General', 'dedup_store_file', None)
+        self.dedup_max_entries = self.__get_optional_int(parser, 'General', 'dedup_max_entries', 100000)
+        self.dedup_ttl = self.__get_optional_float(parser, 'General', 'dedup_ttl', 7 * 24 * 3600)
+
         tmp_folder = self.folder_localinbox
         if not os.path.exists(tmp_folder):
             os.makedirs(tmp_folder)
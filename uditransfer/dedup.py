@@ -0,0 +1,220 @@
+import sys
+import os
+import json
+import time
+import logging
+import threading
+import collections
+
+sys.path.append(".")
+
+try:
+    from . import util
+    from . import metrics
+except:
+    import util
+    import metrics
+
+# what happens to a file with the same content as one transferred before
+SKIP_POLICY = 'skip'
+QUARANTINE_POLICY = 'quarantine'
+FORWARD_POLICY = 'forward'
+POLICIES = [SKIP_POLICY, QUARANTINE_POLICY, FORWARD_POLICY]
+
+# kinds of files whose digests are kept apart
+HL7_DIGESTS = 'hl7'
+ACK_DIGESTS = 'ack'
+
+STORE_NAME = "dedup-store.json"
+
+# a transfer which didn't publish the file, because it's a duplicate
+DUPLICATE = 'duplicate'
+
+
+class dedup_store():
+    '''
+    sha256 digests of files transferred, with the file name and time they were first seen.
+    at most max_entries digests are kept, the oldest go first, and none is kept longer than ttl seconds.
+    '''
+    def __init__(self, store_file, max_entries=100000, ttl=7 * 24 * 3600):
+        self.store_file = store_file
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (kind, digest) -> (time, file name), oldest first
+        self.__entries = collections.OrderedDict()
+        self.__dirty = False
+        self.__lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not (self.store_file and os.path.exists(self.store_file)):
+            return
+
+        try:
+            with open(self.store_file, 'r') as store:
+                entries = json.load(store)
+            now = time.time()
+            for kind, digest, seen, file_name in entries:
+                if self.ttl <= 0 or now - seen <= self.ttl:
+                    self.__entries[(kind, digest)] = (seen, file_name)
+            logging.info("Loaded %d digest(s) from %s", len(self.__entries), self.store_file)
+        except Exception:
+            logging.exception("Unable to load dedup store:%s, starting with an empty one!", self.store_file)
+            self.__entries = collections.OrderedDict()
+
+    def save(self):
+        if not (self.store_file and self.__dirty):
+            return
+
+        with self.__lock:
+            entries = json.dumps([[kind, digest, seen, file_name]
+                                  for (kind, digest), (seen, file_name) in self.__entries.items()])
+            self.__dirty = False
+
+        temp_file = self.store_file + ".tmp"
+        with open(temp_file, 'w') as store:
+            store.write(entries)
+        util.replace_file(temp_file, self.store_file)
+
+    def get(self, kind, digest, now=None):
+        '''
+        :return: name of the file first seen with this digest, None if it's new or expired
+        '''
+        with self.__lock:
+            return self.__get(kind, digest, now or time.time())
+
+    def __get(self, kind, digest, now):
+        entry = self.__entries.get((kind, digest))
+        if entry is None:
+            return None
+        if self.ttl > 0 and now - entry[0] > self.ttl:
+            del self.__entries[(kind, digest)]
+            self.__dirty = True
+            return None
+        return entry[1]
+
+    def add(self, kind, digest, file_name, now=None):
+        '''
+        remember file_name by its digest, unless the digest is known already.
+        looking up and adding is one step, so of two workers with the same content only one gets None.
+        :return: name of the file first seen with this digest, None if file_name is the first one
+        '''
+        now = now or time.time()
+        with self.__lock:
+            first_name = self.__get(kind, digest, now)
+            if first_name is not None:
+                return first_name
+            self.__entries[(kind, digest)] = (now, file_name)
+            self.__dirty = True
+            while self.max_entries > 0 and len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+            return None
+
+    def discard(self, kind, digest, file_name):
+        '''
+        forget a digest added for file_name, e.g. because its transfer failed and will be retried
+        '''
+        with self.__lock:
+            entry = self.__entries.get((kind, digest))
+            if entry is not None and entry[1] == file_name:
+                del self.__entries[(kind, digest)]
+                self.__dirty = True
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+class dedup_check():
+    '''
+    choose_target of transfer.stream_copy for one file: the digest computed while copying is looked up
+    before the temp file is published, a duplicate is dropped, published into the quarantine folder
+    or forwarded anyway, depending on policy. a transfer which fails after the digest has been added
+    calls rollback, so the file isn't a duplicate of itself when it's retried.
+    '''
+    def __init__(self, store, kind, target_file, policy=SKIP_POLICY, quarantine_folder=None,
+                 metrics_registry=None):
+        self.store = store
+        self.kind = kind
+        self.target_file = target_file
+        self.policy = policy
+        self.quarantine_folder = quarantine_folder
+        self.metrics_registry = metrics_registry or metrics.null_registry()
+        self.duplicate_of = None
+        self.added_digest = None
+
+    def __call__(self, result):
+        file_name = os.path.basename(self.target_file)
+        first_name = self.store.add(self.kind, result.digest, file_name)
+        if first_name is None:
+            self.added_digest = result.digest
+            return self.target_file
+
+        self.duplicate_of = first_name
+        logging.warning("%s has the same content as %s transferred before, policy:%s",
+                        file_name, first_name, self.policy)
+        self.metrics_registry.inc(metrics.DUPLICATES_TOTAL, {'kind': self.kind, 'policy': self.policy})
+        if self.policy == FORWARD_POLICY:
+            return self.target_file
+        if self.policy == QUARANTINE_POLICY:
+            if not os.path.exists(self.quarantine_folder):
+                os.makedirs(self.quarantine_folder)
+            return os.path.join(self.quarantine_folder, file_name)
+        return None
+
+    def rollback(self):
+        if self.added_digest is not None:
+            self.store.discard(self.kind, self.added_digest, os.path.basename(self.target_file))
+            self.added_digest = None
+
+    @property
+    def dropped(self):
+        ''' True if the file hasn't been published as target_file, because it's a duplicate
+        '''
+        return self.duplicate_of is not None and self.policy != FORWARD_POLICY
+
+
+def get_store_file(my_config):
+    ''' every instance sharing the folders keeps its own store, so a duplicate is only caught by the instance
+    which transferred the first file. one store file isn't shared, each instance would overwrite the others.
+    '''
+    if my_config.dedup_store_file:
+        return my_config.dedup_store_file
+    if my_config.instance_id:
+        return os.path.join(my_config.folder_tobedeleted, "dedup-store-%s.json" % my_config.instance_id)
+    return os.path.join(my_config.folder_tobedeleted, STORE_NAME)
+
+
+def get_dedup_store(my_config):
+    '''
+    :return: the dedup store of this configuration, None unless dedup_policy is set
+    '''
+    if my_config.dedup_policy not in POLICIES:
+        return None
+
+    store = getattr(my_config, 'dedup_store', None)
+    if store is None:
+        store = dedup_store(get_store_file(my_config), my_config.dedup_max_entries, my_config.dedup_ttl)
+        my_config.dedup_store = store
+    return store
+
+
+def get_check(my_config, kind, target_file):
+    '''
+    :return: dedup_check of a file about to be transferred as target_file, None unless dedup_policy is set
+    '''
+    store = get_dedup_store(my_config)
+    if store is None:
+        return None
+    return dedup_check(store, kind, target_file, my_config.dedup_policy,
+                       os.path.join(my_config.folder_quarantine, 'duplicates', kind), metrics.get_metrics(my_config))
+
+
+def save(my_config):
+    store = get_dedup_store(my_config)
+    if store is None:
+        return
+
+    try:
+        store.save()
+    except (IOError, OSError) as e:
+        logging.error("Unable to save dedup store %s:%s", store.store_file, str(e))
@@ -0,0 +1,165 @@
+import sys
+import os
+import json
+import logging
+import threading
+import collections
+
+sys.path.append(".")
+
+try:
+    from . import util
+except:
+    import util
+
+
+def get_file_identity(file_name):
+    '''
+    :return: (absolute path, inode, size, mtime) of file_name, None if it doesn't exist
+    '''
+    try:
+        file_stat = os.stat(file_name)
+    except OSError:
+        return None
+    return os.path.abspath(file_name), file_stat.st_ino, file_stat.st_size, file_stat.st_mtime
+
+
+class verdict_cache():
+    '''
+    bounded, least recently used map from file identity to a verdict.
+    a file which is rewritten gets a new identity, so its old verdict is never returned.
+    '''
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, identity):
+        with self.__lock:
+            verdict = self.__entries.pop(identity, None)
+            if verdict is not None:
+                self.__entries[identity] = verdict
+            return verdict
+
+    def put(self, identity, verdict):
+        if self.max_entries <= 0:
+            return
+
+        with self.__lock:
+            self.__entries.pop(identity, None)
+            self.__entries[identity] = verdict
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+def get_hl7_verdict_cache(my_config):
+    cache = getattr(my_config, 'hl7_verdict_cache', None)
+    if cache is None:
+        cache = verdict_cache(my_config.hl7_validation_cache_size)
+        my_config.hl7_verdict_cache = cache
+    return cache
+
+
+class negative_orphan_cache():
+    '''
+    orphans which are not acks for CCM, keyed by file name. an entry keeps the identity
+    (path, inode, size, mtime) the file had when it was read, plus the ack type and ID found in it. the file is skipped without
+    being opened as long as it is unchanged and no flag exists that would make it match.
+    '''
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.__entries = {}
+        self.__dirty = False
+        self.__lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not (self.cache_file and os.path.exists(self.cache_file)):
+            return
+
+        try:
+            with open(self.cache_file, 'r') as cache:
+                entries = json.load(cache)
+            self.__entries = dict((name, (tuple(entry[0]), entry[1], entry[2]))
+                                  for name, entry in entries.items())
+            logging.info("Loaded %d orphan(s) not for CCM from %s", len(self.__entries), self.cache_file)
+        except Exception:
+            logging.exception("Unable to load negative orphan cache:%s, starting with an empty one!", self.cache_file)
+            self.__entries = {}
+
+    def save(self):
+        if not (self.cache_file and self.__dirty):
+            return
+
+        with self.__lock:
+            entries = dict((name, [list(entry[0]), entry[1], entry[2]]) for name, entry in self.__entries.items())
+            self.__dirty = False
+
+        temp_file = self.cache_file + ".tmp"
+        with open(temp_file, 'w') as cache:
+            json.dump(entries, cache)
+        util.replace_file(temp_file, self.cache_file)
+
+    def can_skip(self, file_name, identity, ack1_flag_files, ack2_flag_files, ack3_flag_files):
+        with self.__lock:
+            entry = self.__entries.get(file_name)
+        if entry is None:
+            return False
+
+        cached_identity, ack_type, correlation_id = entry
+        if cached_identity != identity:
+            self.forget(file_name)
+            return False
+
+        # any file is checked against ack1 flags by name first, then by the ID found in it
+        if file_name in ack1_flag_files:
+            self.forget(file_name)
+            return False
+        if ack_type == 'ACK2' and correlation_id in ack2_flag_files:
+            self.forget(file_name)
+            return False
+        if ack_type == 'ACK3' and correlation_id in ack3_flag_files:
+            self.forget(file_name)
+            return False
+
+        return True
+
+    def add(self, file_name, identity, ack_type, correlation_id):
+        with self.__lock:
+            self.__entries[file_name] = (identity, ack_type, correlation_id)
+            self.__dirty = True
+
+    def forget(self, file_name):
+        with self.__lock:
+            if self.__entries.pop(file_name, None) is not None:
+                self.__dirty = True
+
+    def evict_missing(self, existing_files):
+        ''' drop entries of files which are not in existing_files any more
+        '''
+        existing_files = set(existing_files)
+        with self.__lock:
+            for file_name in list(self.__entries.keys()):
+                if file_name not in existing_files:
+                    del self.__entries[file_name]
+                    self.__dirty = True
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+def get_negative_orphan_cache(my_config):
+    '''
+    :return: the negative orphan cache of this configuration, None if orphan_negative_cache_file is not set
+    '''
+    if not my_config.orphan_negative_cache_file:
+        return None
+
+    cache = getattr(my_config, 'negative_orphan_cache', None)
+    if cache is None:
+        cache = negative_orphan_cache(my_config.orphan_negative_cache_file)
+        my_config.negative_orphan_cache = cache
+    return cache
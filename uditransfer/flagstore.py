@@ -0,0 +1,493 @@
+import sys
+import os
+import time
+import logging
+import argparse
+import threading
+import sqlite3
+import hashlib
+
+sys.path.append(".")
+
+try:
+    from . import util
+    from . import configuration
+except:
+    import util
+    import configuration
+
+ACK1_FLAG = 'ack1'
+ACK2_FLAG = 'ack2'
+ACK3_FLAG = 'ack3'
+FLAG_KINDS = [ACK1_FLAG, ACK2_FLAG, ACK3_FLAG]
+
+# seconds the flag counts of a sharded folder are kept up to date by add and remove, before every subfolder
+# is listed again to pick up flags of other instances
+COUNT_MAX_AGE = 3600
+
+
+def get_flag_folder(my_config, kind):
+    return {ACK1_FLAG: my_config.folder_ack1flag,
+            ACK2_FLAG: my_config.folder_ack2flag,
+            ACK3_FLAG: my_config.folder_ack3flag}[kind]
+
+
+def get_shard(name, shard_depth):
+    ''' hash prefix subfolders of a flag, two hex digits per level: 3f/a2 for shard_depth 2
+    '''
+    if not isinstance(name, bytes):
+        name = name.encode('utf-8')
+    digest = hashlib.md5(name).hexdigest()
+    return [digest[level * 2:level * 2 + 2] for level in range(shard_depth)]
+
+
+class folder_flag_store():
+    '''
+    flags as files in folder_ack1flag, folder_ack2flag and folder_ack3flag, the original layout.
+    with shard_depth above 0, every flag lives in hash prefix subfolders (256 per level) of its flag folder,
+    so no single folder grows beyond a few thousand entries. flags still in the flat layout are found too,
+    migrate moves them into their subfolders a batch at a time while the monitor keeps running.
+    counting the flags of a sharded folder lists every subfolder once, add and remove keep the count after that.
+    '''
+    uses_folders = True
+
+    def __init__(self, my_config, shard_depth=0):
+        self.my_config = my_config
+        self.shard_depth = shard_depth
+        self.generation = 0
+        # flags in subfolders don't show up as events on the flag folders
+        self.uses_folders = shard_depth <= 0
+        self.__shard_folders = set()
+        # no flat flags are looked for once migrate found none left
+        self.__flat_flags_left = shard_depth > 0
+        # kind -> [number of flags, time they have been listed]
+        self.__counts = {}
+        self.__lock = threading.Lock()
+
+    def describe(self, kind, name):
+        if self.shard_depth <= 0:
+            return os.path.join(get_flag_folder(self.my_config, kind), name)
+        return os.path.join(get_flag_folder(self.my_config, kind), *(get_shard(name, self.shard_depth) + [name]))
+
+    def describe_flat(self, kind, name):
+        return os.path.join(get_flag_folder(self.my_config, kind), name)
+
+    def prepare(self, kind, name):
+        '''
+        :return: file name of the flag, its subfolders are created if needed
+        '''
+        flag_file = self.describe(kind, name)
+        if self.shard_depth > 0:
+            shard_folder = os.path.dirname(flag_file)
+            with self.__lock:
+                known = shard_folder in self.__shard_folders
+            if not known:
+                try:
+                    os.makedirs(shard_folder)
+                except OSError:
+                    if not os.path.isdir(shard_folder):
+                        raise
+                with self.__lock:
+                    self.__shard_folders.add(shard_folder)
+        return flag_file
+
+    def create_ack1_flag(self, hl7_file, src_file):
+        ''' ack1 flag is an empty file of its own, a link would change along with the HL7 message
+        '''
+        self.add(ACK1_FLAG, hl7_file)
+        return self.describe(ACK1_FLAG, hl7_file)
+
+    def add(self, kind, name, parent=None, created=None):
+        flag_file = self.prepare(kind, name)
+        new_flag = self.__is_counted(kind) and not os.path.exists(flag_file)
+        util.touch(flag_file)
+        self.generation += 1
+        if new_flag:
+            self.__add_count(kind, 1)
+
+    def remove(self, kind, name):
+        try:
+            os.remove(self.describe(kind, name))
+        except OSError:
+            if not self.__flat_flags_left or not os.path.exists(self.describe_flat(kind, name)):
+                raise
+            # not migrated yet
+            os.remove(self.describe_flat(kind, name))
+        if self.__is_counted(kind):
+            self.__add_count(kind, -1)
+
+    def count(self, kind, now=None):
+        '''
+        :return: number of flags of this kind
+        '''
+        if self.shard_depth <= 0:
+            return len(self.list_names(kind))
+
+        now = now or time.time()
+        with self.__lock:
+            count = self.__counts.get(kind)
+            if count is not None and now - count[1] < COUNT_MAX_AGE:
+                return count[0]
+        count = [len(self.list_names(kind)), now]
+        with self.__lock:
+            self.__counts[kind] = count
+        return count[0]
+
+    def __is_counted(self, kind):
+        with self.__lock:
+            return kind in self.__counts
+
+    def __add_count(self, kind, delta):
+        with self.__lock:
+            count = self.__counts.get(kind)
+            if count is not None:
+                count[0] = max(0, count[0] + delta)
+
+    def find(self, kind, name):
+        '''
+        :return: file name of the flag in the sharded or the flat layout, None if there is no such flag
+        '''
+        flag_file = self.describe(kind, name)
+        if os.path.exists(flag_file):
+            return flag_file
+        if self.__flat_flags_left:
+            flag_file = self.describe_flat(kind, name)
+            if os.path.exists(flag_file):
+                return flag_file
+        return None
+
+    def contains(self, kind, name):
+        return self.find(kind, name) is not None
+
+    def list_names(self, kind):
+        folder = get_flag_folder(self.my_config, kind)
+        names = util.get_file_list(folder)
+        if self.shard_depth > 0:
+            for shard_folder in iter_shard_folders(folder, self.shard_depth):
+                names.extend(util.get_file_list(shard_folder))
+        return names
+
+    def names(self, kind):
+        if self.shard_depth <= 0:
+            return set(util.get_file_list(get_flag_folder(self.my_config, kind)))
+        # listing every subfolder on every pass would undo the point of sharding
+        return sharded_flag_names(self, kind)
+
+    def migrate(self, batch_size=0):
+        '''
+        move flags of the flat layout into their subfolders, lookups find them before and after the move.
+        :param batch_size: flags moved at most, 0 means all of them
+        :return: number of flags moved
+        '''
+        if self.shard_depth <= 0:
+            return 0
+
+        moved = 0
+        for kind in FLAG_KINDS:
+            for name in util.get_file_list(get_flag_folder(self.my_config, kind)):
+                if batch_size > 0 and moved >= batch_size:
+                    return moved
+                flag_file = self.prepare(kind, name)
+                util.replace_file(self.describe_flat(kind, name), flag_file)
+                moved += 1
+        if moved:
+            logging.info("Moved %d flag(s) into shard subfolders", moved)
+        else:
+            self.__flat_flags_left = False
+        return moved
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def iter_shard_folders(folder, shard_depth):
+    ''' leaf subfolders of a sharded flag folder
+    '''
+    if shard_depth <= 0:
+        yield folder
+        return
+    try:
+        entries = sorted(os.listdir(folder))
+    except OSError:
+        return
+    for entry in entries:
+        subfolder = os.path.join(folder, entry)
+        if len(entry) == 2 and os.path.isdir(subfolder):
+            for leaf_folder in iter_shard_folders(subfolder, shard_depth - 1):
+                yield leaf_folder
+
+
+class sharded_flag_names():
+    ''' set like view on the flags of one kind in a sharded folder, every lookup is one stat of its file,
+    its length is the count kept by the store
+    '''
+    def __init__(self, store, kind):
+        self.store = store
+        self.kind = kind
+
+    def __contains__(self, name):
+        return self.store.contains(self.kind, name)
+
+    def __iter__(self):
+        return iter(self.store.list_names(self.kind))
+
+    def __len__(self):
+        return self.store.count(self.kind)
+
+    def __repr__(self):
+        return "<%s flag(s) in %s, sharded>" % (self.kind, get_flag_folder(self.store.my_config, self.kind))
+
+
+class indexed_flag_names():
+    ''' set like view on the pending flags of one kind, every lookup is one primary key query
+    '''
+    def __init__(self, store, kind):
+        self.store = store
+        self.kind = kind
+
+    def __contains__(self, name):
+        return self.store.contains(self.kind, name)
+
+    def __iter__(self):
+        return iter(self.store.list_names(self.kind))
+
+    def __len__(self):
+        return self.store.count(self.kind)
+
+    def __repr__(self):
+        return "<%d %s flag(s) in %s>" % (len(self), self.kind, self.store.index_file)
+
+
+class index_flag_store():
+    '''
+    flags as rows of a SQLite database in WAL mode. a row keeps the name it has been created
+    with and the name of the previous stage (HL7 name -> message ID -> core ID), so the
+    correlation of a submission is kept after its flags are gone.
+    '''
+    uses_folders = False
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.generation = 0
+        self.__lock = threading.RLock()
+
+        index_folder = os.path.dirname(os.path.abspath(index_file))
+        if not os.path.exists(index_folder):
+            os.makedirs(index_folder)
+
+        self.__connection = sqlite3.connect(index_file, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        # commits are written to the WAL without fsync, the fsync happens once per checkpoint.
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS flags ("
+                                  "kind TEXT NOT NULL, "
+                                  "name TEXT NOT NULL, "
+                                  "parent TEXT, "
+                                  "created REAL NOT NULL, "
+                                  "removed REAL, "
+                                  "PRIMARY KEY (kind, name))")
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS flags_parent ON flags (parent)")
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS flags_removed ON flags (removed)")
+        self.__connection.commit()
+        self.last_purge = 0
+
+    def describe(self, kind, name):
+        return "%s:%s/%s" % (self.index_file, kind, name)
+
+    def create_ack1_flag(self, hl7_file, src_file):
+        self.add(ACK1_FLAG, hl7_file)
+        return self.describe(ACK1_FLAG, hl7_file)
+
+    def add(self, kind, name, parent=None, created=None):
+        with self.__lock:
+            self.__connection.execute("INSERT OR REPLACE INTO flags (kind, name, parent, created, removed) "
+                                      "VALUES (?, ?, ?, ?, NULL)",
+                                      (kind, name, parent, created or time.time()))
+            self.generation += 1
+
+    def remove(self, kind, name):
+        with self.__lock:
+            cursor = self.__connection.execute("UPDATE flags SET removed = ? "
+                                               "WHERE kind = ? AND name = ? AND removed IS NULL",
+                                               (time.time(), kind, name))
+            if cursor.rowcount == 0:
+                raise OSError("No %s flag:%s in %s" % (kind, name, self.index_file))
+
+    def contains(self, kind, name):
+        with self.__lock:
+            cursor = self.__connection.execute("SELECT 1 FROM flags "
+                                               "WHERE kind = ? AND name = ? AND removed IS NULL",
+                                               (kind, name))
+            return cursor.fetchone() is not None
+
+    def list_names(self, kind):
+        with self.__lock:
+            cursor = self.__connection.execute("SELECT name FROM flags WHERE kind = ? AND removed IS NULL",
+                                               (kind,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def count(self, kind):
+        with self.__lock:
+            cursor = self.__connection.execute("SELECT COUNT(*) FROM flags WHERE kind = ? AND removed IS NULL",
+                                               (kind,))
+            return cursor.fetchone()[0]
+
+    def names(self, kind):
+        return indexed_flag_names(self, kind)
+
+    def get_parent(self, kind, name):
+        with self.__lock:
+            cursor = self.__connection.execute("SELECT parent FROM flags WHERE kind = ? AND name = ?",
+                                               (kind, name))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def purge(self, max_age, now=None):
+        '''
+        delete rows of flags removed more than max_age seconds ago, their correlation is dropped with them.
+        :return: number of rows deleted
+        '''
+        now = now or time.time()
+        with self.__lock:
+            cursor = self.__connection.execute("DELETE FROM flags WHERE removed IS NOT NULL AND removed < ?",
+                                               (now - max_age,))
+            self.__connection.commit()
+            self.last_purge = now
+            return cursor.rowcount
+
+    def commit(self):
+        ''' make every change since the last commit durable in one transaction
+        '''
+        with self.__lock:
+            self.__connection.commit()
+
+    def close(self):
+        with self.__lock:
+            self.__connection.commit()
+            self.__connection.close()
+
+
+def get_flag_store(my_config):
+    '''
+    :return: the flag store of this configuration, the SQLite index if flag_index_file is set, folders otherwise
+    '''
+    flag_store = getattr(my_config, 'flag_store', None)
+    if flag_store is None:
+        if my_config.flag_index_file:
+            flag_store = index_flag_store(my_config.flag_index_file)
+        else:
+            flag_store = folder_flag_store(my_config, my_config.flag_shard_depth)
+        my_config.flag_store = flag_store
+    return flag_store
+
+
+def migrate_flat_flags(my_config):
+    '''
+    move the next flag_shard_migration_batch flags of the flat layout into shard subfolders.
+    :return: number of flags moved
+    '''
+    if my_config.flag_index_file or my_config.flag_shard_depth <= 0:
+        return 0
+    return get_flag_store(my_config).migrate(my_config.flag_shard_migration_batch)
+
+
+def purge_removed_flags(my_config, interval=3600):
+    '''
+    delete rows of the flag index removed more than flag_index_retention seconds ago,
+    on the first call and then at most once every interval seconds.
+    :return: number of rows deleted
+    '''
+    if not my_config.flag_index_file or my_config.flag_index_retention <= 0:
+        return 0
+    index_store = get_flag_store(my_config)
+    if time.time() - index_store.last_purge < interval:
+        return 0
+    purged = index_store.purge(my_config.flag_index_retention)
+    if purged:
+        logging.info("Purged %d removed flag(s) from %s", purged, index_store.index_file)
+    return purged
+
+
+def import_flag_folders(my_config, index_store, batch_size=10000):
+    '''
+    copy every flag file into the index, the flag files are left in place.
+    :return: number of imported flags
+    '''
+    imported = 0
+    folder_store = folder_flag_store(my_config, my_config.flag_shard_depth)
+    for kind in FLAG_KINDS:
+        folder = get_flag_folder(my_config, kind)
+        for name in folder_store.list_names(kind):
+            created = os.path.getmtime(folder_store.find(kind, name))
+            index_store.add(kind, name, created=created)
+            imported += 1
+            if imported % batch_size == 0:
+                index_store.commit()
+        logging.info("Imported %s flags from %s", kind, folder)
+
+    index_store.commit()
+    return imported
+
+
+def export_flag_folders(my_config, index_store):
+    '''
+    write an empty flag file for every pending flag of the index, so the folder layout can be used again.
+    :return: number of exported flags
+    '''
+    exported = 0
+    folder_store = folder_flag_store(my_config, my_config.flag_shard_depth)
+    for kind in FLAG_KINDS:
+        folder = get_flag_folder(my_config, kind)
+        for name in index_store.list_names(kind):
+            if not folder_store.contains(kind, name):
+                util.touch(folder_store.prepare(kind, name))
+            exported += 1
+        logging.info("Exported %s flags to %s", kind, folder)
+
+    return exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate ack flags between flag folders and flag index')
+    parser.add_argument('-c', action="store", dest="configuration", required=True,
+                        help="configuration file")
+    parser.add_argument('--import', action="store_true", dest="import_flags", default=False,
+                        help="import flag folders into flag_index_file")
+    parser.add_argument('--export', action="store_true", dest="export_flags", default=False,
+                        help="write pending flags of flag_index_file back into flag folders")
+    parser.add_argument('--shard', action="store_true", dest="shard_flags", default=False,
+                        help="move every flat flag file into the subfolders of flag_shard_depth")
+
+    args = parser.parse_args()
+    my_config = configuration.monitor_configuration(args.configuration)
+    util.initialize_logger(my_config.folder_logs, my_config.stdout_log, my_config.all_file_log,
+                           my_config.log_max_bytes, my_config.log_async, my_config.log_payload_max_bytes)
+
+    if args.shard_flags:
+        if my_config.flag_shard_depth <= 0:
+            sys.exit("flag_shard_depth is not set in configuration file!")
+        folder_store = folder_flag_store(my_config, my_config.flag_shard_depth)
+        logging.info("Moved %d flag(s) into shard subfolders", folder_store.migrate())
+
+    if not (args.import_flags or args.export_flags):
+        return
+    if not my_config.flag_index_file:
+        sys.exit("flag_index_file is not set in configuration file!")
+
+    index_store = index_flag_store(my_config.flag_index_file)
+    try:
+        if args.import_flags:
+            logging.info("Imported %d flag(s) into %s", import_flag_folders(my_config, index_store),
+                         my_config.flag_index_file)
+        if args.export_flags:
+            logging.info("Exported %d flag(s) from %s", export_flag_folders(my_config, index_store),
+                         my_config.flag_index_file)
+    finally:
+        index_store.close()
+
+
+if __name__=='__main__':
+    main()
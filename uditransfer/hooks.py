@@ -0,0 +1,272 @@
+import sys
+import os
+import time
+import shlex
+import signal
+import logging
+import threading
+import subprocess
+import collections
+
+sys.path.append(".")
+
+try:
+    from . import metrics
+except:
+    import metrics
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+TARGET = '&target'
+
+# shell syntax which a command run without a shell passes on as plain arguments
+SHELL_SYNTAX = ['|', '>', '<', '&&', ';', '$', '`', '*', '?']
+
+hook_result = collections.namedtuple('hook_result', ['command', 'target_files', 'return_code', 'duration',
+                                                     'timed_out'])
+
+
+def build_command(command, target_files, use_shell=False):
+    '''
+    replace &target by the absolute path of every target file.
+    without shell the command is split into an argument list, and an argument containing &target is
+    repeated once per target file. with shell every path is quoted into the command line as before.
+    :return: argument list, or a command line if use_shell
+    '''
+    command = command.replace('"', '')
+    target_paths = [os.path.abspath(target_file) for target_file in target_files]
+    if use_shell:
+        return command.replace(TARGET, " ".join('"' + target_path + '"' for target_path in target_paths))
+
+    argv = []
+    for argument in shlex.split(command):
+        if TARGET in argument:
+            argv.extend(argument.replace(TARGET, target_path) for target_path in target_paths)
+        else:
+            argv.append(argument)
+    return argv
+
+
+def find_shell_syntax(command):
+    '''
+    :return: first shell syntax found in command, None if it runs the same without a shell
+    '''
+    command = command.replace(TARGET, '')
+    for syntax in SHELL_SYNTAX:
+        if syntax in command:
+            return syntax
+    return None
+
+
+def run_command(command, target_files, timeout=0, use_shell=False):
+    '''
+    run one hook for target_files and wait for it, killing it after timeout seconds.
+    :param timeout: 0 means no limit
+    :return: hook_result, return_code is None if it couldn't be started
+    '''
+    args = build_command(command, target_files, use_shell)
+    # in a session of its own, a timeout kills the shell and everything it started
+    own_session = getattr(os, 'setsid', None)
+    start = time.time()
+    try:
+        process = subprocess.Popen(args, shell=use_shell, preexec_fn=own_session)
+    except OSError as e:
+        logging.error("Unable to execute command:%s, %s", command, str(e))
+        return hook_result(command, target_files, None, time.time() - start, False)
+
+    timed_out = []
+    timer = None
+    if timeout > 0:
+        def kill():
+            timed_out.append(True)
+            try:
+                if own_session is not None:
+                    os.killpg(process.pid, signal.SIGKILL)
+                else:
+                    process.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        return_code = process.wait()
+    finally:
+        if timer:
+            timer.cancel()
+
+    return hook_result(command, target_files, return_code, time.time() - start, bool(timed_out))
+
+
+class hook_statistics():
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_return_code = None
+
+
+class hook_executor():
+    '''
+    runs hl7/ack operation hooks for transferred files.
+    with worker_count 0 hooks run in the calling thread right away, as they always did. otherwise
+    they are queued to worker_count threads and the transfer goes on without waiting for them.
+    with batch_size above 1, target files are collected and handed to one invocation per batch.
+    the commands of one batch always run in their configured order.
+    '''
+    def __init__(self, worker_count=0, timeout=0, use_shell=False, batch_size=1, metrics_registry=None):
+        self.worker_count = worker_count
+        self.timeout = timeout
+        self.use_shell = use_shell
+        self.batch_size = max(1, batch_size)
+        self.metrics_registry = metrics_registry or metrics.null_registry()
+        self.__pending = collections.OrderedDict()
+        self.__statistics = collections.OrderedDict()
+        self.__queue = queue.Queue()
+        self.__threads = []
+        self.__lock = threading.Lock()
+
+    def submit(self, command_list, target_file):
+        if not command_list:
+            return
+
+        key = tuple(command_list)
+        with self.__lock:
+            target_files = self.__pending.setdefault(key, [])
+            target_files.append(target_file)
+            if len(target_files) < self.batch_size:
+                return
+            del self.__pending[key]
+
+        self.__dispatch(key, target_files)
+
+    def flush(self):
+        ''' hand every partial batch over, called at the end of each pass
+        '''
+        with self.__lock:
+            pending = list(self.__pending.items())
+            self.__pending.clear()
+
+        for key, target_files in pending:
+            self.__dispatch(key, target_files)
+
+    def wait(self):
+        ''' flush and wait until every queued hook has finished
+        '''
+        self.flush()
+        if self.__threads:
+            self.__queue.join()
+
+    def close(self):
+        self.wait()
+        for _ in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+        self.log_statistics()
+
+    def __dispatch(self, command_list, target_files):
+        if self.worker_count <= 0:
+            self.run_commands(command_list, target_files)
+            return
+
+        with self.__lock:
+            while len(self.__threads) < self.worker_count:
+                thread = threading.Thread(target=self.__worker, name="hook-%d" % len(self.__threads))
+                thread.daemon = True
+                thread.start()
+                self.__threads.append(thread)
+
+        self.__queue.put((command_list, target_files))
+
+    def __worker(self):
+        while True:
+            task = self.__queue.get()
+            try:
+                if task is None:
+                    return
+                self.run_commands(*task)
+            except Exception:
+                logging.exception("Unexpected error in hook for:%s", str(task))
+            finally:
+                self.__queue.task_done()
+
+    def run_commands(self, command_list, target_files):
+        results = []
+        for command in command_list:
+            result = run_command(command, target_files, self.timeout, self.use_shell)
+            self.record(result)
+            results.append(result)
+        return results
+
+    def record(self, result):
+        with self.__lock:
+            statistics = self.__statistics.setdefault(result.command, hook_statistics())
+            statistics.runs += 1
+            statistics.total_seconds += result.duration
+            statistics.max_seconds = max(statistics.max_seconds, result.duration)
+            statistics.last_return_code = result.return_code
+            if result.return_code != 0:
+                statistics.failures += 1
+            if result.timed_out:
+                statistics.timeouts += 1
+
+        self.metrics_registry.observe(metrics.STAGE_SECONDS, result.duration, {'stage': 'hook'})
+        if result.return_code != 0:
+            self.metrics_registry.inc(metrics.ERRORS_TOTAL, {'stage': 'hook'})
+
+        if result.timed_out:
+            logging.error("Command:%s has been killed after %.3fs for %d file(s)",
+                          result.command, result.duration, len(result.target_files))
+        elif result.return_code == 0:
+            logging.info("Successfully executed command:%s in %.3fs for %d file(s)",
+                         result.command, result.duration, len(result.target_files))
+        elif result.return_code is not None:
+            logging.info("Returned value is: %d from command:%s in %.3fs",
+                         result.return_code, result.command, result.duration)
+
+    def statistics(self):
+        '''
+        :return: dict of command -> (runs, failures, timeouts, total seconds, max seconds, last return code)
+        '''
+        with self.__lock:
+            return dict((command, (s.runs, s.failures, s.timeouts, s.total_seconds, s.max_seconds,
+                                   s.last_return_code))
+                        for command, s in self.__statistics.items())
+
+    def log_statistics(self):
+        for command, (runs, failures, timeouts, total_seconds, max_seconds, last_return_code) \
+                in self.statistics().items():
+            logging.info("Command:%s ran %d time(s), %d failed, %d timed out, %.3fs average, %.3fs max",
+                         command, runs, failures, timeouts, total_seconds / runs, max_seconds)
+
+
+def get_hook_executor(my_config):
+    executor = getattr(my_config, 'hook_executor', None)
+    if executor is None:
+        if not my_config.hook_use_shell:
+            for command in my_config.hl7_operation_shell_commands + my_config.ack_operation_shell_commands:
+                syntax = find_shell_syntax(command)
+                if syntax:
+                    logging.warning("Command:%s contains %s, which doesn't work with hook_use_shell = false!",
+                                    command, syntax)
+        executor = hook_executor(my_config.hook_worker_count, my_config.hook_timeout,
+                                 my_config.hook_use_shell, my_config.hook_batch_size,
+                                 metrics.get_metrics(my_config))
+        my_config.hook_executor = executor
+    return executor
+
+
+def close_hook_executor(my_config):
+    ''' wait for queued hooks before the process ends, worker threads don't keep it alive
+    '''
+    executor = getattr(my_config, 'hook_executor', None)
+    if executor is not None:
+        executor.close()
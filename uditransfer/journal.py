@@ -0,0 +1,218 @@
+import sys
+import os
+import json
+import logging
+import threading
+
+sys.path.append(".")
+
+try:
+    from . import util
+except:
+    import util
+
+JOURNAL_NAME = "handoff.journal"
+
+BEGIN = 'begin'
+DONE = 'done'
+
+# steps of one ACK hand-off, in order. a crash after any of them is recovered by replaying the journal.
+BEGUN_STEP = 'begun'
+TRANSFERRED_STEP = 'transferred'
+FLAG_ADDED_STEP = 'flag_added'
+SOURCE_REMOVED_STEP = 'source_removed'
+FLAG_REMOVED_STEP = 'flag_removed'
+STEPS = [BEGUN_STEP, TRANSFERRED_STEP, FLAG_ADDED_STEP, SOURCE_REMOVED_STEP, FLAG_REMOVED_STEP]
+
+# called with the name of every step reached, fault injection tests kill the process from here
+step_hook = None
+
+
+def reached(step):
+    if step_hook is not None:
+        step_hook(step)
+
+
+class handoff_journal():
+    '''
+    append-only journal of ACK hand-offs: one begin record before anything is transferred, one done record
+    after the source and the old flag are gone. begin records are durable before they return, the fsync is
+    shared by every thread waiting at the same time (group commit) and commit_delay seconds can be spent
+    waiting for more of them. done records are handed to the os right away, the next group commit or
+    checkpoint makes them durable. checkpoint rewrites the file with only the hand-offs still open.
+    '''
+    def __init__(self, journal_file, commit_delay=0.0):
+        self.journal_file = journal_file
+        self.commit_delay = commit_delay
+        self.syncs = 0
+        self.__lock = threading.Lock()
+        self.__synced = threading.Condition(self.__lock)
+        self.__syncing = False
+        # records appended, and how many of them are known to be durable
+        self.__appended = 0
+        self.__durable = 0
+
+        journal_folder = os.path.dirname(os.path.abspath(journal_file))
+        if not os.path.exists(journal_folder):
+            os.makedirs(journal_folder)
+
+        self.__open_records, self.__next_seq = load_journal(journal_file)
+        # the file holds done hand-offs, which checkpoint can drop
+        self.__closed = os.path.exists(journal_file) and os.path.getsize(journal_file) > 0
+        self.__stream = open(journal_file, 'a')
+
+    def open_records(self):
+        ''' begin records without done record, in the order they began
+        '''
+        with self.__lock:
+            return [self.__open_records[seq] for seq in sorted(self.__open_records)]
+
+    def begin(self, record):
+        '''
+        :param record: dict describing the hand-off, kept as it is
+        :return: sequence number to pass to done
+        '''
+        with self.__lock:
+            seq = self.__next_seq
+            self.__next_seq += 1
+            record = dict(record, seq=seq, op=BEGIN)
+            self.__append(record)
+            self.__open_records[seq] = record
+            ticket = self.__appended
+
+        self.__wait_durable(ticket)
+        return seq
+
+    def done(self, seq):
+        with self.__lock:
+            self.__append({'seq': seq, 'op': DONE})
+            self.__stream.flush()
+            self.__open_records.pop(seq, None)
+            self.__closed = True
+
+    def checkpoint(self):
+        '''
+        drop the done hand-offs from the journal: the begin records still open are written into a new file,
+        which replaces the journal once it's durable.
+        :return: True if every hand-off is done and the journal is empty now
+        '''
+        with self.__synced:
+            # a group commit syncs the stream about to be replaced
+            while self.__syncing:
+                self.__synced.wait()
+
+            if self.__closed:
+                temp_file = self.journal_file + ".tmp"
+                with open(temp_file, 'w') as temp_stream:
+                    for seq in sorted(self.__open_records):
+                        temp_stream.write(json.dumps(self.__open_records[seq], sort_keys=True) + "\n")
+                    temp_stream.flush()
+                    os.fsync(temp_stream.fileno())
+                self.__stream.close()
+                util.replace_file(temp_file, self.journal_file)
+                self.__stream = open(self.journal_file, 'a')
+                # everything appended so far is either dropped or in the durable new file
+                self.__durable = self.__appended
+                self.__closed = False
+            return not self.__open_records
+
+    def close(self):
+        with self.__lock:
+            self.__stream.flush()
+            os.fsync(self.__stream.fileno())
+            self.__stream.close()
+
+    def __append(self, record):
+        self.__stream.write(json.dumps(record, sort_keys=True) + "\n")
+        self.__appended += 1
+
+    def __wait_durable(self, ticket):
+        with self.__synced:
+            while self.__durable < ticket:
+                if self.__syncing:
+                    # another thread is syncing, our record might be part of it
+                    self.__synced.wait()
+                    continue
+
+                self.__syncing = True
+                if self.commit_delay > 0:
+                    # let other threads append their records into the same fsync
+                    self.__synced.wait(self.commit_delay)
+                try:
+                    target = self.__appended
+                    self.__stream.flush()
+                    file_descriptor = self.__stream.fileno()
+                    self.__lock.release()
+                    try:
+                        os.fsync(file_descriptor)
+                    finally:
+                        self.__lock.acquire()
+                    self.syncs += 1
+                    self.__durable = max(self.__durable, target)
+                finally:
+                    self.__syncing = False
+                    self.__synced.notify_all()
+
+
+def load_journal(journal_file):
+    '''
+    read the journal left behind, a torn last line of a crashed write is cut off.
+    :return: (dict of seq -> begin record without done record, next sequence number)
+    '''
+    open_records = {}
+    next_seq = 1
+    if not os.path.exists(journal_file):
+        return open_records, next_seq
+
+    with open(journal_file, 'rb') as journal_stream:
+        content = journal_stream.read()
+
+    complete_length = content.rfind(b"\n") + 1
+    if complete_length < len(content):
+        logging.warning("Cutting off %d bytes of a torn record at the end of %s",
+                        len(content) - complete_length, journal_file)
+        with open(journal_file, 'r+b') as journal_stream:
+            journal_stream.truncate(complete_length)
+
+    for line in content[:complete_length].splitlines():
+        try:
+            record = json.loads(line.decode('utf-8'))
+            seq = record['seq']
+        except (ValueError, KeyError, TypeError):
+            logging.warning("Skipping unreadable record in %s:%s", journal_file, line)
+            continue
+
+        next_seq = max(next_seq, seq + 1)
+        if record.get('op') == BEGIN:
+            open_records[seq] = record
+        elif record.get('op') == DONE:
+            open_records.pop(seq, None)
+    return open_records, next_seq
+
+
+def get_journal_file(my_config):
+    ''' every instance sharing the folders keeps its own journal
+    '''
+    if my_config.journal_file:
+        return my_config.journal_file
+    if my_config.instance_id:
+        return os.path.join(my_config.folder_tobedeleted, "handoff-%s.journal" % my_config.instance_id)
+    return os.path.join(my_config.folder_tobedeleted, JOURNAL_NAME)
+
+
+def get_journal(my_config):
+    '''
+    :return: the hand-off journal of this configuration
+    '''
+    journal = getattr(my_config, 'handoff_journal', None)
+    if journal is None:
+        journal = handoff_journal(get_journal_file(my_config), my_config.journal_commit_delay)
+        my_config.handoff_journal = journal
+    return journal
+
+
+def close_journal(my_config):
+    journal = getattr(my_config, 'handoff_journal', None)
+    if journal is not None:
+        journal.close()
+        my_config.handoff_journal = None
@@ -0,0 +1,224 @@
+import sys
+import os
+import math
+import time
+import json
+import logging
+import argparse
+import threading
+
+sys.path.append(".")
+
+try:
+    from . import configuration
+except:
+    import configuration
+
+# stages of one submission, in the order they complete
+HL7_STAGE = 'HL7'
+ACK1_STAGE = 'ACK1'
+ACK2_STAGE = 'ACK2'
+ACK3_STAGE = 'ACK3'
+STAGES = [HL7_STAGE, ACK1_STAGE, ACK2_STAGE, ACK3_STAGE]
+
+# latencies reported, each from the first stage to the second
+INTERVALS = [(HL7_STAGE, ACK1_STAGE), (ACK1_STAGE, ACK2_STAGE), (ACK2_STAGE, ACK3_STAGE), (HL7_STAGE, ACK3_STAGE)]
+
+PERCENTILES = [50, 90, 99]
+
+
+class latency_recorder():
+    '''
+    appends one line per completed stage to log_file: time, stage, key and the key of the next stage.
+    keys are the ones the flags use: HL7 file name -> message ID -> core ID.
+    lines are only ever appended, the log is read back by load_latencies.
+    '''
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.__lock = threading.Lock()
+
+        log_folder = os.path.dirname(os.path.abspath(log_file))
+        if not os.path.exists(log_folder):
+            os.makedirs(log_folder)
+        self.__stream = open(log_file, 'a')
+
+    def record(self, stage, key, next_key=None, timestamp=None):
+        line = "%.3f\t%s\t%s\t%s\n" % (timestamp or time.time(), stage, key, next_key or '')
+        with self.__lock:
+            self.__stream.write(line)
+            self.__stream.flush()
+
+    def close(self):
+        with self.__lock:
+            self.__stream.close()
+
+
+def get_latency_recorder(my_config):
+    '''
+    :return: the latency recorder of this configuration, None if latency_log_file is not set
+    '''
+    if not my_config.latency_log_file:
+        return None
+
+    recorder = getattr(my_config, 'latency_recorder', None)
+    if recorder is None:
+        recorder = latency_recorder(my_config.latency_log_file)
+        my_config.latency_recorder = recorder
+    return recorder
+
+
+def record(my_config, stage, key, next_key=None):
+    ''' record a completed stage, nothing happens unless latency_log_file is set
+    '''
+    recorder = get_latency_recorder(my_config)
+    if recorder is None or not key:
+        return
+
+    try:
+        recorder.record(stage, key, next_key)
+    except (IOError, OSError) as e:
+        logging.error("Unable to record %s of %s into %s:%s", stage, key, recorder.log_file, str(e))
+
+
+class latency_report():
+    def __init__(self):
+        self.latencies = dict((interval, []) for interval in INTERVALS)
+        # submissions without ACK3 yet: HL7 file name -> {stage: time}
+        self.open_submissions = {}
+        self.completed = 0
+
+
+def load_latencies(log_file):
+    '''
+    read the log once, keeping only submissions which are not complete yet in memory.
+    :return: latency_report
+    '''
+    report = latency_report()
+    submission_of_key = {}
+
+    with open(log_file, 'r') as log_stream:
+        for line in log_stream:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 4:
+                continue
+            try:
+                timestamp = float(fields[0])
+            except ValueError:
+                continue
+            stage, key, next_key = fields[1], fields[2], fields[3]
+
+            if stage == HL7_STAGE:
+                submission = key
+                report.open_submissions[submission] = {HL7_STAGE: timestamp}
+                # ACK1 comes back under the HL7 file name
+                submission_of_key[key] = submission
+            else:
+                submission = submission_of_key.pop(key, None)
+                stage_times = report.open_submissions.get(submission)
+                if stage_times is None or stage not in STAGES:
+                    continue
+
+                stage_times[stage] = timestamp
+                previous_stage = STAGES[STAGES.index(stage) - 1]
+                if previous_stage in stage_times:
+                    report.latencies[(previous_stage, stage)].append(timestamp - stage_times[previous_stage])
+
+                if stage == ACK3_STAGE:
+                    report.latencies[(HL7_STAGE, ACK3_STAGE)].append(timestamp - stage_times[HL7_STAGE])
+                    del report.open_submissions[submission]
+                    report.completed += 1
+                    continue
+
+            if next_key:
+                submission_of_key[next_key] = submission
+
+    return report
+
+
+def percentile(sorted_values, percent):
+    ''' nearest rank percentile of an already sorted list
+    '''
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def summarize(report):
+    '''
+    :return: dict of "HL7->ACK1" ... -> dict of count, p50, p90, p99 and max seconds
+    '''
+    summary = {}
+    for first_stage, second_stage in INTERVALS:
+        values = sorted(report.latencies[(first_stage, second_stage)])
+        one_summary = {'count': len(values), 'max': values[-1] if values else None}
+        for percent in PERCENTILES:
+            one_summary['p%d' % percent] = percentile(values, percent)
+        summary["%s->%s" % (first_stage, second_stage)] = one_summary
+    return summary
+
+
+def get_stuck_submissions(report, stuck_after, now=None):
+    '''
+    :param stuck_after: seconds since the last completed stage
+    :return: list of (HL7 file name, last completed stage, seconds since), oldest first
+    '''
+    now = now or time.time()
+    stuck = []
+    for submission, stage_times in report.open_submissions.items():
+        last_stage = max(stage_times, key=STAGES.index)
+        age = now - stage_times[last_stage]
+        if age >= stuck_after:
+            stuck.append((submission, last_stage, age))
+    stuck.sort(key=lambda one_stuck: -one_stuck[2])
+    return stuck
+
+
+def format_seconds(value):
+    return "-" if value is None else "%.1f" % value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Submission latency from HL7 to ACK1, ACK2 and ACK3')
+    parser.add_argument('-c', action="store", dest="configuration", required=True,
+                        help="configuration file")
+    parser.add_argument('--stuck-after', action="store", dest="stuck_after", type=float, default=86400,
+                        help="list submissions without progress for this many seconds, default one day")
+    parser.add_argument('--json', action="store_true", dest="json", default=False,
+                        help="print the report as JSON")
+
+    args = parser.parse_args()
+    my_config = configuration.monitor_configuration(args.configuration)
+    if not my_config.latency_log_file:
+        sys.exit("latency_log_file is not set in configuration file!")
+    if not os.path.exists(my_config.latency_log_file):
+        sys.exit("No latency log yet:%s" % my_config.latency_log_file)
+
+    report = load_latencies(my_config.latency_log_file)
+    summary = summarize(report)
+    stuck = get_stuck_submissions(report, args.stuck_after)
+
+    if args.json:
+        print(json.dumps({'completed': report.completed, 'open': len(report.open_submissions),
+                          'latency_seconds': summary,
+                          'stuck': [{'hl7': submission, 'last_stage': last_stage, 'seconds': age}
+                                    for submission, last_stage, age in stuck]}, indent=2, sort_keys=True))
+        return
+
+    print("%d complete, %d open submission(s)" % (report.completed, len(report.open_submissions)))
+    print("%-12s %8s %10s %10s %10s %10s" % ("seconds", "count", "p50", "p90", "p99", "max"))
+    for first_stage, second_stage in INTERVALS:
+        name = "%s->%s" % (first_stage, second_stage)
+        one_summary = summary[name]
+        print("%-12s %8d %10s %10s %10s %10s" % (name, one_summary['count'], format_seconds(one_summary['p50']),
+                                                 format_seconds(one_summary['p90']),
+                                                 format_seconds(one_summary['p99']),
+                                                 format_seconds(one_summary['max'])))
+
+    print("%d submission(s) without progress for %d seconds:" % (len(stuck), args.stuck_after))
+    for submission, last_stage, age in stuck:
+        print("%s last %s %s seconds ago" % (submission, last_stage, format_seconds(age)))
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,120 @@
+import os
+import logging
+import datetime
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class queue_handler(logging.Handler):
+    '''
+    hands log records over to a queue_listener, the logging thread neither formats nor writes them.
+    arguments are formatted later by the listener, so only log values which don't change afterwards.
+    '''
+    def __init__(self, record_queue):
+        logging.Handler.__init__(self)
+        self.record_queue = record_queue
+
+    def emit(self, record):
+        try:
+            if record.exc_info:
+                # the traceback is rendered now, while it still describes this thread
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.record_queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class queue_listener():
+    '''
+    background thread writing records from a queue to handlers, each handler keeps its own level.
+    '''
+    def __init__(self, record_queue, handlers):
+        self.record_queue = record_queue
+        self.handlers = handlers
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name="log-writer")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self):
+        while True:
+            record = self.record_queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        ''' write every queued record, then stop the thread
+        '''
+        if self.__thread is None:
+            return
+        self.record_queue.put(None)
+        self.__thread.join()
+        self.__thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+
+class dated_file_handler(logging.FileHandler):
+    '''
+    writes to prefix-YYYY-MM-DD.log in output_dir, starting a new file when the day changes.
+    with max_bytes, a file grown beyond it is renamed to prefix-YYYY-MM-DD.N.log and a new one started.
+    '''
+    def __init__(self, output_dir, prefix, max_bytes=0, mode="a+", encoding=None, delay=False):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.day = datetime.date.today()
+        logging.FileHandler.__init__(self, self.get_file_name(self.day), mode, encoding, delay)
+
+    def get_file_name(self, day, index=0):
+        if index > 0:
+            return os.path.join(self.output_dir, "%s-%4d-%02d-%02d.%d.log" %
+                                (self.prefix, day.year, day.month, day.day, index))
+        return os.path.join(self.output_dir, "%s-%4d-%02d-%02d.log" % (self.prefix, day.year, day.month, day.day))
+
+    def close_stream(self):
+        self.acquire()
+        try:
+            if self.stream:
+                self.stream.flush()
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+
+    def emit(self, record):
+        try:
+            today = datetime.date.today()
+            if today != self.day:
+                self.close_stream()
+                self.day = today
+                # the file is opened again by FileHandler.emit
+                self.baseFilename = os.path.abspath(self.get_file_name(today))
+        except Exception:
+            self.handleError(record)
+            return
+
+        logging.FileHandler.emit(self, record)
+
+        try:
+            if self.max_bytes > 0 and self.stream and self.stream.tell() >= self.max_bytes:
+                self.roll_over()
+        except Exception:
+            self.handleError(record)
+
+    def roll_over(self):
+        self.close_stream()
+        index = 1
+        while os.path.exists(self.get_file_name(self.day, index)):
+            index += 1
+        os.rename(self.baseFilename, self.get_file_name(self.day, index))
@@ -0,0 +1,285 @@
+import sys
+import os
+import time
+import logging
+import threading
+
+sys.path.append(".")
+
+try:
+    from . import util
+except:
+    import util
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+STAGE_SECONDS = 'uditransfer_stage_seconds'
+FILE_SECONDS = 'uditransfer_file_seconds'
+CYCLE_SECONDS = 'uditransfer_cycle_seconds'
+FILES_TOTAL = 'uditransfer_files_total'
+REJECTED_TOTAL = 'uditransfer_rejected_total'
+ERRORS_TOTAL = 'uditransfer_errors_total'
+BACKLOG_FILES = 'uditransfer_backlog_files'
+QUARANTINED_TOTAL = 'uditransfer_quarantined_total'
+DUPLICATES_TOTAL = 'uditransfer_duplicates_total'
+SCAN_SECONDS = 'uditransfer_scan_seconds'
+SKIPPED_PASSES_TOTAL = 'uditransfer_skipped_passes_total'
+
+METRIC_HELP = {
+    STAGE_SECONDS: "Time spent in one stage for one file or listing: list, validate, flag, transfer, hook, orphan_read.",
+    FILE_SECONDS: "Time to process one HL7 message or ack from start to end.",
+    CYCLE_SECONDS: "Time of one pass over all folders.",
+    FILES_TOTAL: "Files processed, by type HL7, ACK1, ACK2 or ACK3.",
+    REJECTED_TOTAL: "HL7 files rejected as invalid packages.",
+    ERRORS_TOTAL: "Errors, by stage.",
+    BACKLOG_FILES: "Files waiting in a folder at its last listing.",
+    QUARANTINED_TOTAL: "Files given up after retry_max_attempts failures, by kind hl7 or orphan.",
+    DUPLICATES_TOTAL: "Files with the same content as one transferred before, by kind hl7 or ack and dedup policy.",
+    SCAN_SECONDS: "Time to compare one folder with its previous snapshot, by folder.",
+    SKIPPED_PASSES_TOTAL: "Passes of a stage skipped by the periodical loop, none of its folders had changed.",
+}
+
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+
+def get_label_key(labels):
+    if not labels:
+        return ()
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(label_key, extra=None):
+    labels = list(label_key) + (extra or [])
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                                      .replace('\n', '\\n'))
+                              for name, value in labels)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+
+class histogram():
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class stage_timer():
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, time.time() - self.start, self.labels)
+        return False
+
+
+class null_timer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = null_timer()
+
+
+class null_registry():
+    ''' stands in when metrics are disabled, every call returns right away
+    '''
+    enabled = False
+
+    def inc(self, name, labels=None, value=1):
+        pass
+
+    def observe(self, name, value, labels=None):
+        pass
+
+    def set_gauge(self, name, value, labels=None):
+        pass
+
+    def time(self, name, labels=None):
+        return NULL_TIMER
+
+    def export(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class metrics_registry():
+    '''
+    counters, histograms and gauges kept in memory, rendered in the Prometheus text format.
+    with textfile, export() writes them there for the node_exporter textfile collector.
+    '''
+    enabled = True
+
+    def __init__(self, textfile=None):
+        self.textfile = textfile
+        self.__counters = {}
+        self.__histograms = {}
+        self.__gauges = {}
+        self.__lock = threading.Lock()
+        self.__server = None
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, get_label_key(labels))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = (name, get_label_key(labels))
+        with self.__lock:
+            one_histogram = self.__histograms.get(key)
+            if one_histogram is None:
+                one_histogram = self.__histograms[key] = histogram()
+            one_histogram.observe(value)
+
+    def set_gauge(self, name, value, labels=None):
+        with self.__lock:
+            self.__gauges[(name, get_label_key(labels))] = value
+
+    def time(self, name, labels=None):
+        ''' with-block observing its duration into histogram name
+        '''
+        return stage_timer(self, name, labels)
+
+    def get_counter(self, name, labels=None):
+        return self.__counters.get((name, get_label_key(labels)), 0)
+
+    def get_gauge(self, name, labels=None):
+        return self.__gauges.get((name, get_label_key(labels)))
+
+    def get_histogram(self, name, labels=None):
+        return self.__histograms.get((name, get_label_key(labels)))
+
+    def render(self):
+        with self.__lock:
+            counters = sorted(self.__counters.items())
+            gauges = sorted(self.__gauges.items())
+            histograms = sorted((key, (list(h.counts), h.count, h.sum, h.buckets))
+                                for key, h in self.__histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name, metric_type):
+            if name not in described:
+                described.add(name)
+                lines.append("# HELP %s %s" % (name, METRIC_HELP.get(name, name)))
+                lines.append("# TYPE %s %s" % (name, metric_type))
+
+        for (name, label_key), value in counters:
+            describe(name, "counter")
+            lines.append("%s%s %s" % (name, format_labels(label_key), format_value(value)))
+
+        for (name, label_key), value in gauges:
+            describe(name, "gauge")
+            lines.append("%s%s %s" % (name, format_labels(label_key), format_value(value)))
+
+        for (name, label_key), (counts, count, total, buckets) in histograms:
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append("%s_bucket%s %d" % (name, format_labels(label_key, [('le', format_value(bound))]),
+                                                 cumulative))
+            lines.append("%s_bucket%s %d" % (name, format_labels(label_key, [('le', "+Inf")]), count))
+            lines.append("%s_sum%s %s" % (name, format_labels(label_key), format_value(total)))
+            lines.append("%s_count%s %d" % (name, format_labels(label_key), count))
+
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        ''' write all metrics into textfile, through a temp file so the collector never reads half of it
+        '''
+        if not self.textfile:
+            return
+
+        temp_file = "%s.%d.tmp" % (self.textfile, os.getpid())
+        try:
+            with open(temp_file, 'w') as metrics_file:
+                metrics_file.write(self.render())
+            util.replace_file(temp_file, self.textfile)
+        except (IOError, OSError) as e:
+            logging.error("Unable to write metrics into %s:%s", self.textfile, str(e))
+
+    def serve(self, address, port):
+        ''' answer GET /metrics on address:port from a background thread
+        '''
+        registry = self
+
+        class metrics_handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = HTTPServer((address, port), metrics_handler)
+        thread = threading.Thread(target=self.__server.serve_forever, name="metrics-http")
+        thread.daemon = True
+        thread.start()
+        logging.info("Serving metrics on http://%s:%d/metrics", address, self.__server.server_address[1])
+        return self.__server.server_address[1]
+
+    def close(self):
+        self.export()
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+
+def get_metrics(my_config):
+    '''
+    :return: metrics registry of this configuration, a null_registry if neither metrics_textfile
+             nor metrics_http_port is set
+    '''
+    registry = getattr(my_config, 'metrics_registry', None)
+    if registry is None:
+        if my_config.metrics_textfile or my_config.metrics_http_port > 0:
+            registry = metrics_registry(my_config.metrics_textfile)
+            if my_config.metrics_http_port > 0:
+                try:
+                    registry.serve(my_config.metrics_http_address, my_config.metrics_http_port)
+                except Exception as e:
+                    logging.error("Unable to serve metrics on port %d:%s", my_config.metrics_http_port, str(e))
+        else:
+            registry = null_registry()
+        my_config.metrics_registry = registry
+    return registry
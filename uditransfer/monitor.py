@@ -3,140 +3,238 @@ import logging
 import time
 import argparse
 import os
-import shutil
-import tarfile
-import subprocess
+import errno
+import threading
 
 sys.path.append(".")
 
 try:
     from . import util
     from . import configuration
+    from . import watcher
+    from . import workers
+    from . import stability
+    from . import flagstore
+    from . import filecache
+    from . import ackparser
+    from . import transfer
+    from . import scanner
+    from . import hooks
+    from . import metrics
+    from . import latency
+    from . import profiler
+    from . import journal
+    from . import scheduler
+    from . import claims
+    from . import retry
+    from . import stages
+    from . import validation
+    from . import dedup
 except:
     import util
     import configuration
+    import watcher
+    import workers
+    import stability
+    import flagstore
+    import filecache
+    import ackparser
+    import transfer
+    import scanner
+    import hooks
+    import metrics
+    import latency
+    import profiler
+    import journal
+    import scheduler
+    import claims
+    import retry
+    import stages
+    import validation
+    import dedup
 
 
 def process_hl7_shell_commands(my_config, target_file):
-    process_shell_commands(my_config.hl7_operation_shell_commands, target_file)
+    hooks.get_hook_executor(my_config).submit(my_config.hl7_operation_shell_commands, target_file)
 
 
 def process_ack_shell_commands(my_config, target_file):
-    process_shell_commands(my_config.ack_operation_shell_commands, target_file)
-
-
-def process_shell_commands(command_list, target_file):
-    for command in command_list:
-        command = command.replace('"', '')
-        command = command.replace(r"&target", '"' + os.path.abspath(target_file) + '"')
-        try:
-            return_code = subprocess.call([command], shell=True)
-            if return_code == 0:
-                logging.info("Successfully executed command:%s" % command)
-            else:
-                logging.info("Returned value is: %d from command:%s" % (return_code, command))
-        except subprocess.CalledProcessError as e:
-            print(e.output)
-            logging.debug("Error happened in command execution:%s" % command)
-            logging.debug(e.output)
+    hooks.get_hook_executor(my_config).submit(my_config.ack_operation_shell_commands, target_file)
 
 def get_hl7_message_files(my_config):
     return get_file_list(my_config.folder_localoutbox)
 
-def is_valid_hl7_message(hl7_fullname):
-    try:
+def is_valid_hl7_message(hl7_fullname, max_members=0, max_bytes=0, verdict_cache=None):
+    '''
+    a HL7 message is a tar.gz package with a SUBMISSION.XML member.
+    members are read as a stream and the scan stops at SUBMISSION.XML, so only the part of the
+    package in front of it is decompressed.
+    :param hl7_fullname:
+    :param max_members: give up after this many members, 0 means no limit
+    :param max_bytes: give up at the first member starting beyond the first max_bytes uncompressed bytes,
+                      0 means no limit
+    :param verdict_cache: filecache.verdict_cache, an unchanged file is only scanned once
+    :return:
+    '''
+    identity = None
+    if verdict_cache is not None:
+        identity = filecache.get_file_identity(hl7_fullname)
+        verdict = verdict_cache.get(identity)
+        if verdict is not None:
+            logging.info("%s has been validated before:%s", hl7_fullname, verdict)
+            return verdict
+
+    scan_result = validation.scan_package(hl7_fullname, max_members, max_bytes)
+    verdict = validation.get_verdict(scan_result)
+    if scan_result[0] is None:
+        return False
 
-        tar = tarfile.open(hl7_fullname, 'r:gz')
-        for tar_info in tar:
-            name_info = (tar_info.name).upper()
-            if "SUBMISSION.XML" in name_info:
-                logging.info("%s is a valid HL7 message tar.gz package!" % hl7_fullname)
-                return True
+    if identity is not None:
+        verdict_cache.put(identity, verdict)
+    return verdict
 
-        return False
-    except tarfile.ReadError as re:
-        logging.info(hl7_fullname + " " + str(re))
-        return False
-    except Exception as e:
-        logging.error("Unacceptable HL7 tar.gz package received. it will be ignored!")
-        logging.exception("Exception")
-        return False
 
-    return False
+def needs_hl7_operation_delay(my_config):
+    # the stability tracker has already made sure the file is complete, no need to wait.
+    return my_config.hl7_operation_delay > 0 and stability.get_tracker(my_config) is None
 
-def is_valid_hl7(my_config, hl7_file):
-    if my_config.hl7_operation_delay > 0:
+
+def is_valid_hl7(my_config, hl7_file, pending_verdict=None):
+    '''
+    :param pending_verdict: validation.pending_verdict of the file submitted to the validation pool,
+                            None means it's validated right here
+    '''
+    if pending_verdict is not None:
+        with metrics.get_metrics(my_config).time(metrics.STAGE_SECONDS, {'stage': 'validate'}):
+            return pending_verdict.get()
+
+    if needs_hl7_operation_delay(my_config):
         time.sleep(my_config.hl7_operation_delay)
 
-    return is_valid_hl7_message(os.path.join(my_config.folder_localoutbox, os.path.basename(hl7_file)))
+    with metrics.get_metrics(my_config).time(metrics.STAGE_SECONDS, {'stage': 'validate'}):
+        return is_valid_hl7_message(os.path.join(my_config.folder_localoutbox, os.path.basename(hl7_file)),
+                                    my_config.hl7_validation_max_members, my_config.hl7_validation_max_bytes,
+                                    filecache.get_hl7_verdict_cache(my_config))
+
+
+
+get_file_list = util.get_file_list
 
 
+def submit_hl7_validations(my_config, file_list):
+    '''
+    hand large packages of file_list over to the validation pool, they are scanned while the HL7 workers
+    handle the files in front of them.
+    :return: dict of file name -> validation.pending_verdict, empty unless hl7_validation_processes is set
+    '''
+    validation_pool = validation.get_validation_pool(my_config)
+    # files still waiting out hl7_operation_delay could be incomplete
+    if not validation_pool.enabled or needs_hl7_operation_delay(my_config):
+        return {}
 
-def get_file_list(folder):
-    onlyfiles = [f for f in os.listdir(folder)
-                 if (os.path.isfile(os.path.join(folder, f)) and (not f.startswith('.')))]
-    return onlyfiles
+    verdict_cache = filecache.get_hl7_verdict_cache(my_config)
+    pending_verdicts = {}
+    for hl7_file in file_list:
+        pending_verdict = validation_pool.submit(os.path.join(my_config.folder_localoutbox, hl7_file),
+                                                 my_config.hl7_validation_max_members,
+                                                 my_config.hl7_validation_max_bytes, verdict_cache)
+        if pending_verdict is not None:
+            pending_verdicts[hl7_file] = pending_verdict
+    return pending_verdicts
 
 
 def create_ack1_flag_from_hl7(my_config, hl7_file):
     try:
+        flag_store = flagstore.get_flag_store(my_config)
         src_file = os.path.join(my_config.folder_localoutbox, hl7_file)
-        target_file = os.path.join(my_config.folder_ack1flag, hl7_file)
+        target_file = flag_store.describe(flagstore.ACK1_FLAG, hl7_file)
         #if my_config.hl7_operation_delay>0:
         #    time.sleep(my_config.hl7_operation_delay)
 
-        logging.debug("Start to copy %s to %s" % (src_file, target_file))
-        shutil.copyfile(src_file, target_file)
-        logging.info("Successfully copied %s to %s!" % (src_file, target_file))
+        logging.debug("Start to create ack1 flag %s of %s", target_file, src_file)
+        with metrics.get_metrics(my_config).time(metrics.STAGE_SECONDS, {'stage': 'flag'}):
+            flag_store.create_ack1_flag(hl7_file, src_file)
+            # the flag has to be there before the HL7 message can be answered by an ACK1
+            flag_store.commit()
+        logging.info("Successfully created ack1 flag %s!", target_file)
         return True
     except IOError as (errno, strerror):
         logging.error("I/O error({0}): {1}".format(errno, strerror))
+        metrics.get_metrics(my_config).inc(metrics.ERRORS_TOTAL, {'stage': 'flag'})
         return False
     except Exception as e:
-        logging.error("Unexpected error:", sys.exc_info()[0])
-        logging.exception("Error happened in copy %s to ack1_flag folder!" % hl7_file)
+        metrics.get_metrics(my_config).inc(metrics.ERRORS_TOTAL, {'stage': 'flag'})
+        logging.error("Unexpected error:%s", sys.exc_info()[0])
+        logging.exception("Error happened in copy %s to ack1_flag folder!", hl7_file)
         return False
 
+def remove_ack1_flag(my_config, hl7_file):
+    try:
+        flag_store = flagstore.get_flag_store(my_config)
+        with metrics.get_metrics(my_config).time(metrics.STAGE_SECONDS, {'stage': 'flag'}):
+            flag_store.remove(flagstore.ACK1_FLAG, hl7_file)
+            flag_store.commit()
+        logging.info("Successfully removed ack1 flag of %s!", hl7_file)
+    except Exception as e:
+        metrics.get_metrics(my_config).inc(metrics.ERRORS_TOTAL, {'stage': 'flag'})
+        logging.error("Unable to remove ack1 flag of %s:%s", hl7_file, str(e))
+
 def copy_or_move_wrong_hl7(my_config, hl7_file):
     try:
         src_file = os.path.join(my_config.folder_localoutbox, hl7_file)
         target_file = os.path.join(my_config.folder_hl7flag, hl7_file)
 
-        if my_config.hl7_operation_method_is_copy:
-            logging.debug("Start to copy wrong hl7 %s to %s" % (src_file, target_file))
-            shutil.copyfile(src_file, target_file)
-            logging.info("Successfully copied wrong hl7 %s to %s!" % (src_file, target_file))
-            os.remove(src_file)
-            logging.info("Successfully removed wrong hl7 source file after copy:%s" % src_file)
-        else:
-            logging.debug("Start to move wrong hl7 %s to %s" % (src_file, target_file))
-            shutil.move(src_file, target_file)
-            logging.info("Successfully moved wrong hl7 %s to %s!" % (src_file, target_file))
+        with metrics.get_metrics(my_config).time(metrics.STAGE_SECONDS, {'stage': 'transfer'}):
+            # Copy removes the source after the copy as well, a rename does both on one file system
+            logging.debug("Start to move wrong hl7 %s to %s", src_file, target_file)
+            if transfer.move_file(src_file, target_file):
+                logging.info("Successfully moved wrong hl7 %s to %s!", src_file, target_file)
+            else:
+                logging.info("Successfully copied wrong hl7 %s to %s and removed the source!", src_file, target_file)
 
         return True
     except IOError as (errno, strerror):
         logging.error("I/O error({0}) for wrong hl7: {1}".format(errno, strerror))
+        metrics.get_metrics(my_config).inc(metrics.ERRORS_TOTAL, {'stage': 'transfer'})
         return False
     except Exception as e:
+        metrics.get_metrics(my_config).inc(metrics.ERRORS_TOTAL, {'stage': 'transfer'})
         logging.error("Unexpected error:{0}".format(sys.exc_info()[0]))
-        logging.exception("Error happened in copy wrong hl7 %s to remote outbox folder!" % hl7_file)
+        logging.exception("Error happened in copy wrong hl7 %s to remote outbox folder!", hl7_file)
         return False
 
 def copy_or_move_hl7_to_remoteoutbox(my_config, hl7_file):
+    '''
+    :return: True if transferred, dedup.DUPLICATE if it has been dropped as a duplicate, False if it failed
+    '''
     try:
         src_file = os.path.join(my_config.folder_localoutbox, hl7_file)
         target_file = os.path.join(my_config.folder_remoteoutbox, hl7_file)
 
-        if my_config.hl7_operation_method_is_copy:
-            logging.debug("Start to copy %s to %s" % (src_file, target_file))
-            shutil.copyfile(src_file, target_file)
-            logging.info("Successfully copied %s to %s!" % (src_file, target_file))
-            os.remove(src_file)
-            logging.info("Successfully removed source file after copy:%s" % src_file)
-        else:
-            logging.debug("Start to move %s to %s" % (src_file, target_file))
-            shutil.move(src_file, target_file)
-            logging.info("Successfully moved %s to %s!" % (src_file, target_file))
+        dedup_check = dedup.get_check(my_config, dedup.HL7_DIGESTS, target_file)
+        with metrics.get_metrics(my_config).time(metrics.STAGE_SECONDS, {'stage': 'transfer'}):
+            if dedup_check is not None:
+                # renamed next to the target and read once for its digest, streamed across file systems
+                logging.debug("Start to move %s to %s", src_file, target_file)
+                try:
+                    move_result = transfer.stream_move(src_file, target_file, choose_target=dedup_check)
+                except:
+                    dedup_check.rollback()
+                    raise
+                if dedup_check.dropped:
+                    logging.info("Duplicate %s has been dropped by %s policy!", src_file, my_config.dedup_policy)
+                    return dedup.DUPLICATE
+                if move_result.renamed:
+                    logging.info("Successfully moved %s to %s!", src_file, target_file)
+                else:
+                    logging.info("Successfully streamed %s to %s and removed the source!", src_file, target_file)
+            else:
+                # Copy removes the source after the copy as well, a rename does both on one file system
+                logging.debug("Start to move %s to %s", src_file, target_file)
+                if transfer.move_file(src_file, target_file):
+                    logging.info("Successfully moved %s to %s!", src_file, target_file)
+                else:
+                    logging.info("Successfully copied %s to %s and removed the source!", src_file, target_file)
 
         #20160902 added in order to support shell command after copy or move
         process_hl7_shell_commands(my_config, target_file)
@@ -144,48 +242,132 @@ def copy_or_move_hl7_to_remoteoutbox(my_config, hl7_file):
         return True
     except IOError as (errno, strerror):
         logging.error("I/O error({0}): {1}".format(errno, strerror))
+        metrics.get_metrics(my_config).inc(metrics.ERRORS_TOTAL, {'stage': 'transfer'})
         return False
     except Exception as e:
+        metrics.get_metrics(my_config).inc(metrics.ERRORS_TOTAL, {'stage': 'transfer'})
         logging.error("Unexpected error:{0}".format(sys.exc_info()[0]))
-        logging.exception("Error happened in copy %s to remote outbox folder!" % hl7_file)
+        logging.exception("Error happened in copy %s to remote outbox folder!", hl7_file)
         return False
 
-def process_hl7_message(my_config):
+def process_hl7_message(my_config, file_list=None, budget=None):
+    '''
+    process HL7 message in local outbox folder
+    :param my_config:
+    :param file_list: only process these file names, None means everything in local outbox folder
+    :param budget: stages.stage_budget limiting the files and seconds of this pass, None means no limit
+    :return: number of HL7 messages transferred
+    '''
     logging.info("Start to process HL7 message in local outbox folder...")
     if not os.path.exists(my_config.folder_localoutbox):
         logging.error("Local outbox folder doesn't exist! Please check your configuration file!")
-        return
+        return 0
+
+    metrics_registry = metrics.get_metrics(my_config)
+    retry_queue = retry.get_retry_queue(my_config)
+    if file_list is None:
+        with metrics_registry.time(metrics.STAGE_SECONDS, {'stage': 'list'}):
+            file_list = get_hl7_message_files(my_config)
+        metrics_registry.set_gauge(metrics.BACKLOG_FILES, len(file_list), {'folder': 'localoutbox'})
+        if retry_queue is not None:
+            retry_queue.evict_missing(retry.HL7_RETRIES, file_list)
+    file_list = stability.get_ready_files(my_config, my_config.folder_localoutbox, file_list)
+    claim_manager = claims.get_claim_manager(my_config)
+    file_list = claim_manager.select(my_config.folder_localoutbox, file_list)
+    # files which have failed before wait for their backoff and come after the others
+    file_list = retry.select(my_config, retry.HL7_RETRIES, file_list)
+    if budget is not None:
+        file_list = budget.start(file_list)
+
+    transfer_section = workers.bounded_section(my_config.hl7_max_inflight_transfers)
+    pending_verdicts = submit_hl7_validations(my_config, file_list)
+
+    def process_one(hl7_file):
+        if budget is not None and budget.expired():
+            budget.leave([hl7_file])
+            return False
+        # another instance could be at it already
+        with claim_manager.claim(claims.HL7_CLAIMS, my_config.folder_localoutbox, hl7_file) as hl7_claim:
+            if not hl7_claim:
+                return False
+            return process_hl7_file(my_config, hl7_file, transfer_section, pending_verdicts.get(hl7_file))
+
+    results = workers.run_tasks(process_one, file_list, my_config.hl7_worker_count, "hl7")
+    hooks.get_hook_executor(my_config).flush()
+    retry.save(my_config)
+    dedup.save(my_config)
 
-    file_list = get_hl7_message_files(my_config)
-    for hl7_file in file_list:
-        if is_valid_hl7(my_config, hl7_file):
+    logging.info("Processing in local outbox folder has been finished!")
+    return len([result for result in results if result])
+
+
+def process_hl7_file(my_config, hl7_file, transfer_section=None, pending_verdict=None):
+    '''
+    validate, flag and transfer one HL7 file, always in this order.
+    :param my_config:
+    :param hl7_file: file name in local outbox folder
+    :param transfer_section: workers.bounded_section limiting concurrent transfers, None means no limit
+    :param pending_verdict: validation.pending_verdict if the file is being validated in the validation pool
+    :return: True if the file has been transferred to remote outbox folder
+    '''
+    if transfer_section is None:
+        transfer_section = workers.bounded_section(0)
+
+    metrics_registry = metrics.get_metrics(my_config)
+    with metrics_registry.time(metrics.FILE_SECONDS, {'type': 'HL7'}):
+        if is_valid_hl7(my_config, hl7_file, pending_verdict):
             ack1_flag_copy_status = create_ack1_flag_from_hl7(my_config, hl7_file)
-            if ack1_flag_copy_status:
-                hl7_copy_status = copy_or_move_hl7_to_remoteoutbox(my_config, hl7_file)
+            if not ack1_flag_copy_status:
+                retry.record(my_config, retry.HL7_RETRIES, my_config.folder_localoutbox, hl7_file, False, 'flag')
+                return False
+            with transfer_section:
+                transferred = copy_or_move_hl7_to_remoteoutbox(my_config, hl7_file)
+            if not transferred:
+                retry.record(my_config, retry.HL7_RETRIES, my_config.folder_localoutbox, hl7_file, False,
+                             'transfer')
+                return False
+            retry.record(my_config, retry.HL7_RETRIES, my_config.folder_localoutbox, hl7_file, True)
+            if transferred == dedup.DUPLICATE:
+                # no ACK1 is coming for a message which hasn't been sent
+                remove_ack1_flag(my_config, hl7_file)
+                return False
+            metrics_registry.inc(metrics.FILES_TOTAL, {'type': 'HL7'})
+            latency.record(my_config, latency.HL7_STAGE, hl7_file)
+            return True
         else:
-            logging.warning("Unknown file found in HL7 local outbox folder:%s" % os.path.basename(hl7_file))
-            copy_or_move_wrong_hl7(my_config, hl7_file)
+            logging.warning("Unknown file found in HL7 local outbox folder:%s", os.path.basename(hl7_file))
+            metrics_registry.inc(metrics.REJECTED_TOTAL, {'type': 'HL7'})
+            with transfer_section:
+                moved = copy_or_move_wrong_hl7(my_config, hl7_file)
+            retry.record(my_config, retry.HL7_RETRIES, my_config.folder_localoutbox, hl7_file, moved, 'transfer')
 
-    logging.info("Processing in local outbox folder has been finished!")
+    return False
 
 
 def detect_ack_file(my_config, orphan, file_content,
-                                    ack1_flag_files, ack2_flag_files, ack3_flag_files):
+                                    ack1_flag_files, ack2_flag_files, ack3_flag_files, ack_info=None):
+    '''
+    :param ack_info: ackparser.ack_info of file_content, parsed here if not given
+    :return: (ack type, True if it's for CCM)
+    '''
     file_name = os.path.basename(orphan)
+    if ack_info is None:
+        ack_info = ackparser.parse_ack_content(file_content)
 
     logging.info("Start to detect ack types!")
-    logging.info("Looking for file name:%s in ack1-flag folder" % file_name)
+    logging.info("Looking for file name:%s in ack1-flag folder", file_name)
     if file_name in ack1_flag_files:
-        logging.info("Found ack1 flag:%s" % file_name)
+        logging.info("Found ack1 flag:%s", file_name)
         return 'ACK1', True
     else:
         logging.info("This is not a ACK1 for CCM")
 
-    logging.info("Looking for message ID from potential ack2 content:%s" % orphan)
-    message_id = get_messageid_from_ack2_content(file_content)
+    logging.info("Looking for message ID from potential ack2 content:%s", orphan)
+    message_id = ack_info.message_id
 
     if message_id:
-        logging.info("Found message ID from ack2:%s" % message_id)
+        logging.info("Found MessageID in ack2 content!")
+        logging.info("Found message ID from ack2:%s", message_id)
         if message_id in ack2_flag_files:
             logging.info("Found this message ID in ack2 flag folder!")
             return 'ACK2', True
@@ -196,10 +378,10 @@ def detect_ack_file(my_config, orphan, file_content,
         logging.info("Couldn't find message ID from this content. it's not a ACK2 file!")
 
     logging.info("Try to look for core ID from ack3 content")
-    core_id = get_coreid_from_ack3_content(file_content)
+    core_id = ack_info.core_id if ack_info.ack_type == 'ACK3' else None
 
     if core_id:
-        logging.info("Found core id:%s" % core_id)
+        logging.info("Found core id:%s", core_id)
         if core_id in ack3_flag_files:
             logging.info("Found this core id in ack3 flag folder!")
             return 'ACK3', True
@@ -214,7 +396,7 @@ def detect_ack_file(my_config, orphan, file_content,
 
 
 def get_coreid_from_ack2_content(file_content):
-    logging.debug(file_content)
+    util.log_payload(file_content)
     CORE_ID = r'CoreId:'
     DATA_RECEIVED = r'DateTime Receipt Generated:'
 
@@ -230,7 +412,7 @@ def get_coreid_from_ack2_content(file_content):
 
 
 def get_coreid_from_ack3_content(file_content):
-    logging.debug(file_content)
+    util.log_payload(file_content)
     ACK3_XML1 = r'<?xml version="1.0" encoding="UTF-8"?>'   #ACK3 file from FDA doesn't have this tag
     ACK3_XML2 = r'<submission>'
     CORE_ID_START = r'<coreId>'
@@ -246,7 +428,7 @@ def get_coreid_from_ack3_content(file_content):
 
 
 def get_messageid_from_ack1_content(file_content):
-    logging.debug(file_content)
+    util.log_payload(file_content)
     return file_content[file_content.find("<")+1 : file_content.find(">")]
 
 
@@ -256,7 +438,7 @@ def get_messageid_from_ack2_content(file_content):
     :param file_content:
     :return:
     '''
-    logging.debug(file_content)
+    util.log_payload(file_content)
     if file_content.find('MessageId')>=0:
         logging.info("Found MessageID in ack2 content!")
         return (file_content[file_content.find("<")+1:file_content.rfind(">")]).strip()
@@ -264,217 +446,851 @@ def get_messageid_from_ack2_content(file_content):
         return None
 
 
-def touch(file_name):
-    ''' create an empty file with specific name
-    '''
-    with open(file_name, 'a'):
-        os.utime(file_name, None)
+touch = util.touch
 
 
 def read_content_from_orphan(my_config, orphan):
-    with open(os.path.join(my_config.folder_remoteorphan, orphan), 'r') as content_file:
-        return content_file.read()
+    '''
+    read the head of an orphan, enough to detect its ack type and IDs.
+    :return: first ack_read_max_bytes bytes of the orphan, all of it if ack_read_max_bytes is 0
+    '''
+    with metrics.get_metrics(my_config).time(metrics.STAGE_SECONDS, {'stage': 'orphan_read'}):
+        with open(os.path.join(my_config.folder_remoteorphan, orphan), 'rb') as content_file:
+            if my_config.ack_read_max_bytes > 0:
+                return content_file.read(my_config.ack_read_max_bytes)
+            return content_file.read()
+
+def is_whole_content(my_config, file_content):
+    return my_config.ack_read_max_bytes <= 0 or len(file_content) < my_config.ack_read_max_bytes
 
 def create_file(my_config, source_file, target_file, file_content, notes):
-    if my_config.operation_delay>0:
+    '''
+    :return: True if transferred, dedup.DUPLICATE if it has been dropped or quarantined as a duplicate,
+             False if it failed
+    '''
+    if my_config.operation_delay>0 and stability.get_tracker(my_config) is None:
         time.sleep(my_config.operation_delay)
 
+    metrics_registry = metrics.get_metrics(my_config)
     try:
-        if my_config.operation_method_is_move:
-            shutil.move(source_file, target_file)
-            logging.info("Successfully moved %s to %s for %s file." %
-                         (source_file, target_file, notes))
-        elif my_config.operation_method_is_copy:
-            shutil.copyfile(source_file, target_file)
-            logging.info("Successfully copied %s to %s for %s file." %
-                         (source_file, target_file, notes))
-        else:
-            if my_config.recheck_content:
-                new_file_content = read_content_from_orphan(my_config, os.path.basename(source_file))
-                if not file_content == new_file_content:
-                    logging.debug("%s file content has been changed since ACK detect, "
-                                  "it will be ignored this time." % notes)
-            with open(target_file, "w") as target:
-                target.write(file_content)
-                logging.info("Successfully write down %s content into file:%s" % (notes,target_file))
+        dedup_check = dedup.get_check(my_config, dedup.ACK_DIGESTS, target_file)
+        with metrics_registry.time(metrics.STAGE_SECONDS, {'stage': 'transfer'}):
+            if my_config.operation_method_is_move and dedup_check is None:
+                transfer.move_file(source_file, target_file)
+                logging.info("Successfully moved %s to %s for %s file.",
+                             source_file, target_file, notes)
+            elif my_config.operation_method_is_copy and dedup_check is None:
+                transfer.copy_file(source_file, target_file)
+                logging.info("Successfully copied %s to %s for %s file.",
+                             source_file, target_file, notes)
+            else:
+                # with dedup on, copies are streamed so the digest comes from the copy itself,
+                # moves are renamed and read once on the same file system
+                head_size = len(file_content) if my_config.recheck_content else 0
+                try:
+                    if my_config.operation_method_is_move:
+                        copy_result = transfer.stream_move(source_file, target_file, head_size,
+                                                           choose_target=dedup_check)
+                    else:
+                        copy_result = transfer.stream_copy(source_file, target_file, head_size,
+                                                           choose_target=dedup_check)
+                except:
+                    if dedup_check is not None:
+                        dedup_check.rollback()
+                    raise
+                if dedup_check is not None and dedup_check.dropped:
+                    logging.info("Duplicate %s %s has been dropped by %s policy.",
+                                 notes, source_file, my_config.dedup_policy)
+                    return dedup.DUPLICATE
+                if my_config.recheck_content:
+                    content_changed = copy_result.head_digest != transfer.get_content_digest(file_content)
+                    if is_whole_content(my_config, file_content) and copy_result.size != len(file_content):
+                        content_changed = True
+                    if content_changed:
+                        logging.debug("%s file content has been changed since ACK detect, "
+                                      "it will be ignored this time.", notes)
+                logging.info("Successfully write down %s content into file:%s", notes,target_file)
         #20160902 added to support shell commands after copy or move
         process_ack_shell_commands(my_config, target_file)
         #20160902 Done
 
         return True
     except Exception as e:
-        logging.exception("Error happened in %s file operation!" % notes)
+        metrics_registry.inc(metrics.ERRORS_TOTAL, {'stage': 'transfer'})
+        logging.exception("Error happened in %s file operation!", notes)
         return False
 
     return False
 
-def process_ack1_file(my_config, orphan, file_content):
+def process_ack1_file(my_config, orphan, file_content, ack_info=None):
     try:
-        message_id = get_messageid_from_ack1_content(file_content)
+        if ack_info is None:
+            ack_info = ackparser.parse_ack_content(file_content)
+        message_id = ack_info.ack1_message_id
 
         source_file = os.path.join(my_config.folder_remoteorphan, orphan)
         target_file = os.path.join(my_config.folder_localinbox, orphan)
-        ack1_flag = os.path.join(my_config.folder_ack1flag, orphan)
-        ack2_flag = os.path.join(my_config.folder_ack2flag, message_id)
-        file_tobedelete = os.path.join(my_config.folder_tobedeleted, orphan)
+        handoff = create_handoff('ACK1', orphan, source_file, target_file,
+                                 [flagstore.ACK2_FLAG, message_id, orphan], [flagstore.ACK1_FLAG, orphan])
 
         # copy or write, it's a question. let's try from write content!
         # shutil.copyfile(source_file, target_file)
         logging.debug("Start to write ack1 content into local inbox folder!")
-        if not create_file(my_config, source_file, target_file, file_content, "ACK1"):
+        if not run_handoff(my_config, handoff, file_content):
             logging.error("Unexpected error happened in ack1 file creation!")
-            return
-
-        touch(ack2_flag)
-        logging.info("Successfully create an empty ack2 flag file:%s" % ack2_flag)
-        touch(file_tobedelete)
-        logging.info("Successfully create an empty file to be deleted:%s" % file_tobedelete)
-
-        try:
-            if not my_config.operation_method_is_move:
-                os.remove(source_file)
-                logging.info("Successfully removed original source file from remote orphan folder:%s" % source_file)
-            os.remove(file_tobedelete)
-            logging.info("Successfully removed flag of file to be deleted!")
-            os.remove(ack1_flag)
-            logging.info("Successfully removed ack1 flag!")
-        except IOError as (errno, strerror):
-            logging.error("process_ack1_file remove I/O error({0}): {1}".format(errno, strerror))
-        except Exception as e:
-            logging.exception("process_ack1_file remove Unexpected error:{0}".format(sys.exc_info()[0]))
+            return False
+        latency.record(my_config, latency.ACK1_STAGE, orphan, message_id)
+        return True
     except UnicodeDecodeError as ude:
-        logging.error(("%s has invalid content as ack1 file, error message:" % orphan)+ str(ude))
-        logging.exception("process_ack1_file UnicodeDecodeError: %s" % orphan)
+        logging.error("%s has invalid content as ack1 file, error message:%s", orphan, str(ude))
+        logging.exception("process_ack1_file UnicodeDecodeError: %s", orphan)
     except IOError as (errno, strerror):
         logging.error("process_ack1_file I/O error({0}): {1}".format(errno, strerror))
     except Exception as e:
-        logging.exception("process_ack1_file Unexpected error:", sys.exc_info()[0])
+        logging.exception("process_ack1_file Unexpected error:%s", sys.exc_info()[0])
+
+    return False
 
 
-def process_ack2_file(my_config, orphan, file_content):
+def process_ack2_file(my_config, orphan, file_content, ack_info=None):
     try:
-
-        message_id = get_messageid_from_ack2_content(file_content)
-        core_id = get_coreid_from_ack2_content(file_content)
+        if ack_info is None:
+            ack_info = ackparser.parse_ack_content(file_content)
+        message_id = ack_info.message_id
+        core_id = ack_info.core_id
 
         source_file = os.path.join(my_config.folder_remoteorphan, orphan)
         target_file = os.path.join(my_config.folder_localinbox, orphan)
-        ack2_flag = os.path.join(my_config.folder_ack2flag, message_id)
-        ack3_flag = os.path.join(my_config.folder_ack3flag, core_id)
-        file_tobedelete = os.path.join(my_config.folder_tobedeleted, orphan)
+        handoff = create_handoff('ACK2', orphan, source_file, target_file,
+                                 [flagstore.ACK3_FLAG, core_id, message_id], [flagstore.ACK2_FLAG, message_id])
 
         # shutil.copyfile(source_file, target_file)
         logging.debug("Start to write down content to ACK2 file!")
-        if not create_file(my_config, source_file, target_file, file_content, "ACK2"):
+        if not run_handoff(my_config, handoff, file_content):
             logging.error("Unexpected error happened in ack2 file creation!")
-            return
-
-        touch(ack3_flag)
-        logging.info("Successfully create an empty ack3 flag:%s" % ack3_flag)
-        touch(file_tobedelete)
-        logging.info("Successfully create an empty flag for file to be delete")
-
-        try:
-            if not my_config.operation_method_is_move:
-                os.remove(source_file)
-                logging.info("Successfully removed original source file:%s" % source_file)
-            os.remove(file_tobedelete)
-            logging.info("Successfully removed flag of file to be delete!")
-            os.remove(ack2_flag)
-            logging.info("Successfully removed ack2 flag!")
-        except IOError as (errno, strerror):
-            logging.error("process_ack2_file remove I/O error({0}): {1}".format(errno, strerror))
-        except Exception as e:
-            logging.exception("process_ack2_file remove Unexpected error:{0}".format(sys.exc_info()[0]))
+            return False
+        latency.record(my_config, latency.ACK2_STAGE, message_id, core_id)
+        return True
     except UnicodeDecodeError as ude:
-        logging.error(("%s has invalid content as ack2 file, error message:" % orphan)+ str(ude))
-        logging.exception("process_ack2_file UnicodeDecodeError: %s" % orphan)
+        logging.error("%s has invalid content as ack2 file, error message:%s", orphan, str(ude))
+        logging.exception("process_ack2_file UnicodeDecodeError: %s", orphan)
     except IOError as (errno, strerror):
         logging.error("process_ack2_file I/O error({0}): {1}".format(errno, strerror))
     except Exception as e:
         logging.exception("process_ack2_file Unexpected error:{0}".format(sys.exc_info()[0]))
 
+    return False
+
 
-def process_ack3_file(my_config, orphan, file_content):
+def process_ack3_file(my_config, orphan, file_content, ack_info=None):
     try:
-        core_id = get_coreid_from_ack3_content(file_content)
+        if ack_info is None:
+            ack_info = ackparser.parse_ack_content(file_content)
+        core_id = ack_info.core_id
         source_file = os.path.join(my_config.folder_remoteorphan, orphan)
         target_file = os.path.join(my_config.folder_localinbox, orphan)
-        ack3_flag = os.path.join(my_config.folder_ack3flag, core_id)
-        file_tobedelete = os.path.join(my_config.folder_tobedeleted, orphan)
+        handoff = create_handoff('ACK3', orphan, source_file, target_file, None, [flagstore.ACK3_FLAG, core_id])
 
         logging.debug("Start process_ack3_file...")
-        if not create_file(my_config, source_file, target_file, file_content, "ACK3"):
+        if not run_handoff(my_config, handoff, file_content):
             logging.error("Unexpected error happened in ack3 file creation!")
-            return
-
-        #logging.info("Start to create flag file to be deleted:%s" % file_tobedelete)
-        touch(file_tobedelete)
-        logging.info("Successfully created an empty flag file to be deleted")
-
-        try:
-            if not my_config.operation_method_is_move:
-                os.remove(source_file)
-                logging.info("Successfully removed original source file:%s" % source_file)
-            os.remove(file_tobedelete)
-            logging.info("Successfully removed flag file to be deleted!")
-            os.remove(ack3_flag)
-            logging.info("Successfully removed ack3 flag!")
-        except IOError as (errno, strerror):
-            logging.error("process_ack3_file remove I/O error({0}): {1}".format(errno, strerror))
-        except Exception as e:
-            logging.exception("process_ack3_file remove Unexpected error:{0}".format(sys.exc_info()[0]))
+            return False
+        latency.record(my_config, latency.ACK3_STAGE, core_id)
+        return True
     except UnicodeDecodeError as ude:
-        logging.error(("%s has invalid content as ack3 file, error message:" % orphan)+ str(ude))
-        logging.exception("process_ack3_file UnicodeDecodeError: %s" % orphan)
+        logging.error("%s has invalid content as ack3 file, error message:%s", orphan, str(ude))
+        logging.exception("process_ack3_file UnicodeDecodeError: %s", orphan)
     except IOError as (errno, strerror):
         logging.error("process_ack3_file I/O error({0}): {1}".format(errno, strerror))
     except Exception as e:
         logging.exception("process_ack3_file Unexpected error:{0}".format(sys.exc_info()[0]))
 
+    return False
 
-def process_orphan_acks(my_config):
-    logging.info("Start to process ack(s) folder...")
-    ack1_flag_files = get_file_list(my_config.folder_ack1flag)
-    logging.debug("ACK1, ACK2, ACK3, Orphan list:")
-    logging.debug(ack1_flag_files)
-    ack2_flag_files = get_file_list(my_config.folder_ack2flag)
-    logging.debug(ack2_flag_files)
-    ack3_flag_files = get_file_list(my_config.folder_ack3flag)
-    logging.debug(ack3_flag_files)
-
-    orphan_files = get_file_list(my_config.folder_remoteorphan)
-    logging.debug(orphan_files)
-
-    for orphan in orphan_files:
-        # in order for safe access, read all it's content first.
-        logging.info("Proccessing %s from ack(s) folder." % orphan)
+
+def create_handoff(ack_type, orphan, source_file, target_file, add_flag, remove_flag):
+    '''
+    :param add_flag: [kind, name, parent] of the flag the next ack is matched with, None for ACK3
+    :param remove_flag: [kind, name] of the flag this ack has been matched with
+    :return: journal record of handing one ack over from remote orphan to local inbox
+    '''
+    return {'type': ack_type, 'orphan': orphan, 'source': source_file, 'target': target_file,
+            'add': add_flag, 'remove': remove_flag}
+
+
+def run_handoff(my_config, handoff, file_content):
+    '''
+    journal the hand-off, transfer the ack and finish the hand-off.
+    the journal record stays open if anything fails after the transfer, replay_handoffs finishes it.
+    :return: False if the ack couldn't be transferred
+    '''
+    # a flag without a name, e.g. of an ACK2 without CoreId, fails here before anything has been transferred
+    for flag in [handoff['add'], handoff['remove']]:
+        if flag is not None and not flag[1]:
+            raise ValueError("%s %s has no name for its %s flag" % (handoff['type'], handoff['orphan'], flag[0]))
+
+    handoff_journal = journal.get_journal(my_config)
+    seq = handoff_journal.begin(handoff)
+    journal.reached(journal.BEGUN_STEP)
+
+    if not create_file(my_config, handoff['source'], handoff['target'], file_content, handoff['type']):
+        # nothing has changed, the ack is picked up again next time
+        handoff_journal.done(seq)
+        return False
+    journal.reached(journal.TRANSFERRED_STEP)
+
+    # a duplicate dropped by dedup has been delivered before, its flags move on all the same
+    finish_handoff(my_config, handoff)
+    handoff_journal.done(seq)
+    return True
+
+
+def finish_handoff(my_config, handoff):
+    '''
+    add the next flag, remove the source and the flag of this ack. every step can be repeated,
+    a missing source or flag means it has been done before.
+    '''
+    flag_store = flagstore.get_flag_store(my_config)
+    metrics_registry = metrics.get_metrics(my_config)
+
+    if handoff['add']:
+        kind, name, parent = handoff['add']
+        with metrics_registry.time(metrics.STAGE_SECONDS, {'stage': 'flag'}):
+            flag_store.add(kind, name, parent)
+            flag_store.commit()
+        logging.info("Successfully create an empty %s flag:%s", kind, flag_store.describe(kind, name))
+    journal.reached(journal.FLAG_ADDED_STEP)
+
+    if not my_config.operation_method_is_move:
         try:
-            file_content = read_content_from_orphan(my_config, orphan)
-            ack_type, is_for_ccm = detect_ack_file(my_config, orphan, file_content,
-                                                   ack1_flag_files, ack2_flag_files, ack3_flag_files)
-            if is_for_ccm:
-                logging.debug("\tFound ACK type:%s" % ack_type)
-                if ack_type == 'ACK1':
-                    process_ack1_file(my_config, orphan, file_content)
-                elif ack_type == 'ACK2':
-                    process_ack2_file(my_config, orphan, file_content)
-                elif ack_type == 'ACK3':
-                    process_ack3_file(my_config, orphan, file_content)
-            else:
-                logging.debug("\tThis file is not for CCM!")
+            os.remove(handoff['source'])
+            logging.info("Successfully removed original source file from remote orphan folder:%s",
+                         handoff['source'])
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    journal.reached(journal.SOURCE_REMOVED_STEP)
+
+    kind, name = handoff['remove']
+    with metrics_registry.time(metrics.STAGE_SECONDS, {'stage': 'flag'}):
+        try:
+            flag_store.remove(kind, name)
+        except OSError as e:
+            # the flag index reports a missing flag without errno
+            if e.errno not in (None, errno.ENOENT):
+                raise
+            logging.debug("%s flag %s has been removed before.", kind, name)
+        flag_store.commit()
+    logging.info("Successfully removed %s flag!", kind)
+    journal.reached(journal.FLAG_REMOVED_STEP)
+
+
+def remove_stale_temp_files(my_config, max_age=3600):
+    '''
+    remove the hidden temp files transfers of a crashed process left in the folders they write into.
+    the sources of those transfers are still in place, so nothing but the temp file is lost.
+    :param max_age: seconds a temp file is left alone, another instance might still be writing it
+    :return: number of files removed
+    '''
+    folders = [my_config.folder_remoteoutbox, my_config.folder_localinbox, my_config.folder_ack1flag]
+    if my_config.folder_quarantine:
+        folders.extend(os.path.join(my_config.folder_quarantine, 'duplicates', kind)
+                       for kind in [dedup.HL7_DIGESTS, dedup.ACK_DIGESTS])
+    return sum(transfer.remove_stale_temp_files(folder, max_age) for folder in folders)
+
 
-        except IOError as (errno, strerror):
-            logging.error("I/O error({0}): {1}".format(errno, strerror))
+def replay_handoffs(my_config):
+    '''
+    finish every hand-off a previous process left open in the journal, then empty the journal.
+    an ack still in remote orphan folder is transferred again, the transfer might not have completed.
+    :return: number of hand-offs finished
+    '''
+    handoff_journal = journal.get_journal(my_config)
+    finished = 0
+    for handoff in handoff_journal.open_records():
+        logging.warning("Replaying unfinished hand-off of %s %s", handoff['type'], handoff['orphan'])
+        try:
+            if os.path.exists(handoff['source']):
+                if my_config.operation_method_is_move:
+                    transfer.move_file(handoff['source'], handoff['target'])
+                else:
+                    transfer.copy_file(handoff['source'], handoff['target'])
+                logging.info("Successfully transferred %s to %s again", handoff['source'], handoff['target'])
+                process_ack_shell_commands(my_config, handoff['target'])
+            elif not os.path.exists(handoff['target']):
+                logging.error("%s is neither in remote orphan nor in local inbox, hand-off dropped!",
+                              handoff['orphan'])
+                handoff_journal.done(handoff['seq'])
+                continue
+
+            finish_handoff(my_config, handoff)
+            handoff_journal.done(handoff['seq'])
+            finished += 1
         except Exception as e:
-            logging.exception("process_orphan_acks Unexpected error:{0}".format(sys.exc_info()[0]))
+            logging.exception("Unable to replay hand-off of %s:%s", handoff['orphan'], str(e))
+
+    hooks.get_hook_executor(my_config).flush()
+    handoff_journal.checkpoint()
+    return finished
+
+
+def process_orphan_acks(my_config, orphan_files=None, budget=None):
+    '''
+    detect and process acks in remote orphan folder
+    :param my_config:
+    :param orphan_files: only process these file names, None means everything in remote orphan folder
+    :param budget: stages.stage_budget limiting the files and seconds of this pass, None means no limit
+    :return: number of acks for CCM found
+    '''
+    logging.info("Start to process ack(s) folder...")
+    flag_store = flagstore.get_flag_store(my_config)
+    ack1_flag_files = flag_store.names(flagstore.ACK1_FLAG)
+    logging.debug("ACK1, ACK2, ACK3, Orphan list:")
+    util.log_payload(ack1_flag_files)
+    ack2_flag_files = flag_store.names(flagstore.ACK2_FLAG)
+    util.log_payload(ack2_flag_files)
+    ack3_flag_files = flag_store.names(flagstore.ACK3_FLAG)
+    util.log_payload(ack3_flag_files)
+
+    metrics_registry = metrics.get_metrics(my_config)
+    negative_cache = filecache.get_negative_orphan_cache(my_config)
+    retry_queue = retry.get_retry_queue(my_config)
+    if orphan_files is None:
+        with metrics_registry.time(metrics.STAGE_SECONDS, {'stage': 'list'}):
+            orphan_files = get_file_list(my_config.folder_remoteorphan)
+        metrics_registry.set_gauge(metrics.BACKLOG_FILES, len(orphan_files), {'folder': 'remoteorphan'})
+        if metrics_registry.enabled:
+            metrics_registry.set_gauge(metrics.BACKLOG_FILES, len(ack1_flag_files), {'folder': 'ack1flag'})
+            metrics_registry.set_gauge(metrics.BACKLOG_FILES, len(ack2_flag_files), {'folder': 'ack2flag'})
+            metrics_registry.set_gauge(metrics.BACKLOG_FILES, len(ack3_flag_files), {'folder': 'ack3flag'})
+        # against the full listing, orphans not stable yet or claimed by another instance keep their entries
+        if negative_cache is not None:
+            negative_cache.evict_missing(orphan_files)
+        if retry_queue is not None:
+            retry_queue.evict_missing(retry.ORPHAN_RETRIES, orphan_files)
+    orphan_files = stability.get_ready_files(my_config, my_config.folder_remoteorphan, orphan_files)
+    claim_manager = claims.get_claim_manager(my_config)
+    orphan_files = claim_manager.select(my_config.folder_remoteorphan, orphan_files)
+    util.log_payload(orphan_files)
+
+    orphan_files = retry.select(my_config, retry.ORPHAN_RETRIES, orphan_files)
+    if budget is not None:
+        orphan_files = budget.start(orphan_files)
+
+    def classify_one(orphan):
+        if budget is not None and budget.expired():
+            budget.leave([orphan])
+            return None
+        return classify_orphan(my_config, orphan, ack1_flag_files, ack2_flag_files, ack3_flag_files,
+                               negative_cache)
+
+    # read and detect every orphan against the flags listed above, then process the ones for CCM.
+    classified = workers.run_tasks(classify_one, orphan_files, my_config.ack_worker_count, "ack-read")
+    detected_acks = [one_ack for one_ack in classified if one_ack]
+    if negative_cache is not None:
+        negative_cache.save()
+
+    # acks sharing a flag are processed by the same worker in listing order, so the
+    # ACK1 -> ack2 flag -> ACK2 -> ack3 flag -> ACK3 hand-off never races between workers.
+    ack_groups = workers.group_items(detected_acks, get_ack_correlation_keys)
+
+    def process_group(ack_group):
+        if budget is not None and budget.expired():
+            budget.leave([detected_ack[0] for detected_ack in ack_group])
+            return
+        for orphan, file_content, ack_type, ack_info in ack_group:
+            with claim_manager.claim(claims.ORPHAN_CLAIMS, my_config.folder_remoteorphan, orphan) as orphan_claim:
+                if orphan_claim:
+                    process_ack_file(my_config, orphan, file_content, ack_type, ack_info)
+
+    workers.run_tasks(process_group, ack_groups, my_config.ack_worker_count, "ack")
+    hooks.get_hook_executor(my_config).flush()
+    journal.get_journal(my_config).checkpoint()
+    retry.save(my_config)
+    dedup.save(my_config)
     logging.info("Processing in ack(s) folder has been finished!")
+    return len(detected_acks)
 
 
-def process_folders(my_config):
+def classify_orphan(my_config, orphan, ack1_flag_files, ack2_flag_files, ack3_flag_files, negative_cache=None):
+    '''
+    read one orphan and detect its ack type.
+    :param negative_cache: filecache.negative_orphan_cache, unchanged orphans known not for CCM are not read again
+    :return: (orphan, file_content, ack_type, ack_info) if it's an ack for CCM, otherwise None
+    '''
+    identity = None
+    if negative_cache is not None:
+        identity = filecache.get_file_identity(os.path.join(my_config.folder_remoteorphan, orphan))
+        if negative_cache.can_skip(orphan, identity, ack1_flag_files, ack2_flag_files, ack3_flag_files):
+            logging.debug("%s is unchanged and still not for CCM, skipped.", orphan)
+            return None
+
+    # in order for safe access, read all it's content first.
+    logging.info("Proccessing %s from ack(s) folder.", orphan)
+    try:
+        file_content = read_content_from_orphan(my_config, orphan)
+        ack_info = ackparser.parse_ack_content(file_content)
+        ack_type, is_for_ccm = detect_ack_file(my_config, orphan, file_content,
+                                               ack1_flag_files, ack2_flag_files, ack3_flag_files, ack_info)
+        if is_for_ccm:
+            logging.debug("\tFound ACK type:%s", ack_type)
+            return orphan, file_content, ack_type, ack_info
+        else:
+            logging.debug("\tThis file is not for CCM!")
+            # readable again, it waits for its flag like any other orphan
+            retry.record(my_config, retry.ORPHAN_RETRIES, my_config.folder_remoteorphan, orphan, True)
+            if identity is not None:
+                correlation_id = ack_info.message_id if ack_type == 'ACK2' else ack_info.core_id
+                negative_cache.add(orphan, identity, ack_type, correlation_id)
+
+    except IOError as (errno, strerror):
+        logging.error("I/O error({0}): {1}".format(errno, strerror))
+        metrics.get_metrics(my_config).inc(metrics.ERRORS_TOTAL, {'stage': 'orphan_read'})
+        retry.record(my_config, retry.ORPHAN_RETRIES, my_config.folder_remoteorphan, orphan, False, 'read')
+    except Exception as e:
+        logging.exception("process_orphan_acks Unexpected error:{0}".format(sys.exc_info()[0]))
+        metrics.get_metrics(my_config).inc(metrics.ERRORS_TOTAL, {'stage': 'orphan_read'})
+        retry.record(my_config, retry.ORPHAN_RETRIES, my_config.folder_remoteorphan, orphan, False, 'read')
+
+    return None
+
+
+def get_ack_correlation_keys(detected_ack):
+    ''' flags an ack reads or writes, acks sharing any of them must not be processed concurrently
+    '''
+    orphan, file_content, ack_type, ack_info = detected_ack
+    if ack_type == 'ACK1':
+        return [('ack1', orphan), ('ack2', ack_info.ack1_message_id)]
+    elif ack_type == 'ACK2':
+        return [('ack2', ack_info.message_id), ('ack3', ack_info.core_id)]
+    elif ack_type == 'ACK3':
+        return [('ack3', ack_info.core_id)]
+    return []
+
+
+def process_ack_file(my_config, orphan, file_content, ack_type, ack_info=None):
+    '''
+    :return: True if the ack has been handed over to local inbox folder
+    '''
+    metrics_registry = metrics.get_metrics(my_config)
+    handed_over = False
+    try:
+        with metrics_registry.time(metrics.FILE_SECONDS, {'type': ack_type}):
+            if ack_type == 'ACK1':
+                handed_over = process_ack1_file(my_config, orphan, file_content, ack_info)
+            elif ack_type == 'ACK2':
+                handed_over = process_ack2_file(my_config, orphan, file_content, ack_info)
+            elif ack_type == 'ACK3':
+                handed_over = process_ack3_file(my_config, orphan, file_content, ack_info)
+        metrics_registry.inc(metrics.FILES_TOTAL, {'type': ack_type})
+    except IOError as (errno, strerror):
+        logging.error("I/O error({0}): {1}".format(errno, strerror))
+        metrics_registry.inc(metrics.ERRORS_TOTAL, {'stage': ack_type})
+    except Exception as e:
+        metrics_registry.inc(metrics.ERRORS_TOTAL, {'stage': ack_type})
+        logging.exception("process_orphan_acks Unexpected error:{0}".format(sys.exc_info()[0]))
+
+    retry.record(my_config, retry.ORPHAN_RETRIES, my_config.folder_remoteorphan, orphan, handed_over, ack_type)
+    return handed_over
+
+
+def process_folders(my_config, skip_unchanged=False):
+    '''
+    :param skip_unchanged: skip the pass of a stage whose folders haven't changed since its previous pass
+    :return: number of HL7 messages and acks handled
+    '''
     logging.info("Start processing")
-    process_hl7_message(my_config)
-    process_orphan_acks(my_config)
+    metrics_registry = metrics.get_metrics(my_config)
+    with profiler.get_profiler(my_config).cycle(), metrics_registry.time(metrics.CYCLE_SECONDS):
+        work_count = 0
+        for stage in stages.get_coordinator(my_config).next_order():
+            if skip_unchanged:
+                work_count += process_changed_stage(my_config, stage)
+            else:
+                work_count += process_stage(my_config, stage)
+    finish_pass(my_config)
+    metrics_registry.export()
+    return work_count
+
+
+def process_stage(my_config, stage):
+    '''
+    one pass of the HL7 or ACK stage within its budget
+    :return: number of HL7 messages or acks handled
+    '''
+    budget = stages.get_budget(my_config, stage)
+    if stage == stages.HL7_STAGE:
+        return process_hl7_message(my_config, budget=budget)
+    return process_orphan_acks(my_config, budget=budget)
+
+
+def get_stage_folders(my_config, stage):
+    if stage == stages.HL7_STAGE:
+        return [my_config.folder_localoutbox]
+    return [my_config.folder_remoteorphan, my_config.folder_ack1flag, my_config.folder_ack2flag,
+            my_config.folder_ack3flag]
+
+
+def get_stage_watch(my_config, stage):
+    '''
+    :return: stages.stage_watch of stage, None if watch_rescan_interval is 0 or less
+    '''
+    if my_config.watch_rescan_interval <= 0:
+        return None
+
+    watches = getattr(my_config, 'stage_watches', None)
+    if watches is None:
+        # keyed by inode only, so scandir lists a folder without a stat per file. a file rewritten
+        # under the same name is picked up by the rescan every watch_rescan_interval seconds.
+        folder_scanner = scanner.folder_scanner(get_scan_observer(my_config))
+        for one_stage in stages.STAGES:
+            for folder in get_stage_folders(my_config, one_stage):
+                folder_scanner.add_folder(folder)
+        watches = dict((one_stage, stages.stage_watch(folder_scanner, get_stage_folders(my_config, one_stage),
+                                                      my_config.watch_rescan_interval))
+                       for one_stage in stages.STAGES)
+        my_config.stage_watches = watches
+    return watches[stage]
+
+
+def has_pending_work(my_config, stage):
+    ''' work of stage which doesn't show up as a change of its folders
+    '''
+    if stages.get_budget(my_config, stage).leftovers():
+        return True
+    # files of other partitions, and claims of other instances, are released as time goes by
+    if claims.get_claim_manager(my_config).enabled or my_config.instance_count > 1:
+        return True
+    retry_queue = retry.get_retry_queue(my_config)
+    if retry_queue is not None and len(retry_queue) > 0:
+        return True
+    tracker = stability.get_tracker(my_config)
+    return bool(tracker and tracker.pending())
+
+
+def process_changed_stage(my_config, stage):
+    '''
+    one pass of the HL7 or ACK stage, unless none of its folders has changed and nothing else is pending.
+    a new flag could make any waiting orphan match, so flags created by this process count as a change too.
+    :return: number of HL7 messages or acks handled, 0 if the pass has been skipped
+    '''
+    stage_watch = get_stage_watch(my_config, stage)
+    if stage_watch is None:
+        return process_stage(my_config, stage)
+
+    state = flagstore.get_flag_store(my_config).generation if stage == stages.ACK_STAGE else None
+    if not stage_watch.needs_pass(has_pending_work(my_config, stage), state):
+        logging.info("%s stage: nothing has changed, pass skipped.", stage)
+        metrics.get_metrics(my_config).inc(metrics.SKIPPED_PASSES_TOTAL, {'stage': stage})
+        return 0
+
+    work_count = process_stage(my_config, stage)
+    stage_watch.passed(work_count, state)
+    return work_count
+
+
+def finish_pass(my_config):
+    ''' housekeeping after the stages of a pass
+    '''
+    flagstore.migrate_flat_flags(my_config)
+    flagstore.purge_removed_flags(my_config)
+    claims.get_claim_manager(my_config).sweep({claims.HL7_CLAIMS: my_config.folder_localoutbox,
+                                               claims.ORPHAN_CLAIMS: my_config.folder_remoteorphan})
+
+
+def run_periodically(my_config):
+    '''
+    sleep time adapts to the work found: min_sleeptime after a busy pass, growing up to max_sleeptime while idle.
+    '''
+    if my_config.concurrent_stages:
+        run_stages_concurrently(my_config)
+        return
+
+    schedule = scheduler.get_scheduler(my_config)
+    schedule.install_signal_handler()
+    tracker = stability.get_tracker(my_config)
+    try:
+        while True:
+            work_count = process_folders(my_config, skip_unchanged=True)
+            # files the budgets have left over keep the sleep time short
+            sleeptime = schedule.next_interval(work_count + stages.get_leftover_count(my_config))
+            if tracker and tracker.pending():
+                # files still being written are looked at again once they could be quiet.
+                sleeptime = min(sleeptime, tracker.quiet_period)
+            logging.info("%d file(s) handled, sleeping %.1f seconds...\n\n", work_count, sleeptime)
+            if schedule.wait(sleeptime):
+                logging.info("Woken up before the end of sleep time!")
+    except KeyboardInterrupt:
+        logging.info("Process stopped!")
+
+
+def prepare_shared_state(my_config):
+    ''' create everything both stages share, before their threads race to create it twice
+    '''
+    flagstore.get_flag_store(my_config)
+    filecache.get_hl7_verdict_cache(my_config)
+    filecache.get_negative_orphan_cache(my_config)
+    stability.get_tracker(my_config)
+    hooks.get_hook_executor(my_config)
+    latency.get_latency_recorder(my_config)
+    journal.get_journal(my_config)
+    claims.get_claim_manager(my_config)
+    retry.get_retry_queue(my_config)
+    profiler.get_profiler(my_config)
+    stages.get_coordinator(my_config)
+    for stage in stages.STAGES:
+        stages.get_budget(my_config, stage)
+        get_stage_watch(my_config, stage)
+
+
+def run_stages_concurrently(my_config, stopped=None):
+    '''
+    run the HL7 and ACK stages each in its own thread with its own adaptive sleep time, so a long HL7 pass
+    doesn't hold back acks or the other way round. stage_order decides which stage goes first when both want to run.
+    :param stopped: threading.Event ending both stages once set, they run until interrupted otherwise
+    '''
+    if stopped is None:
+        stopped = threading.Event()
+    prepare_shared_state(my_config)
+    coordinator = stages.get_coordinator(my_config)
+    metrics_registry = metrics.get_metrics(my_config)
+    tracker = stability.get_tracker(my_config)
+
+    schedules = dict((stage, scheduler.create_scheduler(my_config)) for stage in stages.STAGES)
+    scheduler.link_schedulers(list(schedules.values()))
+    schedules[stages.HL7_STAGE].install_signal_handler()
+
+    def run_stage(stage):
+        schedule = schedules[stage]
+        budget = stages.get_budget(my_config, stage)
+        try:
+            while not stopped.is_set():
+                with coordinator.running(stage), profiler.get_profiler(my_config).cycle(stage), \
+                        metrics_registry.time(metrics.CYCLE_SECONDS, {'stage': stage}):
+                    work_count = process_changed_stage(my_config, stage)
+                if stage == stages.ACK_STAGE:
+                    finish_pass(my_config)
+                metrics_registry.export()
+
+                sleeptime = schedule.next_interval(work_count + len(budget.leftovers()))
+                if tracker and tracker.pending():
+                    sleeptime = min(sleeptime, tracker.quiet_period)
+                logging.info("%s stage: %d file(s) handled, sleeping %.1f seconds...", stage, work_count, sleeptime)
+                schedule.wait(sleeptime)
+        except Exception:
+            logging.exception("%s stage has been stopped by an unexpected error!", stage)
+        finally:
+            # one stage alone is not worth running
+            stopped.set()
+            schedule.wake_all()
+
+    threads = []
+    for stage in stages.STAGES:
+        thread = threading.Thread(target=run_stage, args=(stage,), name="%s-stage" % stage)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        # waiting with a timeout keeps KeyboardInterrupt working
+        while not stopped.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        logging.info("Process stopped!")
+        stopped.set()
+    finally:
+        for schedule in schedules.values():
+            schedule.wake()
+        for thread in threads:
+            thread.join()
+
+
+def get_next_rescan(my_config):
+    ''' files the budgets have left over are picked up by another full pass right away
+    '''
+    if stages.get_leftover_count(my_config):
+        return time.time()
+    return time.time() + my_config.watch_rescan_interval
+
+
+def get_changed_files(folder, file_names):
+    ''' keep names which still exist as regular, non hidden files in folder
+    '''
+    return [f for f in sorted(set(file_names))
+            if (not f.startswith('.')) and os.path.isfile(os.path.join(folder, f))]
+
+
+def create_folder_watcher(my_config):
+    folder_watcher = watcher.inotify_watcher()
+    try:
+        folder_watcher.add_folder(my_config.folder_localoutbox, watcher.FILE_READY_MASK)
+        folder_watcher.add_folder(my_config.folder_remoteorphan, watcher.FILE_READY_MASK)
+        folder_watcher.add_folder(my_config.folder_ack1flag, watcher.FLAG_CHANGE_MASK)
+        folder_watcher.add_folder(my_config.folder_ack2flag, watcher.FLAG_CHANGE_MASK)
+        folder_watcher.add_folder(my_config.folder_ack3flag, watcher.FLAG_CHANGE_MASK)
+    except:
+        folder_watcher.close()
+        raise
+    return folder_watcher
+
+
+def dispatch_watch_events(my_config, events):
+    '''
+    process only the files reported by the watcher.
+    a new flag could make any waiting orphan match, so flag changes trigger a pass over the whole orphan folder.
+    '''
+    with profiler.get_profiler(my_config).cycle("dispatch"):
+        dispatch_events(my_config, events)
+    metrics.get_metrics(my_config).export()
+
+
+def dispatch_events(my_config, events):
+    flag_store = flagstore.get_flag_store(my_config)
+    flag_generation = flag_store.generation
+    hl7_files = []
+    orphan_files = []
+    flag_changed = False
+    flag_folders = (my_config.folder_ack1flag, my_config.folder_ack2flag, my_config.folder_ack3flag)
+
+    for folder, file_name, mask in events:
+        if folder == my_config.folder_localoutbox:
+            hl7_files.append(file_name)
+        elif folder == my_config.folder_remoteorphan:
+            orphan_files.append(file_name)
+        elif folder in flag_folders:
+            flag_changed = True
+
+    hl7_files = get_changed_files(my_config.folder_localoutbox, hl7_files)
+    if hl7_files:
+        process_hl7_message(my_config, hl7_files)
+
+    if flag_changed:
+        process_orphan_acks(my_config)
+    else:
+        orphan_files = get_changed_files(my_config.folder_remoteorphan, orphan_files)
+        if orphan_files:
+            process_orphan_acks(my_config, orphan_files)
+
+    # flags kept in the index or in shard subfolders don't show up as inotify events
+    while (not flag_store.uses_folders) and flag_store.generation != flag_generation:
+        flag_generation = flag_store.generation
+        process_orphan_acks(my_config)
+
+
+def watch_folders(my_config):
+    '''
+    event driven replacement of run_periodically: inotify events dispatch changed files right away,
+    and a full pass still runs every watch_rescan_interval seconds as a safety net.
+    '''
+    if not watcher.inotify_available():
+        logging.warning("inotify is not available on this platform, falling back to polling snapshots!")
+        poll_folders(my_config)
+        return
+
+    try:
+        folder_watcher = create_folder_watcher(my_config)
+    except OSError as e:
+        logging.error("Unable to watch folders:%s, falling back to polling snapshots!", str(e))
+        poll_folders(my_config)
+        return
+
+    try:
+        process_folders(my_config)
+        next_rescan = get_next_rescan(my_config)
+        tracker = stability.get_tracker(my_config)
+        while True:
+            timeout = max(0, next_rescan - time.time())
+            pending_files = tracker.pending() if tracker else []
+            if pending_files:
+                # files still being written are looked at again once they could be quiet.
+                timeout = min(timeout, tracker.quiet_period)
+
+            events = folder_watcher.read_events(timeout)
+            # our own flag and file operations show up as events too, drain them into the same batch.
+            events.extend(folder_watcher.read_events(0))
+            events.extend((folder, file_name, 0) for folder, file_name in pending_files)
+
+            if folder_watcher.overflowed or time.time() >= next_rescan:
+                folder_watcher.overflowed = False
+                logging.info("Start safety rescan of all folders...")
+                process_folders(my_config)
+                next_rescan = get_next_rescan(my_config)
+            elif events:
+                logging.debug("Dispatching %d watch event(s)", len(events))
+                dispatch_watch_events(my_config, events)
+    except KeyboardInterrupt:
+        logging.info("Process stopped!")
+    finally:
+        folder_watcher.close()
+
+
+def get_scan_observer(my_config):
+    ''' on_scan of scanner.folder_scanner, the time of every scan goes into metrics
+    '''
+    metrics_registry = metrics.get_metrics(my_config)
+    folder_labels = {my_config.folder_localoutbox: 'localoutbox', my_config.folder_remoteorphan: 'remoteorphan',
+                     my_config.folder_ack1flag: 'ack1flag', my_config.folder_ack2flag: 'ack2flag',
+                     my_config.folder_ack3flag: 'ack3flag'}
+
+    def observe_scan(folder, seconds, file_count):
+        metrics_registry.observe(metrics.SCAN_SECONDS, seconds, {'folder': folder_labels.get(folder, folder)})
+
+    return observe_scan
+
+
+def create_folder_scanner(my_config):
+    folder_scanner = scanner.folder_scanner(get_scan_observer(my_config))
+    # HL7 messages and orphans could be rewritten under the same name, flags are only created and removed.
+    folder_scanner.add_folder(my_config.folder_localoutbox, detect_changes=True)
+    folder_scanner.add_folder(my_config.folder_remoteorphan, detect_changes=True)
+    folder_scanner.add_folder(my_config.folder_ack1flag)
+    folder_scanner.add_folder(my_config.folder_ack2flag)
+    folder_scanner.add_folder(my_config.folder_ack3flag)
+    return folder_scanner
+
+
+def get_scan_events(folder_scanner):
+    ''' added and changed files of every folder since its previous scan, in the form of watch events
+    '''
+    events = []
+    for folder, changes in folder_scanner.scan_all():
+        events.extend((folder, file_name, 0) for file_name in changes.added + changes.changed)
+    return events
+
+
+def poll_folders(my_config):
+    '''
+    replacement of watch_folders where inotify is not available: every sleeptime seconds the folders are
+    compared with their previous snapshot and only added or changed files are dispatched.
+    a full pass still runs every watch_rescan_interval seconds as a safety net.
+    '''
+    folder_scanner = create_folder_scanner(my_config)
+    try:
+        # the first scan only takes the snapshots, process_folders handles everything already there.
+        folder_scanner.scan_all()
+        process_folders(my_config)
+        next_rescan = get_next_rescan(my_config)
+        tracker = stability.get_tracker(my_config)
+        while True:
+            timeout = min(my_config.sleeptime, max(0, next_rescan - time.time()))
+            pending_files = tracker.pending() if tracker else []
+            if pending_files:
+                timeout = min(timeout, tracker.quiet_period)
+            logging.info("sleeping...\n\n")
+            time.sleep(timeout)
+
+            events = get_scan_events(folder_scanner)
+            events.extend((folder, file_name, 0) for folder, file_name in pending_files)
+
+            if time.time() >= next_rescan:
+                logging.info("Start safety rescan of all folders...")
+                process_folders(my_config)
+                next_rescan = get_next_rescan(my_config)
+            elif events:
+                logging.debug("Dispatching %d scan event(s)", len(events))
+                dispatch_watch_events(my_config, events)
+    except KeyboardInterrupt:
+        logging.info("Process stopped!")
 
 
 def main():
@@ -485,6 +1301,14 @@ def main():
                         help="configuration file")
     parser.add_argument('-p', action="store_true", dest="periodical", required=False, default=False,
                         help="periodically run with interval time defined in configuration.")
+    parser.add_argument('-w', '--watch', action="store_true", dest="watch", required=False, default=False,
+                        help="watch folders with inotify and process changed files right away.")
+    parser.add_argument('--profile', action="store", dest="profile", type=int, nargs='?', const=1, default=None,
+                        metavar="N", help="profile every Nth pass (default every pass) into the log folder. "
+                                          "kill -USR1 switches profiling on or off in a running process.")
+    parser.add_argument('--profile-memory', action="store", dest="profile_memory", type=int, nargs='?', const=10,
+                        default=0, metavar="FRAMES",
+                        help="take tracemalloc snapshots of profiled passes, keeping FRAMES frames per allocation.")
 
     args = parser.parse_args()
     if not args.configuration:
@@ -494,20 +1318,33 @@ def main():
     if args.logpath:
         util.initialize_logger(args.logpath)
     else:
-        util.initialize_logger(my_config.folder_logs, my_config.stdout_log, my_config.all_file_log)
+        util.initialize_logger(my_config.folder_logs, my_config.stdout_log, my_config.all_file_log,
+                               my_config.log_max_bytes, my_config.log_async, my_config.log_payload_max_bytes)
 
     logging.info("Configuration and Logs have been settled down!")
+    if not scanner.scandir_available():
+        logging.warning("scandir is not installed, listing a folder costs a stat per file. "
+                        "please pip install scandir!")
 
-    if args.periodical:
-        try:
-            while True:
-                process_folders(my_config)
-                logging.info("sleeping...\n\n")
-                time.sleep(my_config.sleeptime)
-        except KeyboardInterrupt:
-            logging.info("Process stopped!")
-    else:
-        process_folders(my_config)
+    my_config.cycle_profiler = profiler.cycle_profiler(args.logpath or my_config.folder_logs, args.profile or 1,
+                                                       args.profile_memory, enabled=args.profile is not None)
+    my_config.cycle_profiler.install_signal_handler()
+
+    try:
+        remove_stale_temp_files(my_config)
+        replay_handoffs(my_config)
+        if args.watch:
+            watch_folders(my_config)
+        elif args.periodical:
+            run_periodically(my_config)
+        else:
+            process_folders(my_config)
+    finally:
+        hooks.close_hook_executor(my_config)
+        journal.close_journal(my_config)
+        claims.close_claim_manager(my_config)
+        validation.close_validation_pool(my_config)
+        metrics.get_metrics(my_config).close()
 
 
 
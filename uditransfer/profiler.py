@@ -0,0 +1,223 @@
+import os
+import time
+import signal
+import logging
+import cProfile
+import pstats
+import threading
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# number of functions and allocation sites written into the text report
+REPORT_LINES = 40
+
+TOGGLE_SIGNAL = getattr(signal, 'SIGUSR1', None)
+
+# cycle_profile of the pass running in a thread, cProfile only sees the thread it's enabled in
+_active = threading.local()
+
+
+def tracemalloc_available():
+    return tracemalloc is not None
+
+
+class cycle_profiler():
+    '''
+    profiles every Nth pass over the folders with cProfile into output_dir:
+    profile-<name>-<time>-<n>.pstats for pstats or snakeviz, and a .txt report of the top functions.
+    with memory_frames above 0, a tracemalloc snapshot is taken after the same passes:
+    memory-<name>-<time>-<n>.tracemalloc, and a .txt report of the top allocation sites and their growth
+    since the previous snapshot.
+    '''
+    def __init__(self, output_dir, every=1, memory_frames=0, enabled=True):
+        self.output_dir = output_dir
+        self.every = max(1, every)
+        self.memory_frames = memory_frames
+        self.enabled = enabled
+        self.cycles = 0
+        self.profiled = 0
+        self.__previous_snapshot = None
+        self.__lock = threading.Lock()
+
+        if memory_frames > 0 and not tracemalloc_available():
+            logging.warning("tracemalloc is not available in this python, no memory snapshots!")
+            self.memory_frames = 0
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        # the next pass is profiled right away instead of waiting for the Nth one
+        self.cycles = 0
+        return self.enabled
+
+    def install_signal_handler(self, signal_number=TOGGLE_SIGNAL):
+        '''
+        kill -USR1 <pid> switches profiling on or off in a running process.
+        :return: True if the handler is installed
+        '''
+        if signal_number is None:
+            logging.warning("No signal to toggle profiling on this platform!")
+            return False
+
+        def handler(signum, frame):
+            # only flip the flag here, the next pass picks it up
+            self.toggle()
+
+        signal.signal(signal_number, handler)
+        return True
+
+    def cycle(self, name="cycle"):
+        '''
+        context manager around one pass, only every Nth pass is profiled while enabled.
+        '''
+        if not self.enabled:
+            return null_profile()
+
+        self.cycles += 1
+        if (self.cycles - 1) % self.every != 0:
+            return null_profile()
+        return cycle_profile(self, name)
+
+    def start_memory(self):
+        if self.memory_frames > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(self.memory_frames)
+
+    def get_file_prefix(self, kind, name):
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        return os.path.join(self.output_dir, "%s-%s-%s-%d" % (kind, name, time.strftime("%Y%m%d-%H%M%S"),
+                                                              self.profiled))
+
+    def save(self, profile, name, duration, worker_profiles=()):
+        with self.__lock:
+            self.profiled += 1
+            # before the report below adds its own allocations
+            if self.memory_frames > 0:
+                self.save_memory(name)
+
+            prefix = self.get_file_prefix("profile", name)
+            report = StringIO()
+            report.write("%s %d took %.3f seconds, %d worker thread(s)\n" % (name, self.profiled, duration,
+                                                                               len(worker_profiles)))
+            stats = pstats.Stats(profile, stream=report)
+            for worker_profile in worker_profiles:
+                stats.add(worker_profile)
+            stats.dump_stats(prefix + ".pstats")
+
+            stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+            stats.sort_stats('tottime').print_stats(REPORT_LINES)
+            with open(prefix + ".txt", 'w') as report_file:
+                report_file.write(report.getvalue())
+            logging.info("Profile of %s (%.3f seconds) saved into %s.pstats", name, duration, prefix)
+
+    def save_memory(self, name):
+        snapshot = tracemalloc.take_snapshot()
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        prefix = self.get_file_prefix("memory", name)
+        snapshot.dump(prefix + ".tracemalloc")
+
+        current, peak = tracemalloc.get_traced_memory()
+        with open(prefix + ".txt", 'w') as report_file:
+            report_file.write("traced memory %d bytes, peak %d bytes\n" % (current, peak))
+            report_file.write("top allocation sites:\n")
+            for statistic in snapshot.statistics('lineno')[:REPORT_LINES]:
+                report_file.write("%s\n" % statistic)
+            if self.__previous_snapshot is not None:
+                report_file.write("growth since previous snapshot:\n")
+                for statistic in snapshot.compare_to(self.__previous_snapshot, 'lineno')[:REPORT_LINES]:
+                    report_file.write("%s\n" % statistic)
+        self.__previous_snapshot = snapshot
+        logging.info("Memory snapshot of %s saved into %s.tracemalloc", name, prefix)
+
+
+class cycle_profile():
+    '''
+    one profiled pass, worker threads started by workers.run_tasks during the pass add their own profiles,
+    which are saved together with the one of the calling thread.
+    '''
+    def __init__(self, cycle_profiler, name):
+        self.cycle_profiler = cycle_profiler
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.worker_profiles = []
+        self.start = None
+        self.__lock = threading.Lock()
+
+    def add_worker_profile(self, profile):
+        with self.__lock:
+            self.worker_profiles.append(profile)
+
+    def __enter__(self):
+        self.cycle_profiler.start_memory()
+        self.start = time.time()
+        _active.profile = self
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.disable()
+        _active.profile = None
+        try:
+            self.cycle_profiler.save(self.profile, self.name, time.time() - self.start, self.worker_profiles)
+        except (IOError, OSError) as e:
+            logging.error("Unable to save profile into %s:%s", self.cycle_profiler.output_dir, str(e))
+        return False
+
+
+class worker_profile():
+    '''
+    with-block around the work of a worker thread for the pass profiled by parent, a cycle_profile
+    or None if the pass isn't profiled.
+    '''
+    def __init__(self, parent):
+        self.parent = parent
+        self.profile = None
+
+    def __enter__(self):
+        if self.parent is not None:
+            # so workers started by this worker are profiled too
+            _active.profile = self.parent
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profile is not None:
+            self.profile.disable()
+            _active.profile = None
+            self.parent.add_worker_profile(self.profile)
+        return False
+
+
+def get_active_profile():
+    '''
+    :return: cycle_profile of the pass running in this thread, None if it isn't profiled
+    '''
+    return getattr(_active, 'profile', None)
+
+
+class null_profile():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def get_profiler(my_config):
+    '''
+    :return: the cycle profiler of this configuration, a disabled one writing into folder_logs
+             unless main set one up with --profile
+    '''
+    profiler = getattr(my_config, 'cycle_profiler', None)
+    if profiler is None:
+        profiler = cycle_profiler(my_config.folder_logs, enabled=False)
+        my_config.cycle_profiler = profiler
+    return profiler
@@ -0,0 +1,230 @@
+import sys
+import os
+import json
+import time
+import random
+import logging
+import threading
+
+sys.path.append(".")
+
+try:
+    from . import util
+    from . import transfer
+    from . import metrics
+except:
+    import util
+    import transfer
+    import metrics
+
+# kinds of files retried, each one keeps its own entries
+HL7_RETRIES = 'hl7'
+ORPHAN_RETRIES = 'orphan'
+
+QUEUE_NAME = "retry-queue.json"
+
+
+class retry_queue():
+    '''
+    files whose processing has failed, keyed by kind and file name. an entry keeps the number of attempts,
+    the time the file may be tried again and the last error.
+    the delay after the n-th failed attempt is base_delay * 2 ** (n - 1), capped at max_delay, minus up to
+    jitter of it at random so files failing together don't come back together.
+    after max_attempts failed attempts the file is given up, 0 means it's retried forever.
+    '''
+    def __init__(self, queue_file, base_delay, max_delay, max_attempts=0, jitter=0.5, max_per_pass=0):
+        self.queue_file = queue_file
+        self.base_delay = max(0, base_delay)
+        self.max_delay = max(self.base_delay, max_delay)
+        self.max_attempts = max_attempts
+        self.jitter = min(1.0, max(0.0, jitter))
+        self.max_per_pass = max_per_pass
+        # kind -> file name -> [attempts, next time, last error]
+        self.__entries = {HL7_RETRIES: {}, ORPHAN_RETRIES: {}}
+        self.__dirty = False
+        self.__lock = threading.Lock()
+        self.__random = random.Random()
+        self.load()
+
+    def load(self):
+        if not (self.queue_file and os.path.exists(self.queue_file)):
+            return
+
+        try:
+            with open(self.queue_file, 'r') as queue:
+                entries = json.load(queue)
+            for kind, kind_entries in entries.items():
+                self.__entries[kind] = dict((name, list(entry)) for name, entry in kind_entries.items())
+            logging.info("Loaded %d file(s) to retry from %s", len(self), self.queue_file)
+        except Exception:
+            logging.exception("Unable to load retry queue:%s, starting with an empty one!", self.queue_file)
+            self.__entries = {HL7_RETRIES: {}, ORPHAN_RETRIES: {}}
+
+    def save(self):
+        if not (self.queue_file and self.__dirty):
+            return
+
+        with self.__lock:
+            entries = json.dumps(self.__entries)
+            self.__dirty = False
+
+        temp_file = self.queue_file + ".tmp"
+        with open(temp_file, 'w') as queue:
+            queue.write(entries)
+        util.replace_file(temp_file, self.queue_file)
+
+    def get_delay(self, attempts):
+        '''
+        :return: seconds to wait after the given number of failed attempts, jitter included
+        '''
+        delay = min(self.max_delay, self.base_delay * (2 ** min(attempts - 1, 64)))
+        return delay - delay * self.jitter * self.__random.random()
+
+    def select(self, kind, file_names, now=None):
+        '''
+        keep retried files off the hot path: files without failures come first in their order,
+        retried files follow once they are due, at most max_per_pass of them.
+        :return: file names to process in this pass
+        '''
+        now = now or time.time()
+        with self.__lock:
+            kind_entries = self.__entries.setdefault(kind, {})
+            if not kind_entries:
+                return file_names
+
+            healthy = []
+            due = []
+            for file_name in file_names:
+                entry = kind_entries.get(file_name)
+                if entry is None:
+                    healthy.append(file_name)
+                elif entry[1] <= now:
+                    due.append((entry[1], file_name))
+
+        # the longest waiting first
+        due = [file_name for next_time, file_name in sorted(due)]
+        if self.max_per_pass > 0:
+            due = due[:self.max_per_pass]
+        return healthy + due
+
+    def failed(self, kind, file_name, error=None, now=None):
+        '''
+        count one failed attempt.
+        :return: True if the file has run out of attempts
+        '''
+        now = now or time.time()
+        with self.__lock:
+            entry = self.__entries.setdefault(kind, {}).setdefault(file_name, [0, now, None])
+            entry[0] += 1
+            entry[1] = now + self.get_delay(entry[0])
+            entry[2] = error
+            self.__dirty = True
+            attempts, next_time = entry[0], entry[1]
+
+        logging.warning("%s has failed %d time(s), next attempt in %.1fs", file_name, attempts, next_time - now)
+        return 0 < self.max_attempts <= attempts
+
+    def attempts(self, kind, file_name):
+        with self.__lock:
+            entry = self.__entries.get(kind, {}).get(file_name)
+        return entry[0] if entry else 0
+
+    def forget(self, kind, file_name):
+        with self.__lock:
+            if self.__entries.get(kind, {}).pop(file_name, None) is not None:
+                self.__dirty = True
+
+    def evict_missing(self, kind, existing_files):
+        ''' drop entries of files which are not in existing_files any more
+        '''
+        existing_files = set(existing_files)
+        with self.__lock:
+            kind_entries = self.__entries.get(kind, {})
+            for file_name in list(kind_entries.keys()):
+                if file_name not in existing_files:
+                    del kind_entries[file_name]
+                    self.__dirty = True
+
+    def __len__(self):
+        return sum(len(kind_entries) for kind_entries in self.__entries.values())
+
+
+def get_queue_file(my_config):
+    ''' every instance sharing the folders keeps its own queue
+    '''
+    if my_config.retry_queue_file:
+        return my_config.retry_queue_file
+    if my_config.instance_id:
+        return os.path.join(my_config.folder_tobedeleted, "retry-queue-%s.json" % my_config.instance_id)
+    return os.path.join(my_config.folder_tobedeleted, QUEUE_NAME)
+
+
+def get_retry_queue(my_config):
+    '''
+    :return: the retry queue of this configuration, None if neither retry_base_delay nor retry_max_attempts is set
+    '''
+    if my_config.retry_base_delay <= 0 and my_config.retry_max_attempts <= 0:
+        return None
+
+    queue = getattr(my_config, 'retry_queue', None)
+    if queue is None:
+        queue = retry_queue(get_queue_file(my_config), my_config.retry_base_delay, my_config.retry_max_delay,
+                            my_config.retry_max_attempts, my_config.retry_jitter, my_config.retry_max_per_pass)
+        my_config.retry_queue = queue
+    return queue
+
+
+def select(my_config, kind, file_names):
+    ''' file names due in this pass, all of them unless the retry queue is in use
+    '''
+    queue = get_retry_queue(my_config)
+    if queue is None:
+        return file_names
+    return queue.select(kind, file_names)
+
+
+def quarantine_file(my_config, kind, folder, file_name):
+    '''
+    move a file which has run out of attempts into its kind's subfolder of folder_quarantine.
+    :return: True if it has been moved
+    '''
+    quarantine_folder = os.path.join(my_config.folder_quarantine, kind)
+    try:
+        if not os.path.exists(quarantine_folder):
+            os.makedirs(quarantine_folder)
+        transfer.move_file(os.path.join(folder, file_name), os.path.join(quarantine_folder, file_name))
+    except (IOError, OSError) as e:
+        logging.error("Unable to quarantine %s into %s:%s", file_name, quarantine_folder, str(e))
+        return False
+
+    logging.error("%s has been quarantined into %s after %d failed attempt(s)!",
+                  file_name, quarantine_folder, my_config.retry_max_attempts)
+    metrics.get_metrics(my_config).inc(metrics.QUARANTINED_TOTAL, {'kind': kind})
+    return True
+
+
+def record(my_config, kind, folder, file_name, succeeded, error=None):
+    '''
+    record the outcome of processing file_name in folder, nothing happens unless the retry queue is in use.
+    a file which has failed too often is quarantined, a file gone in the meantime is forgotten.
+    '''
+    queue = get_retry_queue(my_config)
+    if queue is None:
+        return
+
+    if succeeded or not os.path.exists(os.path.join(folder, file_name)):
+        queue.forget(kind, file_name)
+    elif queue.failed(kind, file_name, error):
+        if quarantine_file(my_config, kind, folder, file_name):
+            queue.forget(kind, file_name)
+
+
+def save(my_config):
+    queue = get_retry_queue(my_config)
+    if queue is None:
+        return
+
+    try:
+        queue.save()
+    except (IOError, OSError) as e:
+        logging.error("Unable to save retry queue %s:%s", queue.queue_file, str(e))
@@ -0,0 +1,176 @@
+import os
+import time
+import logging
+import threading
+import collections
+
+try:
+    _scandir = os.scandir
+except AttributeError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+# what changed in a folder since its previous scan, each a sorted list of file names.
+folder_changes = collections.namedtuple('folder_changes', ['added', 'removed', 'changed'])
+
+
+class listdir_entry():
+    '''
+    stand-in for os.DirEntry where scandir is not available (python 2 without the scandir package).
+    every call costs a stat, like the listdir + isfile enumeration it replaces.
+    '''
+    def __init__(self, folder, name):
+        self.name = name
+        self.path = os.path.join(folder, name)
+        self.__stat = None
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+    def stat(self):
+        if self.__stat is None:
+            self.__stat = os.stat(self.path)
+        return self.__stat
+
+    def inode(self):
+        return os.lstat(self.path).st_ino
+
+
+def listdir_scandir(folder):
+    for name in os.listdir(folder):
+        yield listdir_entry(folder, name)
+
+
+def scandir_available():
+    return _scandir is not None
+
+
+def iter_file_entries(folder):
+    '''
+    yield entries of regular, non hidden files in folder one at a time.
+    with scandir the file type comes with the directory listing, so no file is stat'ed here.
+    '''
+    if _scandir is None:
+        entries = listdir_scandir(folder)
+    else:
+        entries = _scandir(folder)
+
+    try:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_file():
+                    yield entry
+            except OSError:
+                # gone between listing and type check
+                pass
+    finally:
+        close = getattr(entries, 'close', None)
+        if close is not None:
+            close()
+
+
+class folder_snapshot():
+    '''
+    file names of one folder as of its previous scan.
+    names are keyed by inode, which scandir returns for free, so a file replaced by a rename shows up as changed.
+    with detect_changes, size and mtime are part of the key too, at the cost of one stat per file.
+    '''
+    def __init__(self, folder, detect_changes=False):
+        self.folder = folder
+        self.detect_changes = detect_changes
+        self.__entries = None
+
+    def get_entry_key(self, entry):
+        if self.detect_changes:
+            entry_stat = entry.stat()
+            return entry_stat.st_ino, entry_stat.st_size, entry_stat.st_mtime
+        return entry.inode()
+
+    def scan(self):
+        '''
+        :return: folder_changes since the previous scan, everything is added on the first one
+        '''
+        entries = {}
+        for entry in iter_file_entries(self.folder):
+            try:
+                entries[entry.name] = self.get_entry_key(entry)
+            except OSError:
+                pass
+
+        previous_entries = self.__entries or {}
+        added = sorted(name for name in entries if name not in previous_entries)
+        removed = sorted(name for name in previous_entries if name not in entries)
+        changed = sorted(name for name, key in entries.items()
+                         if name in previous_entries and previous_entries[name] != key)
+        self.__entries = entries
+        return folder_changes(added, removed, changed)
+
+    def names(self):
+        return sorted(self.__entries or {})
+
+    def __len__(self):
+        return len(self.__entries or {})
+
+
+class folder_timing():
+    def __init__(self):
+        self.scans = 0
+        self.total_seconds = 0.0
+        self.last_seconds = 0.0
+        self.last_entries = 0
+
+
+class folder_scanner():
+    '''
+    snapshots of several folders, with the time each enumeration took.
+    on_scan is called with folder, seconds and number of files after every scan, to export them.
+    '''
+    def __init__(self, on_scan=None):
+        self.on_scan = on_scan
+        self.__snapshots = collections.OrderedDict()
+        self.__timings = {}
+        self.__lock = threading.Lock()
+
+    def add_folder(self, folder, detect_changes=False):
+        self.__snapshots[folder] = folder_snapshot(folder, detect_changes)
+        self.__timings[folder] = folder_timing()
+
+    def folders(self):
+        return list(self.__snapshots.keys())
+
+    def scan(self, folder):
+        start = time.time()
+        changes = self.__snapshots[folder].scan()
+        elapsed = time.time() - start
+
+        with self.__lock:
+            timing = self.__timings[folder]
+            timing.scans += 1
+            timing.total_seconds += elapsed
+            timing.last_seconds = elapsed
+            timing.last_entries = len(self.__snapshots[folder])
+
+        logging.debug("Scanned %s: %d file(s) in %.3fs, %d added, %d removed, %d changed",
+                      folder, timing.last_entries, elapsed,
+                      len(changes.added), len(changes.removed), len(changes.changed))
+        if self.on_scan is not None:
+            self.on_scan(folder, elapsed, timing.last_entries)
+        return changes
+
+    def scan_all(self):
+        '''
+        :return: list of (folder, folder_changes) in the order folders have been added
+        '''
+        return [(folder, self.scan(folder)) for folder in self.folders()]
+
+    def timings(self):
+        '''
+        :return: dict of folder -> (scans, total seconds, last seconds, files in last scan)
+        '''
+        with self.__lock:
+            return dict((folder, (timing.scans, timing.total_seconds, timing.last_seconds, timing.last_entries))
+                        for folder, timing in self.__timings.items())
@@ -0,0 +1,113 @@
+import os
+import time
+import signal
+import logging
+import threading
+
+WAKEUP_SIGNAL = getattr(signal, 'SIGUSR2', None)
+
+# seconds between looks for the trigger file while sleeping
+TRIGGER_POLL_INTERVAL = 1.0
+
+
+class adaptive_scheduler():
+    '''
+    sleep time between two passes: back to floor right after a pass which found work, then multiplied
+    by backoff after every idle pass until it reaches ceiling.
+    a sleep ends early on wake(), on the wake-up signal or once trigger_file shows up, which is removed.
+    the signal and the trigger file wake the linked peers as well.
+    '''
+    def __init__(self, floor, ceiling, backoff=2.0, trigger_file=None):
+        self.floor = max(0, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.backoff = max(1.0, backoff)
+        self.trigger_file = trigger_file
+        self.interval = self.floor
+        self.peers = []
+        self.__wakeup = threading.Event()
+
+    def next_interval(self, work_count):
+        '''
+        :param work_count: number of files the previous pass has handled
+        :return: seconds to sleep before the next pass
+        '''
+        if work_count > 0:
+            self.interval = self.floor
+        else:
+            self.interval = min(self.ceiling, max(self.interval * self.backoff, self.floor))
+        return self.interval
+
+    def wake(self):
+        self.__wakeup.set()
+
+    def wake_all(self):
+        self.wake()
+        for peer in self.peers:
+            peer.wake()
+
+    def install_signal_handler(self, signal_number=WAKEUP_SIGNAL):
+        '''
+        kill -USR2 <pid> starts the next pass right away.
+        :return: True if the handler is installed
+        '''
+        if signal_number is None:
+            logging.warning("No wake-up signal on this platform!")
+            return False
+
+        def handler(signum, frame):
+            self.wake_all()
+
+        signal.signal(signal_number, handler)
+        return True
+
+    def check_trigger_file(self):
+        if not self.trigger_file:
+            return False
+        try:
+            os.remove(self.trigger_file)
+            return True
+        except OSError:
+            return False
+
+    def wait(self, timeout):
+        '''
+        sleep up to timeout seconds.
+        :return: True if woken up before timeout
+        '''
+        deadline = time.time() + timeout
+        while True:
+            if self.check_trigger_file():
+                self.wake_all()
+            if self.__wakeup.is_set():
+                self.__wakeup.clear()
+                return True
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if self.trigger_file:
+                remaining = min(remaining, TRIGGER_POLL_INTERVAL)
+            self.__wakeup.wait(remaining)
+
+
+def link_schedulers(schedules):
+    ''' let the wake-up signal and the trigger file seen by any of schedules wake all of them
+    '''
+    for schedule in schedules:
+        schedule.peers = [peer for peer in schedules if peer is not schedule]
+
+
+def create_scheduler(my_config):
+    return adaptive_scheduler(my_config.min_sleeptime, my_config.max_sleeptime,
+                              my_config.sleeptime_backoff, my_config.wakeup_trigger_file)
+
+
+def get_scheduler(my_config):
+    '''
+    :return: the scheduler of this configuration, a fixed sleeptime unless min_sleeptime or max_sleeptime is set
+    '''
+    schedule = getattr(my_config, 'scheduler', None)
+    if schedule is None:
+        schedule = create_scheduler(my_config)
+        my_config.scheduler = schedule
+    return schedule
@@ -0,0 +1,88 @@
+import os
+import time
+import logging
+import threading
+
+
+class file_stability_tracker():
+    '''
+    remember size, mtime and inode of files across observations, a file is released once it has been
+    seen unchanged twice, quiet_period seconds apart or more. it stays released as long as it doesn't change,
+    a file which changes starts over, and a file which disappears is forgotten. nothing sleeps here, a file
+    which is not stable yet is reported as pending and should be looked at again later.
+    '''
+    def __init__(self, quiet_period):
+        self.quiet_period = quiet_period
+        # (folder, file_name) -> (identity, time it has been seen with it first, stable)
+        self.__files = {}
+        self.__lock = threading.Lock()
+
+    def is_stable(self, folder, file_name):
+        key = (folder, file_name)
+        try:
+            file_stat = os.stat(os.path.join(folder, file_name))
+        except OSError:
+            self.forget(folder, file_name)
+            return False
+
+        now = time.time()
+        identity = (file_stat.st_size, file_stat.st_mtime, file_stat.st_ino)
+
+        with self.__lock:
+            record = self.__files.get(key)
+            # mtime of a file on a share is set by the server's clock, so only the time between two
+            # observations of this process counts, and a file seen for the first time is never stable.
+            if record is None or record[0] != identity:
+                self.__files[key] = (identity, now, False)
+            elif record[2]:
+                return True
+            elif now - record[1] >= self.quiet_period:
+                self.__files[key] = (identity, record[1], True)
+                return True
+
+        logging.info("%s is not stable yet, it will be checked again later.", os.path.join(folder, file_name))
+        return False
+
+    def forget(self, folder, file_name):
+        with self.__lock:
+            self.__files.pop((folder, file_name), None)
+
+    def pending(self):
+        '''
+        :return: list of (folder, file_name) not released yet, files which disappeared are dropped
+        '''
+        with self.__lock:
+            records = list(self.__files.items())
+
+        pending_files = []
+        for (folder, file_name), record in records:
+            if not os.path.exists(os.path.join(folder, file_name)):
+                self.forget(folder, file_name)
+            elif not record[2]:
+                pending_files.append((folder, file_name))
+        return pending_files
+
+
+def get_tracker(my_config):
+    '''
+    :return: the tracker of this configuration, None if file_stability_quiet_period is not set
+    '''
+    if my_config.file_stability_quiet_period < 0:
+        return None
+
+    tracker = getattr(my_config, 'stability_tracker', None)
+    if tracker is None:
+        tracker = file_stability_tracker(my_config.file_stability_quiet_period)
+        my_config.stability_tracker = tracker
+    return tracker
+
+
+def get_ready_files(my_config, folder, file_list):
+    '''
+    :return: files of file_list which are stable, all of them if no tracker is configured
+    '''
+    tracker = get_tracker(my_config)
+    if tracker is None:
+        return file_list
+
+    return [file_name for file_name in file_list if tracker.is_stable(folder, file_name)]
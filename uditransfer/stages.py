@@ -0,0 +1,189 @@
+import time
+import threading
+
+# the two stages of a pass over the folders
+HL7_STAGE = 'hl7'
+ACK_STAGE = 'ack'
+STAGES = [HL7_STAGE, ACK_STAGE]
+
+# stage_order taking turns instead of one stage always going first
+ALTERNATE_ORDER = 'alternate'
+STAGE_ORDERS = [HL7_STAGE, ACK_STAGE, ALTERNATE_ORDER]
+
+
+def get_other_stage(stage):
+    return ACK_STAGE if stage == HL7_STAGE else HL7_STAGE
+
+
+class stage_budget():
+    '''
+    work one stage may do in a pass: at most max_files files and max_seconds seconds, 0 means no limit.
+    files left over, cut off by max_files or not reached before max_seconds, are carried into the next pass
+    and go first there, so a backlog is worked through instead of the same head of the listing every time.
+    '''
+    def __init__(self, max_files=0, max_seconds=0):
+        self.max_files = max_files
+        self.max_seconds = max_seconds
+        self.__cut = []
+        self.__skipped = []
+        self.__deadline = None
+        self.__lock = threading.Lock()
+
+    def start(self, file_names):
+        '''
+        start a pass over file_names.
+        :return: file names the pass may process, leftovers of the previous pass first
+        '''
+        listed_names = set(file_names)
+        carried = [file_name for file_name in self.leftovers() if file_name in listed_names]
+        if carried:
+            carried_names = set(carried)
+            file_names = carried + [file_name for file_name in file_names if file_name not in carried_names]
+
+        with self.__lock:
+            self.__skipped = []
+            if self.max_files > 0:
+                self.__cut = file_names[self.max_files:]
+                file_names = file_names[:self.max_files]
+            else:
+                self.__cut = []
+            self.__deadline = time.time() + self.max_seconds if self.max_seconds > 0 else None
+        return file_names
+
+    def expired(self):
+        return self.__deadline is not None and time.time() >= self.__deadline
+
+    def leave(self, file_names):
+        ''' file names not processed because the time is up
+        '''
+        with self.__lock:
+            self.__skipped.extend(file_names)
+
+    def leftovers(self):
+        with self.__lock:
+            return self.__skipped + self.__cut
+
+
+class stage_pass():
+    ''' with-block around one pass of a stage running concurrently with the other one
+    '''
+    def __init__(self, coordinator, stage):
+        self.coordinator = coordinator
+        self.stage = stage
+
+    def __enter__(self):
+        self.coordinator.enter(self.stage)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.coordinator.exit(self.stage)
+        return False
+
+
+class stage_coordinator():
+    '''
+    share of the HL7 and ACK stages. order hl7 or ack puts that stage first in every pass, alternate swaps
+    the first stage after every pass so both get the same share.
+    stages running concurrently each in their own thread: a pass of the other stage doesn't start while
+    one of the stage given priority is running, alternate lets both run freely.
+    '''
+    def __init__(self, order=HL7_STAGE):
+        self.order = order
+        self.__first = ACK_STAGE if order == ACK_STAGE else HL7_STAGE
+        self.__running = set()
+        self.__condition = threading.Condition()
+
+    def next_order(self):
+        '''
+        :return: stages in the order to run them in the next pass
+        '''
+        with self.__condition:
+            first = self.__first
+            if self.order == ALTERNATE_ORDER:
+                self.__first = get_other_stage(first)
+        return [first, get_other_stage(first)]
+
+    def running(self, stage):
+        return stage_pass(self, stage)
+
+    def enter(self, stage):
+        with self.__condition:
+            if self.order != ALTERNATE_ORDER and stage != self.order:
+                while self.order in self.__running:
+                    self.__condition.wait()
+            self.__running.add(stage)
+
+    def exit(self, stage):
+        with self.__condition:
+            self.__running.discard(stage)
+            self.__condition.notify_all()
+
+
+class stage_watch():
+    '''
+    snapshots of the folders of one stage between passes of the periodical loop. a pass is only needed when
+    one of the folders has an added or changed file, when the previous pass did some work or left some pending,
+    when state (e.g. the flag store generation) has moved on, and at least every rescan_interval seconds.
+    so an idle stage costs one listing per folder, with scandir without a stat per file.
+    '''
+    def __init__(self, folder_scanner, folders, rescan_interval):
+        self.folder_scanner = folder_scanner
+        self.folders = folders
+        self.rescan_interval = rescan_interval
+        self.skipped = 0
+        self.__busy = True
+        self.__state = None
+        self.__next_rescan = 0
+
+    def needs_pass(self, pending=False, state=None, now=None):
+        '''
+        :param pending: True if there is work the snapshots don't show, like retries or files not stable yet
+        :param state: compared with state of the previous pass, a pass is needed if it's different
+        '''
+        changed = False
+        # every snapshot is brought up to date, even once one has changed
+        for folder in self.folders:
+            changes = self.folder_scanner.scan(folder)
+            if changes.added or changes.changed:
+                changed = True
+
+        if (changed or pending or self.__busy or state != self.__state or
+                (now or time.time()) >= self.__next_rescan):
+            return True
+        self.skipped += 1
+        return False
+
+    def passed(self, work_count, state=None, now=None):
+        ''' a pass of the stage has found work_count files to handle
+        '''
+        self.__busy = work_count > 0
+        self.__state = state
+        self.__next_rescan = (now or time.time()) + self.rescan_interval
+
+
+def get_budget(my_config, stage):
+    '''
+    :return: the budget of stage in this configuration, one without limits unless
+             hl7_stage_max_files, hl7_stage_max_seconds, ack_stage_max_files or ack_stage_max_seconds is set
+    '''
+    budgets = getattr(my_config, 'stage_budgets', None)
+    if budgets is None:
+        budgets = {HL7_STAGE: stage_budget(my_config.hl7_stage_max_files, my_config.hl7_stage_max_seconds),
+                   ACK_STAGE: stage_budget(my_config.ack_stage_max_files, my_config.ack_stage_max_seconds)}
+        my_config.stage_budgets = budgets
+    return budgets[stage]
+
+
+def get_leftover_count(my_config):
+    '''
+    :return: number of files the budgets have carried into the next pass
+    '''
+    return sum(len(get_budget(my_config, stage).leftovers()) for stage in STAGES)
+
+
+def get_coordinator(my_config):
+    coordinator = getattr(my_config, 'stage_coordinator', None)
+    if coordinator is None:
+        coordinator = stage_coordinator(my_config.stage_order)
+        my_config.stage_coordinator = coordinator
+    return coordinator
@@ -0,0 +1,398 @@
+import sys
+import os
+import re
+import time
+import errno
+import logging
+import shutil
+import hashlib
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+sys.path.append(".")
+
+try:
+    from . import util
+except:
+    import util
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# ioctl FICLONE from <linux/fs.h>, shares the data blocks of a file on btrfs, xfs and other CoW file systems.
+FICLONE = 0x40049409
+
+# names of get_temp_file
+TEMP_FILE_PATTERN = re.compile(r'^\..+\.\d+\.tmp$')
+
+# (copy_file_range, sendfile), looked up on first use
+_kernel_copy_functions = None
+
+# kernel side copy errors which mean "not supported here", the next method is tried.
+FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ETXTBSY)
+
+
+class copy_result():
+    def __init__(self):
+        self.size = 0
+        self.digest = None
+        self.head_digest = None
+        self.target = None
+        # the data has been renamed instead of copied
+        self.renamed = False
+
+
+def get_content_digest(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def get_temp_file(target_file):
+    ''' hidden file next to target_file, get_file_list doesn't list it, TEMP_FILE_PATTERN matches it
+    '''
+    folder, file_name = os.path.split(target_file)
+    return os.path.join(folder, ".%s.%d.tmp" % (file_name, os.getpid()))
+
+
+def is_same_device(source_file, target_file):
+    try:
+        target_folder = os.path.dirname(os.path.abspath(target_file))
+        return os.stat(source_file).st_dev == os.stat(target_folder).st_dev
+    except OSError:
+        return False
+
+
+def publish_file(temp_file, target_file):
+    ''' rename a completely written temp file to its final name, nobody ever sees a partial target
+    '''
+    try:
+        util.replace_file(temp_file, target_file)
+    except:
+        remove_quietly(temp_file)
+        raise
+
+
+def remove_quietly(file_name):
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
+
+
+def _raise_errno():
+    error_number = ctypes.get_errno()
+    raise OSError(error_number, os.strerror(error_number))
+
+
+def _load_libc_copy_functions():
+    '''
+    copy_file_range and sendfile of the C library through ctypes, python 2 doesn't have them in os.
+    :return: (copy_file_range, sendfile) with the signatures of os.copy_file_range and os.sendfile,
+             None for one the C library doesn't have
+    '''
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None, None
+
+    copy_file_range = None
+    libc_copy_file_range = getattr(libc, 'copy_file_range', None)
+    if libc_copy_file_range is not None:
+        libc_copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                         ctypes.c_size_t, ctypes.c_uint]
+        libc_copy_file_range.restype = ctypes.c_ssize_t
+
+        def copy_file_range(source_fd, target_fd, count):
+            # no offsets, both file positions move on
+            copied = libc_copy_file_range(source_fd, None, target_fd, None, count, 0)
+            if copied < 0:
+                _raise_errno()
+            return copied
+
+    sendfile = None
+    libc_sendfile = getattr(libc, 'sendfile64', None)
+    if libc_sendfile is not None:
+        libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        libc_sendfile.restype = ctypes.c_ssize_t
+
+        def sendfile(target_fd, source_fd, offset, count):
+            copied = libc_sendfile(target_fd, source_fd, ctypes.byref(ctypes.c_int64(offset)), count)
+            if copied < 0:
+                _raise_errno()
+            return copied
+
+    return copy_file_range, sendfile
+
+
+def get_kernel_copy_functions():
+    '''
+    :return: (copy_file_range, sendfile) of os, else of the C library on linux, None for one which isn't there
+    '''
+    global _kernel_copy_functions
+    if _kernel_copy_functions is None:
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        sendfile = getattr(os, 'sendfile', None)
+        if ctypes is not None and sys.platform.startswith('linux') and (copy_file_range is None or
+                                                                         sendfile is None):
+            libc_copy_file_range, libc_sendfile = _load_libc_copy_functions()
+            copy_file_range = copy_file_range or libc_copy_file_range
+            sendfile = sendfile or libc_sendfile
+        _kernel_copy_functions = (copy_file_range, sendfile)
+    return _kernel_copy_functions
+
+
+def _raise_short_copy(copied, size):
+    # the source has been truncated since its size was taken, the copy must not be published
+    raise IOError(errno.EIO, "source ended after %d of %d bytes" % (copied, size))
+
+
+def _copy_in_kernel(source, target, size):
+    '''
+    copy with copy_file_range or sendfile, data doesn't pass through python.
+    :return: True if all of it has been copied, False if neither is available for these files
+    '''
+    copy_file_range = get_kernel_copy_functions()[0]
+    if copy_file_range is not None:
+        copied = 0
+        try:
+            while copied < size:
+                count = copy_file_range(source.fileno(), target.fileno(), size - copied)
+                if count == 0:
+                    _raise_short_copy(copied, size)
+                copied += count
+            return True
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRORS:
+                raise
+            if copied > 0:
+                source.seek(copied)
+                target.seek(copied)
+                return _copy_in_kernel_sendfile(source, target, copied, size)
+
+    return _copy_in_kernel_sendfile(source, target, 0, size)
+
+
+def _copy_in_kernel_sendfile(source, target, copied, size):
+    sendfile = get_kernel_copy_functions()[1]
+    if sendfile is None or not sys.platform.startswith('linux'):
+        return False
+
+    try:
+        while copied < size:
+            count = sendfile(target.fileno(), source.fileno(), copied, size - copied)
+            if count == 0:
+                _raise_short_copy(copied, size)
+            copied += count
+        return True
+    except OSError as e:
+        if e.errno not in FALLBACK_ERRORS or copied > 0:
+            raise
+        return False
+
+
+def copy_file(source_file, target_file):
+    '''
+    copy source_file to target_file through a temp file in the target folder, renamed once complete.
+    the data is copied in the kernel with copy_file_range or sendfile where possible.
+    '''
+    temp_file = get_temp_file(target_file)
+    try:
+        with open(source_file, 'rb') as source:
+            with open(temp_file, 'wb') as target:
+                size = os.fstat(source.fileno()).st_size
+                if not _copy_in_kernel(source, target, size):
+                    shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+    except:
+        remove_quietly(temp_file)
+        raise
+
+    publish_file(temp_file, target_file)
+
+
+def move_file(source_file, target_file):
+    '''
+    rename source_file to target_file when both are on the same file system, copy and remove otherwise.
+    :return: True if it has been renamed, False if it has been copied
+    '''
+    if is_same_device(source_file, target_file):
+        try:
+            util.replace_file(source_file, target_file)
+            return True
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    copy_file(source_file, target_file)
+    os.remove(source_file)
+    return False
+
+
+def clone_file(source_file, target_file):
+    '''
+    reflink target_file to source_file with ioctl FICLONE, the data blocks are shared until one is written.
+    :return: True if it has been cloned, False if the file system can't do it
+    '''
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    temp_file = get_temp_file(target_file)
+    try:
+        with open(source_file, 'rb') as source:
+            with open(temp_file, 'wb') as target:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    except (IOError, OSError):
+        remove_quietly(temp_file)
+        return False
+
+    publish_file(temp_file, target_file)
+    return True
+
+
+def link_or_copy(source_file, target_file):
+    '''
+    make target_file a hard link of source_file, or a reflink, or a copy, whichever works first.
+    :return: 'link', 'clone' or 'copy'
+    '''
+    link = getattr(os, 'link', None)
+    if link is not None and is_same_device(source_file, target_file):
+        temp_file = get_temp_file(target_file)
+        try:
+            remove_quietly(temp_file)
+            link(source_file, temp_file)
+            publish_file(temp_file, target_file)
+            return 'link'
+        except OSError:
+            remove_quietly(temp_file)
+
+        if clone_file(source_file, target_file):
+            return 'clone'
+
+    copy_file(source_file, target_file)
+    return 'copy'
+
+
+def stream_copy(source_file, target_file, head_size=0, chunk_size=COPY_CHUNK_SIZE, choose_target=None):
+    '''
+    copy source_file into target_file one chunk at a time, so memory use doesn't depend on file size.
+    the digest of the whole content, and of its first head_size bytes, are computed in the same pass.
+    target_file is written as a temp file and renamed once complete.
+    :param source_file:
+    :param target_file:
+    :param head_size: number of leading bytes to compute head_digest of, 0 means none
+    :param chunk_size:
+    :param choose_target: called with the copy_result once the temp file is complete, returns the file name
+                          to publish it as or None to drop it. None means target_file
+    :return: copy_result with size, digest, head_digest and the target it has been published as
+    '''
+    temp_file = get_temp_file(target_file)
+    try:
+        with open(source_file, 'rb') as source:
+            with open(temp_file, 'wb') as target:
+                result = read_digests(source, head_size, chunk_size, target)
+    except:
+        remove_quietly(temp_file)
+        raise
+
+    try:
+        result.target = choose_target(result) if choose_target is not None else target_file
+    except:
+        remove_quietly(temp_file)
+        raise
+    place_temp_file(temp_file, target_file, result.target)
+    return result
+
+
+def stream_move(source_file, target_file, head_size=0, chunk_size=COPY_CHUNK_SIZE, choose_target=None):
+    '''
+    move source_file to target_file with the digests of stream_copy. on the same file system the source
+    is read once where it is, and renamed to where choose_target decides only then, otherwise it's streamed
+    and removed. the source never waits in a hidden temp file, a crash leaves it where it was.
+    :return: copy_result of stream_copy, renamed is True if the data hasn't been copied
+    '''
+    if not is_same_device(source_file, target_file):
+        result = stream_copy(source_file, target_file, head_size, chunk_size, choose_target)
+        os.remove(source_file)
+        return result
+
+    with open(source_file, 'rb') as source:
+        result = read_digests(source, head_size, chunk_size)
+    result.target = choose_target(result) if choose_target is not None else target_file
+
+    if result.target is None:
+        os.remove(source_file)
+    else:
+        result.renamed = move_file(source_file, result.target)
+    return result
+
+
+def remove_stale_temp_files(folder, max_age, now=None):
+    '''
+    remove temp files of get_temp_file a crashed process left behind in folder, get_file_list never lists them.
+    only files not modified for max_age seconds are removed, other processes might still be writing theirs.
+    :return: number of files removed
+    '''
+    now = now or time.time()
+    removed = 0
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return 0
+
+    for name in names:
+        if not TEMP_FILE_PATTERN.match(name):
+            continue
+        temp_file = os.path.join(folder, name)
+        try:
+            if now - os.stat(temp_file).st_mtime < max_age:
+                continue
+            os.remove(temp_file)
+        except OSError:
+            continue
+        logging.warning("Removed stale temp file %s", temp_file)
+        removed += 1
+    return removed
+
+
+def read_digests(source, head_size=0, chunk_size=COPY_CHUNK_SIZE, target=None):
+    '''
+    read source to its end one chunk at a time, writing every chunk into target unless it's None.
+    :return: copy_result with size, digest and head_digest of what has been read
+    '''
+    result = copy_result()
+    digest = hashlib.sha256()
+    head_digest = hashlib.sha256()
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        if result.size < head_size:
+            head_digest.update(chunk[:head_size - result.size])
+        digest.update(chunk)
+        if target is not None:
+            target.write(chunk)
+        result.size += len(chunk)
+
+    result.digest = digest.hexdigest()
+    if head_size > 0:
+        result.head_digest = head_digest.hexdigest()
+    return result
+
+
+def place_temp_file(temp_file, target_file, chosen_target):
+    '''
+    publish a complete temp file of target_file as chosen_target, None drops it.
+    a target elsewhere, e.g. a quarantine folder, is moved there, renamed if it's on the same file system.
+    '''
+    if chosen_target is None:
+        remove_quietly(temp_file)
+    elif chosen_target == target_file:
+        publish_file(temp_file, chosen_target)
+    else:
+        try:
+            move_file(temp_file, chosen_target)
+        except:
+            remove_quietly(temp_file)
+            raise
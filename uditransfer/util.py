@@ -1,42 +1,120 @@
 import logging
 import os.path
 import sys
-import datetime
+import atexit
 
-def initialize_logger(output_dir, stream_loglevel = logging.INFO, all_loglevel=logging.DEBUG):
+sys.path.append(".")
+
+try:
+    from . import scanner
+    from . import logqueue
+except:
+    import scanner
+    import logqueue
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = (str, bytes)
+
+# payload dumps are cut after this many bytes, set by initialize_logger
+payload_log_max_bytes = 1024
+
+
+def initialize_logger(output_dir, stream_loglevel = logging.INFO, all_loglevel=logging.DEBUG, max_bytes=0,
+                      use_queue=True, payload_max_bytes=1024):
+    '''
+    log to console, error-YYYY-MM-DD.log and all-YYYY-MM-DD.log, new log files are started every day.
+    :param max_bytes: a log file beyond this size is renamed to *-YYYY-MM-DD.N.log, 0 means daily files only
+    :param use_queue: format and write log records in a background thread
+    :param payload_max_bytes: see log_payload
+    '''
+    global payload_log_max_bytes
     try:
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
     except:
         sys.exit("Error happened in create log folder:%s" % output_dir)
 
+    payload_log_max_bytes = payload_max_bytes
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+    # records below every handler level are dropped before they are created
+    logger.setLevel(min(stream_loglevel, all_loglevel, logging.ERROR))
+    formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
+    handlers = []
 
     # create console handler and set level to info
     handler = logging.StreamHandler()
     handler.setLevel(stream_loglevel)
-    formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
-
-    now = datetime.datetime.now()
-    error_log_filename = "error-%4d-%02d-%02d.log" % (now.year, now.month, now.day)
-    all_log_filename = "all-%4d-%02d-%02d.log" % (now.year, now.month, now.day)
+    handlers.append(handler)
 
     # create error file handler and set level to error
-    handler = logging.FileHandler(os.path.join(output_dir, error_log_filename), "a+", encoding=None, delay="true")
+    handler = logqueue.dated_file_handler(output_dir, "error", max_bytes, delay=True)
     handler.setLevel(logging.ERROR)
-    formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    handlers.append(handler)
 
     # create debug file handler and set level to debug
-    handler = logging.FileHandler(os.path.join(output_dir, all_log_filename), "a+")
+    handler = logqueue.dated_file_handler(output_dir, "all", max_bytes)
     handler.setLevel(all_loglevel)
-    formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    handlers.append(handler)
+
+    if use_queue:
+        record_queue = queue.Queue()
+        listener = logqueue.queue_listener(record_queue, handlers)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(logqueue.queue_handler(record_queue))
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
 
     logging.info("Start to log...")
 
+
+def log_payload(payload, max_bytes=None):
+    '''
+    debug dump of file content or of a list of names, cut after max_bytes.
+    nothing is formatted unless debug logging is on.
+    :param max_bytes: None means payload_log_max_bytes, 0 means no dump, less than 0 means no limit
+    '''
+    if max_bytes is None:
+        max_bytes = payload_log_max_bytes
+    if max_bytes == 0 or not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+
+    if not isinstance(payload, string_types):
+        payload = repr(payload)
+    if 0 < max_bytes < len(payload):
+        logging.debug("%s... (%d of %d bytes)", payload[:max_bytes], max_bytes, len(payload))
+    else:
+        logging.debug(payload)
+
+
+def get_file_list(folder):
+    ''' names of regular, non hidden files in folder, enumerated with scandir where available
+    '''
+    onlyfiles = [entry.name for entry in scanner.iter_file_entries(folder)]
+    return onlyfiles
+
+
+def touch(file_name):
+    ''' create an empty file with specific name
+    '''
+    with open(file_name, 'a'):
+        os.utime(file_name, None)
+
+
+def replace_file(source_file, target_file):
+    ''' rename source_file to target_file, replacing target_file if it exists
+    '''
+    if os.name == 'nt' and os.path.exists(target_file):
+        os.remove(target_file)
+    os.rename(source_file, target_file)
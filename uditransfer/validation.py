@@ -0,0 +1,157 @@
+import sys
+import os
+import logging
+import tarfile
+import traceback
+import multiprocessing
+
+sys.path.append(".")
+
+try:
+    from . import filecache
+except:
+    import filecache
+
+
+def scan_package(hl7_fullname, max_members=0, max_bytes=0):
+    '''
+    read the members of a tar.gz package as a stream until SUBMISSION.XML shows up.
+    max_members limits the members looked at, max_bytes the uncompressed offset they start at, 0 means no limit.
+    runs in pool processes as well, so nothing is logged here.
+    :return: (verdict, level, reason), verdict is None if the package couldn't be scanned at all
+    '''
+    try:
+        tar = tarfile.open(hl7_fullname, 'r|gz')
+        try:
+            member_count = 0
+            for tar_info in tar:
+                # a member starting beyond max_bytes isn't looked at
+                if max_bytes > 0 and tar_info.offset >= max_bytes:
+                    return False, logging.WARNING, "No SUBMISSION.XML in first %d bytes of %s!" % (
+                        max_bytes, hl7_fullname)
+                name_info = (tar_info.name).upper()
+                if "SUBMISSION.XML" in name_info:
+                    return True, logging.INFO, "%s is a valid HL7 message tar.gz package!" % hl7_fullname
+
+                member_count += 1
+                if max_members > 0 and member_count >= max_members:
+                    return False, logging.WARNING, "No SUBMISSION.XML in first %d members of %s!" % (
+                        member_count, hl7_fullname)
+        finally:
+            tar.close()
+    except tarfile.ReadError as re:
+        return False, logging.INFO, hl7_fullname + " " + str(re)
+    except Exception:
+        return None, logging.ERROR, traceback.format_exc()
+
+    return False, logging.DEBUG, "No SUBMISSION.XML in %s" % hl7_fullname
+
+
+def get_verdict(scan_result):
+    '''
+    log the reason of a scan_package result in this process.
+    :return: verdict, False if the package couldn't be scanned
+    '''
+    verdict, level, reason = scan_result
+    if verdict is None:
+        logging.error("Unacceptable HL7 tar.gz package received. it will be ignored!")
+        logging.error("Exception:%s", reason)
+        return False
+    logging.log(level, reason)
+    return verdict
+
+
+class pending_verdict():
+    '''
+    verdict of one package being scanned by the pool, get() waits for it.
+    if the pool doesn't answer within timeout seconds, the package is scanned in this process instead.
+    '''
+    def __init__(self, async_result, scan_args, identity=None, verdict_cache=None, timeout=None):
+        self.async_result = async_result
+        self.scan_args = scan_args
+        self.identity = identity
+        self.verdict_cache = verdict_cache
+        self.timeout = timeout
+
+    def get(self):
+        try:
+            scan_result = self.async_result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            logging.error("No verdict for %s from validation pool within %ss, scanning it here.",
+                          self.scan_args[0], self.timeout)
+            scan_result = scan_package(*self.scan_args)
+        except Exception as e:
+            logging.error("Validation pool failed on %s:%s, scanning it here.", self.scan_args[0], str(e))
+            scan_result = scan_package(*self.scan_args)
+
+        if scan_result[0] is not None and self.verdict_cache is not None:
+            self.verdict_cache.put(self.identity, scan_result[0])
+        return get_verdict(scan_result)
+
+
+class validation_pool():
+    '''
+    scans packages of at least min_bytes in process_count processes, off the GIL of the HL7 workers.
+    smaller packages are quicker to scan right away than to hand over. every process is replaced after
+    max_tasks_per_child packages, so memory held by decompression can't pile up.
+    the processes are only started once the first large package shows up.
+    '''
+    def __init__(self, process_count, min_bytes=1024 * 1024, max_tasks_per_child=100, timeout=300):
+        self.process_count = process_count
+        self.min_bytes = min_bytes
+        self.max_tasks_per_child = max_tasks_per_child if max_tasks_per_child > 0 else None
+        self.timeout = timeout if timeout > 0 else None
+        self.submitted = 0
+        self.__pool = None
+
+    @property
+    def enabled(self):
+        return self.process_count > 0
+
+    def submit(self, hl7_fullname, max_members=0, max_bytes=0, verdict_cache=None):
+        '''
+        :return: pending_verdict of the package, None if it's small or known to verdict_cache,
+                 so it's better scanned in the calling thread
+        '''
+        if not self.enabled:
+            return None
+
+        identity = filecache.get_file_identity(hl7_fullname)
+        if identity is None or identity[2] < self.min_bytes:
+            return None
+        if verdict_cache is not None and verdict_cache.get(identity) is not None:
+            return None
+
+        if self.__pool is None:
+            logging.info("Starting %d validation process(es)", self.process_count)
+            self.__pool = multiprocessing.Pool(self.process_count, maxtasksperchild=self.max_tasks_per_child)
+
+        scan_args = (hl7_fullname, max_members, max_bytes)
+        self.submitted += 1
+        return pending_verdict(self.__pool.apply_async(scan_package, scan_args), scan_args,
+                               identity, verdict_cache, self.timeout)
+
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+
+def get_validation_pool(my_config):
+    '''
+    :return: the validation pool of this configuration, a disabled one unless hl7_validation_processes is set
+    '''
+    pool = getattr(my_config, 'validation_pool', None)
+    if pool is None:
+        pool = validation_pool(my_config.hl7_validation_processes, my_config.hl7_validation_process_min_bytes,
+                               my_config.hl7_validation_max_tasks_per_child, my_config.hl7_validation_timeout)
+        my_config.validation_pool = pool
+    return pool
+
+
+def close_validation_pool(my_config):
+    pool = getattr(my_config, 'validation_pool', None)
+    if pool is not None:
+        pool.close()
+        my_config.validation_pool = None
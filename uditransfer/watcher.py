@@ -0,0 +1,147 @@
+import sys
+import os
+import errno
+import logging
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# a file is ready to be dispatched once its writer closed it or it has been moved in.
+FILE_READY_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+# any new entry in a flag folder could make an orphan match.
+FLAG_CHANGE_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct('iIII')
+EVENT_BUFFER_SIZE = 64 * 1024
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        library_name = ctypes.util.find_library('c') or 'libc.so.6'
+        _libc = ctypes.CDLL(library_name, use_errno=True)
+    return _libc
+
+
+def inotify_available():
+    '''
+    inotify is only available on Linux, and only through libc since python has no binding for it.
+    :return: True if an inotify watcher can be created on this box
+    '''
+    if not sys.platform.startswith('linux'):
+        return False
+
+    try:
+        libc = _get_libc()
+        return hasattr(libc, 'inotify_init1') and hasattr(libc, 'inotify_add_watch')
+    except Exception:
+        return False
+
+
+class inotify_watcher():
+    def __init__(self):
+        libc = _get_libc()
+        self.__fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, "inotify_init1 failed: %s" % os.strerror(error_number))
+
+        self.__folders = {}
+        self.overflowed = False
+
+    def add_folder(self, folder, mask):
+        libc = _get_libc()
+        path = os.path.abspath(folder)
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+
+        wd = libc.inotify_add_watch(self.__fd, ctypes.c_char_p(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, "inotify_add_watch failed for %s: %s" % (folder, os.strerror(error_number)))
+
+        self.__folders[wd] = folder
+        logging.debug("Watching folder:%s", folder)
+        return wd
+
+    def read_events(self, timeout):
+        '''
+        wait up to timeout seconds for events.
+        :param timeout: seconds to wait, None waits forever, 0 only drains what is queued
+        :return: list of (folder, file_name, mask)
+        '''
+        try:
+            readable, _, _ = select.select([self.__fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        if not readable:
+            return []
+
+        events = []
+        while True:
+            try:
+                buffer = os.read(self.__fd, EVENT_BUFFER_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+
+            if not buffer:
+                break
+
+            events.extend(self.__parse_events(buffer))
+
+        return events
+
+    def __parse_events(self, buffer):
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, cookie, name_length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify event queue overflowed, a full rescan will be triggered!")
+                self.overflowed = True
+                continue
+
+            if mask & (IN_IGNORED | IN_ISDIR):
+                continue
+
+            folder = self.__folders.get(wd)
+            if folder is None:
+                continue
+
+            if not isinstance(name, str):
+                name = name.decode(sys.getfilesystemencoding() or 'utf-8')
+
+            events.append((folder, name, mask))
+
+        return events
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
@@ -0,0 +1,128 @@
+import sys
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+sys.path.append(".")
+
+try:
+    from . import profiler
+except:
+    import profiler
+
+
+def run_tasks(task_function, items, worker_count, name="worker"):
+    '''
+    run task_function for every item with a bounded pool of threads.
+    each item is handled by exactly one worker from start to end, so all steps of one item keep their order.
+    :param task_function: callable taking one item
+    :param items: list of items
+    :param worker_count: number of threads, 1 or less runs everything in the calling thread
+    :param name: thread name prefix, shows up in log lines
+    the threads are profiled as part of the pass when the calling thread runs a profiled one.
+    :return: list of results in the same order as items, None for an item whose task raised
+    '''
+    items = list(items)
+    results = [None] * len(items)
+    if worker_count <= 1 or len(items) <= 1:
+        for index, item in enumerate(items):
+            results[index] = _run_one(task_function, item)
+        return results
+
+    task_queue = queue.Queue()
+    for index, item in enumerate(items):
+        task_queue.put((index, item))
+
+    active_profile = profiler.get_active_profile()
+
+    def worker():
+        with profiler.worker_profile(active_profile):
+            while True:
+                try:
+                    index, item = task_queue.get_nowait()
+                except queue.Empty:
+                    return
+                results[index] = _run_one(task_function, item)
+
+    threads = []
+    for thread_index in range(min(worker_count, len(items))):
+        thread = threading.Thread(target=worker, name="%s-%d" % (name, thread_index))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def _run_one(task_function, item):
+    try:
+        return task_function(item)
+    except Exception:
+        logging.exception("Unexpected error in worker task for:%s", item)
+        return None
+
+
+class bounded_section():
+    '''
+    a with-block which lets at most limit threads in at the same time, limit 0 or less means no limit.
+    '''
+    def __init__(self, limit):
+        self.__semaphore = threading.BoundedSemaphore(limit) if limit > 0 else None
+
+    def __enter__(self):
+        if self.__semaphore:
+            self.__semaphore.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.__semaphore:
+            self.__semaphore.release()
+        return False
+
+
+def group_items(items, key_function):
+    '''
+    put items sharing at least one key into the same group, so they can be handed to one worker.
+    :param items: list of items
+    :param key_function: callable returning the list of keys of an item
+    :return: list of groups, each group keeps the order of items, groups are ordered by their first item
+    '''
+    parents = {}
+
+    def find(key):
+        root = key
+        while parents[root] != root:
+            root = parents[root]
+        while parents[key] != root:
+            parents[key], key = root, parents[key]
+        return root
+
+    item_keys = []
+    for index, item in enumerate(items):
+        keys = [('item', index)] + [('key', key) for key in key_function(item)]
+        for key in keys:
+            parents.setdefault(key, key)
+        first_root = find(keys[0])
+        for key in keys[1:]:
+            root = find(key)
+            if root != first_root:
+                parents[root] = first_root
+        item_keys.append(keys[0])
+
+    groups = {}
+    ordered_groups = []
+    for index, item in enumerate(items):
+        root = find(item_keys[index])
+        if root not in groups:
+            groups[root] = []
+            ordered_groups.append(groups[root])
+        groups[root].append(item)
+
+    return ordered_groups